@@ -0,0 +1,348 @@
+#
+# Asyncio client library for the facial recognition web service.
+#
+# Usage:
+#
+#   async with FacialRecognitionClient(baseurl) as client:
+#     face = await client.authenticate("me.jpeg")
+#     if face is not None:
+#       print("Hello,", face.firstname)
+#
+# All requests go through one pooled keep-alive aiohttp session, are
+# limited to max_concurrency in flight, time out after `timeout` seconds
+# and are retried with jittered exponential backoff when throttled (reads
+# and authentication also on 5xx / dropped connections, registration not).
+# Results come back as Face / Attributes objects; failures raise
+# ClientError. main.py is a thin command-line layer over this module.
+#
+import json
+import time
+import asyncio
+import random
+import pathlib
+
+import aiohttp
+
+import uploads
+import governor
+
+
+###################################################################
+#
+# classes
+#
+class Face:
+
+  # compact records: listing tens of thousands of faces builds one per row
+  __slots__ = ("entryid", "firstname", "lastname", "rekognitionid", "bucketkey")
+
+  def __init__(self, entryid, firstname, lastname, rekognitionid, bucketkey):
+    self.entryid = entryid # these must match columns from DB table
+    self.firstname = firstname
+    self.lastname = lastname
+    self.rekognitionid = rekognitionid
+    self.bucketkey = bucketkey
+
+  @staticmethod
+  def from_row(row):
+    return Face(row[0], row[1], row[2], row[3], row[4])
+
+class Attributes:
+
+  __slots__ = ("gender", "agerange", "emotions", "name")
+
+  def __init__(self, gender, agerange, emotions, name=None):
+    self.gender = gender
+    self.agerange = agerange
+    self.emotions = emotions
+    self.name = name
+
+class ClientError(Exception):
+
+  def __init__(self, status, message, url):
+    super().__init__("status " + str(status) + " from " + url + ": " + str(message))
+    self.status = status
+    self.message = message
+    self.url = url
+
+
+###################################################################
+#
+# client
+#
+class FacialRecognitionClient:
+
+  def __init__(self, baseurl, max_concurrency=8, timeout=30, retries=3,
+               binary=True, preprocessor=None, on_upload=None):
+    """
+    Parameters
+    ----------
+    baseurl: baseurl for web service
+    max_concurrency: most requests in flight at once (also the pool size)
+    timeout: total seconds allowed per HTTP request
+    retries: retries for throttled / transient failures
+    binary: send images as raw bytes (True) or base64 JSON (False)
+    preprocessor: optional preprocess.Preprocessor run before uploads
+    on_upload: optional callback(preprocess report, request ms) after
+               each image upload, e.g. preprocess.print_report
+    """
+    if baseurl.endswith("/"):
+      baseurl = baseurl[:-1]
+
+    self.baseurl = baseurl
+    self.max_concurrency = max_concurrency
+    self.timeout = aiohttp.ClientTimeout(total=timeout)
+    self.retries = retries
+    self.binary = binary
+    self.preprocessor = preprocessor
+    self.on_upload = on_upload
+
+    self.session = None
+    self.semaphore = None
+
+  async def __aenter__(self):
+    await self.open()
+    return self
+
+  async def __aexit__(self, *exc):
+    await self.close()
+
+  async def open(self):
+    if self.session is None:
+      connector = aiohttp.TCPConnector(limit=self.max_concurrency, keepalive_timeout=60)
+      self.session = aiohttp.ClientSession(connector=connector, timeout=self.timeout)
+      self.semaphore = asyncio.Semaphore(self.max_concurrency)
+
+  async def close(self):
+    if self.session is not None:
+      await self.session.close()
+      self.session = None
+
+  async def request(self, method, api, expect=(200,), retry_transient=True, **kwargs):
+    """
+    Sends one request with concurrency limit and retries. Throttled
+    requests are always retried; 5xx responses, dropped connections and
+    timeouts only with retry_transient, since the server may have carried
+    the request out (pass False for requests that must not run twice)
+
+    Returns
+    -------
+    (status code, decoded JSON body)
+    """
+    await self.open()
+    url = self.baseurl + api
+    attempt = 0
+
+    while True:
+      try:
+        async with self.semaphore:
+          async with self.session.request(method, url, **kwargs) as res:
+            status = res.status
+            text = await res.text()
+
+        throttled = governor.is_retryable_response(status, text, retry_transient)
+
+        if not throttled or attempt >= self.retries:
+          break
+
+      except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+        if not retry_transient or attempt >= self.retries:
+          raise
+
+      await asyncio.sleep(random.uniform(0, min(20.0, 0.5 * (2 ** attempt))))
+      attempt += 1
+
+    try:
+      body = json.loads(text)
+    except ValueError:
+      body = text
+
+    if status not in expect:
+      raise ClientError(status, body, url)
+
+    return status, body
+
+  async def read_image(self, local_filename, upload_filename):
+    """
+    Reads and preprocesses an image off the event loop
+
+    Returns
+    -------
+    (filename to upload under, bytes, preprocess report or None)
+    """
+    if pathlib.Path(local_filename).suffix.lower() not in (".jpeg", ".jpg", ".png"):
+      raise ValueError("File must be jpeg or png format")
+
+    bytes = await asyncio.to_thread(pathlib.Path(local_filename).read_bytes)
+    report = None
+
+    if self.preprocessor is not None:
+      upload_filename, bytes, report = await asyncio.to_thread(
+        self.preprocessor.process, upload_filename, bytes)
+
+    return upload_filename, bytes, report
+
+  async def upload(self, api, local_filename, upload_filename, expect=(200,), options=None,
+                   retry_transient=True):
+    """
+    Reads, preprocesses and PUTs an image (see request for retry_transient)
+
+    Returns
+    -------
+    (status code, decoded JSON body)
+    """
+    filename, bytes, report = await self.read_image(local_filename, upload_filename)
+
+    start = time.perf_counter()
+    status, body = await self.request(
+      "PUT", api, expect=expect, retry_transient=retry_transient,
+      **uploads.image_upload_args(filename, bytes, self.binary, options))
+
+    if self.on_upload is not None and report is not None:
+      self.on_upload(report, (time.perf_counter() - start) * 1000)
+
+    return status, body
+
+  #
+  # see_registered
+  #
+  async def iter_registered(self, page_size=500):
+    """
+    Async generator yielding every registered Face, one page at a time
+    """
+    after_entryid = 0
+
+    while after_entryid is not None:
+      status, body = await self.request(
+        "GET", "/registered_faces",
+        params={"after_entryid": after_entryid, "limit": page_size})
+
+      for row in body["faces"]:
+        yield Face.from_row(row)
+
+      after_entryid = body["next_after_entryid"]
+
+  async def see_registered(self, page_size=500):
+    """
+    Returns a list of every registered Face
+    """
+    return [face async for face in self.iter_registered(page_size)]
+
+  #
+  # register
+  #
+  async def register(self, local_filename, firstname, lastname):
+    """
+    Registers the face in local_filename under the given name
+
+    Returns
+    -------
+    the server's confirmation message
+    """
+    extension = pathlib.Path(local_filename).suffix.lower().lstrip(".")
+    if extension == "jpg":
+      extension = "jpeg"
+
+    #
+    # registering twice would add a second face and row, so only
+    # throttled requests are retried:
+    #
+    status, body = await self.upload(
+      "/register_faces", local_filename, uploads.registration_filename(firstname, lastname, extension),
+      retry_transient=False)
+
+    return body
+
+  #
+  # authenticate
+  #
+  async def authenticate(self, local_filename):
+    """
+    Returns the matching registered Face, or None if nobody matched
+    """
+    status, body = await self.upload(
+      "/authenticate_faces", local_filename, local_filename, expect=(200, 403))
+
+    if status == 403:
+      return None
+
+    return Face.from_row(body)
+
+  async def authenticate_bytes(self, filename, bytes):
+    """
+    Like authenticate, for an image that is already in memory (e.g. an
+    encoded video frame); no preprocessing is applied
+
+    Returns
+    -------
+    the matching registered Face, or None if nobody matched
+    """
+    status, body = await self.request(
+      "PUT", "/authenticate_faces", expect=(200, 403),
+      **uploads.image_upload_args(filename, bytes, self.binary))
+
+    if status == 403:
+      return None
+
+    return Face.from_row(body)
+
+  async def authenticate_group(self, local_filename):
+    """
+    Identifies every face in a group photo with one request
+
+    Returns
+    -------
+    (list of (Face, BoundingBox, Similarity) for each identified person,
+     number of faces that were not identified)
+    """
+    status, body = await self.upload(
+      "/authenticate_faces", local_filename, local_filename, expect=(200, 403),
+      options={"mode": "multi"})
+
+    if not isinstance(body, dict):  # single-face server: nobody matched
+      return [], 0
+
+    people = [(Face.from_row(item["Face"]), item["BoundingBox"], item["Similarity"])
+              for item in body["faces"]]
+
+    return people, body["unidentified"]
+
+  #
+  # face_attributes
+  #
+  async def face_attributes(self, entryid):
+    """
+    Returns the Attributes of a registered face; raises ClientError with
+    status 403 if the entry does not exist
+    """
+    status, body = await self.request("GET", "/face_attributes", json={"entryid": entryid})
+
+    return Attributes(body['Gender'], body['AgeRange'], body['Emotions'], body['Name'])
+
+  async def face_attributes_bulk(self, entryids, batch_size=200):
+    """
+    Fetches attributes for many entries, batch_size entry IDs per request
+    (batches are sent concurrently, within the client's limit)
+
+    Returns
+    -------
+    (dictionary entryid -> Attributes, dictionary entryid -> error message)
+    """
+    entryids = list(entryids)
+    batches = [entryids[i:i + batch_size] for i in range(0, len(entryids), batch_size)]
+
+    async def fetch(batch):
+      status, body = await self.request("GET", "/face_attributes", json={"entryids": batch})
+      return body
+
+    found = {}
+    errors = {}
+
+    for body in await asyncio.gather(*[fetch(batch) for batch in batches]):
+      for entryid, item in body.items():
+        if "error" in item:
+          errors[int(entryid)] = item["error"]
+        else:
+          found[int(entryid)] = Attributes(item['Gender'], item['AgeRange'], item['Emotions'], item['Name'])
+
+    return found, errors
@@ -0,0 +1,73 @@
+#
+# Face attributes (gender, age range, emotions) stored with each
+# registration in the faces.attributes column as JSON.
+#
+# register_faces captures them from index_faces, which returns the same
+# FaceDetail as detect_faces when asked for DetectionAttributes=['ALL'],
+# so face_attributes is a single indexed read instead of a Rekognition
+# call per request. Rows registered before this column existed are filled
+# in lazily by face_attributes, or in bulk by backfill_attributes.py.
+#
+import json
+import requestlog
+
+columns = "entryid, firstname, lastname, rekognitionid, bucketkey"
+
+
+def summarize(face_detail):
+  """
+  Keeps the parts of a Rekognition FaceDetail the app reports, with the
+  emotions ordered most confident first
+
+  Returns
+  -------
+  dictionary with Gender, AgeRange and Emotions, or None if there is no
+  detail (e.g. a matcher backend that does not detect attributes)
+  """
+  if not face_detail or "Gender" not in face_detail:
+    return None
+
+  return {
+    "Gender": face_detail["Gender"],
+    "AgeRange": face_detail["AgeRange"],
+    "Emotions": sorted(face_detail["Emotions"], key=lambda e: e["Confidence"], reverse=True)
+  }
+
+
+def detect(rekognition, bucketname, bucketkey):
+  """
+  Runs detect_faces on a registered image in S3 (the fallback for rows
+  that have no stored attributes yet)
+  """
+  with requestlog.span("rekognition"):
+    response = rekognition.detect_faces(
+      Image={
+        'S3Object': {
+          'Bucket': bucketname,
+          'Name': bucketkey
+        }
+      },
+      Attributes=["ALL"]
+    )
+
+  if not response["FaceDetails"]:
+    raise Exception("no face detected in " + bucketkey)
+
+  return summarize(response["FaceDetails"][0])
+
+
+def encode(attributes):
+  return json.dumps(attributes) if attributes is not None else None
+
+
+def decode(value):
+  if value is None:
+    return None
+  if isinstance(value, (bytes, bytearray)):
+    value = value.decode()
+  return json.loads(value)
+
+
+def store(db, entryid, attributes):
+  sql = "UPDATE faces SET attributes = %s WHERE entryid = %s;"
+  db.perform_action(sql, [encode(attributes), entryid])
@@ -1,153 +1,283 @@
+import io
 import json
-import boto3
-import os
-import uuid
-import base64
-import pathlib
-import datatier
+import shards
+import governor
+import lambda_init
+import requestlog
+import imagerequest
+import objectstore
+import resultcache
+import attributestore
+
+
+#
+# margin added around each detected face when cropping group photos,
+# as a fraction of the face's size:
+#
+crop_margin = 0.25
+
+
+#
+# registered_rows
+#
+# Looks up a set of Rekognition face ids in one query and returns a
+# dictionary rekognitionid -> registered row.
+#
+def registered_rows(db, face_ids):
+  if not face_ids:
+    return {}
+
+  sql = """
+    SELECT """ + attributestore.columns + """ FROM faces
+    WHERE rekognitionid IN ({in});
+    """
+  rows = db.retrieve_in(sql, list(face_ids))
+
+  # rekognitionid is the 4th column:
+  return {row[3]: row for row in rows}
+
+
+#
+# best_registered_match
+#
+# Looks up every Rekognition candidate in one query and returns the
+# registered row with the highest similarity, or None.
+#
+def best_registered_match(db, face_matches):
+  similarity = {}
+  for match in face_matches:
+    similarity[match['Face']['FaceId']] = match['Similarity']
+
+  requestlog.debug("candidates", similarity=similarity)
+
+  rows = registered_rows(db, similarity)
+
+  if not rows:
+    return None
+
+  return max(rows.values(), key=lambda row: similarity[row[3]])
+
+
+#
+# crop_faces
+#
+# Cuts each face's bounding box (Rekognition's ratios of the image size)
+# plus a margin out of the image in memory, as JPEG bytes.
+#
+def crop_faces(image_bytes, boxes):
+  from PIL import Image
+
+  image = Image.open(io.BytesIO(image_bytes))
+  if image.mode != "RGB":
+    image = image.convert("RGB")
+  width, height = image.size
+
+  crops = []
+  for box in boxes:
+    dx = box['Width'] * crop_margin
+    dy = box['Height'] * crop_margin
+
+    left = max(0, int((box['Left'] - dx) * width))
+    top = max(0, int((box['Top'] - dy) * height))
+    right = min(width, int((box['Left'] + box['Width'] + dx) * width))
+    bottom = min(height, int((box['Top'] + box['Height'] + dy) * height))
+
+    out = io.BytesIO()
+    image.crop((left, top, right, bottom)).save(out, format="JPEG", quality=90)
+    crops.append(out.getvalue())
+
+  return crops
+
+
+#
+# authenticate_group
+#
+# Multi-face mode: one detect_faces call finds every face, each face is
+# cropped in memory and all crops are searched concurrently, then every
+# candidate is looked up in a single query. Returns the HTTP response.
+#
+def authenticate_group(matcher, db, image_bytes, collection_id=None):
+  boxes = matcher.detect_faces(image_bytes)
+  requestlog.info("detected faces", faces=len(boxes))
+
+  threshold, _ = lambda_init.get_search_params()
+  executor = lambda_init.get_executor()
+
+  with requestlog.span("crop"):
+    crops = crop_faces(image_bytes, boxes)
+
+  searches = [executor.submit(matcher.search, crop, threshold, 1, collection_id) for crop in crops]
+
+  best = []
+  for search in searches:
+    try:
+      matches = search.result()
+    except Exception as err:
+      requestlog.warning("face search failed", error=str(err))
+      matches = []
+    best.append(matches[0] if matches else None)
+
+  rows = registered_rows(db, [match['Face']['FaceId'] for match in best if match])
+
+  identified = []
+  for box, match in zip(boxes, best):
+    if match and match['Face']['FaceId'] in rows:
+      identified.append({
+        "Face": rows[match['Face']['FaceId']],
+        "BoundingBox": box,
+        "Similarity": match['Similarity']
+      })
+
+  requestlog.info("identified faces", identified=len(identified), faces=len(boxes))
 
-from configparser import ConfigParser
+  return {
+    'statusCode': 200 if identified else 403,
+    'body': json.dumps({
+      "faces": identified,
+      "unidentified": len(boxes) - len(identified)
+    })
+  }
+
+
+#
+# finish_archive
+#
+# Waits for the background put_object started by the handler.
+#
+def finish_archive(archive, bucketname, key):
+  try:
+    with requestlog.span("s3_wait"):
+      uploaded = archive.result()
+    requestlog.debug("archived to S3", bucket=bucketname, key=key, uploaded=uploaded)
+  except Exception as err:
+    requestlog.warning("archive to S3 failed", bucket=bucketname, key=key, error=str(err))
+
+
+#
+# authenticate_image
+#
+# Identifies the face (or, in multi mode, every face) in the image, from
+# the result cache when it can. Returns the HTTP response.
+#
+def authenticate_image(matcher, db, body, image_bytes, digest):
+  #
+  # with sharded collections, a shard key limits the search to its
+  # collection; without one every shard is searched:
+  #
+  shard_key = shards.shard_key(body)
+  collection_id = matcher.route(shard_key) if shard_key else None
+
+  #
+  # group photos: identify every face in one request
+  #
+  if body.get("mode") == "multi":
+    return authenticate_group(matcher, db, image_bytes, collection_id)
+
+  #
+  # kiosks re-submit the same frame a lot, so identical (or, with
+  # phash_distance set, nearly identical) images are answered from the
+  # container's result cache. A search limited to a shard can have a
+  # different outcome, so those are cached per shard key (exact hash only):
+  #
+  cache = resultcache.get_cache(lambda_init.get_config())
+  cache_status = "DISABLED"
+  cache_key = digest if shard_key is None else digest + ":" + shard_key
+  phash = None
+  outcome = None
+
+  if cache is not None:
+    cache.refresh_generation(lambda: resultcache.current_generation(db))
+    with requestlog.span("cache"):
+      if cache.phash_distance > 0 and shard_key is None:
+        phash = resultcache.perceptual_hash(image_bytes)
+      outcome = cache.get(cache_key, phash)
+
+  if outcome is not None:
+    cache_status = "HIT"
+    row = None if outcome == resultcache.no_match else outcome
+  else:
+    threshold, max_faces = lambda_init.get_search_params()
+
+    face_matches = matcher.search(image_bytes, threshold, max_faces, collection_id)
+
+    row = best_registered_match(db, face_matches)
+
+    if cache is not None:
+      cache_status = "MISS"
+      cache.put(cache_key, row if row else resultcache.no_match, phash)
+
+  requestlog.annotate(cache=cache_status)
+  if cache is not None:
+    requestlog.debug("cache stats", **cache.stats())
+
+  requestlog.annotate(matched=bool(row))
+
+  if row:
+    requestlog.info("face matched", entryid=row[0])
+    return {
+      'statusCode': 200,
+      'headers': {'X-Cache': cache_status},
+      'body': json.dumps(row)
+    }
+
+  return {
+    'statusCode': 403, 
+    'headers': {'X-Cache': cache_status},
+    'body': json.dumps("No Face Match Found!")
+  }
 
 
+@requestlog.handler("authenticate_faces")
 def lambda_handler(event, context):
   try: 
-    print("**STARTING AUTHENTICATION**")
-    print("PRINTING EVENT:\n", event)
-
-    config_file = 'config.ini'
-    os.environ['AWS_SHARED_CREDENTIALS_FILE'] = config_file
-
-    configur = ConfigParser()
-    configur.read(config_file)
-
-    s3_profile = 's3readwrite+rekognition'
-    boto3.setup_default_session(profile_name=s3_profile)
-
-    bucketname = configur.get('s3', 'bucket_name')
-
-    s3 = boto3.resource('s3')
-    bucket = s3.Bucket(bucketname)
-
-    print("**Accessing request body**")
-
-    if "body" not in event:
-      raise Exception("event has no body")
-
-    body = json.loads(event["body"]) # parse the json
-
-    if "filename" not in body:
-      raise Exception("event has a body but no filename")
-    if "data" not in body:
-      raise Exception("event has a body but no data")
-
-    filename = body["filename"]
-    datastr = body["data"]
-
-    print("filename:", filename)
-    print("datastr (first 10 chars):", datastr[0:10])
-
-    base64_bytes = datastr.encode()        # string -> base64 bytes
-    bytes = base64.b64decode(base64_bytes) # base64 bytes -> raw bytes
-
     #
-    # write raw bytes to local filesystem for upload:
+    # config, clients and db connection are cached across warm invocations:
     #
-    print("**Writing local data file**")
-
-    local_filename = "/tmp/data.pdf"
-
-    outfile = open(local_filename, "wb")
-    outfile.write(bytes)
-    outfile.close()
+    bucket, s3, matcher, db = lambda_init.timed_setup(
+      "authenticate_faces",
+      lambda_init.get_bucket,
+      lambda_init.get_s3,
+      lambda_init.get_matcher,
+      lambda_init.get_db)
 
-    #
-    # generate unique filename in preparation for the S3 upload:
-    #
-    print("**Uploading local file to S3**")
+    bucketname = bucket.name
 
-    basename = pathlib.Path(filename).stem
-    extension = pathlib.Path(filename).suffix
-    print("basename:", basename)
-    print("extension:", extension)
+    filename, bytes, body = imagerequest.parse_image_request(event)
 
-    if extension != ".jpeg" and extension != "png": 
-        raise Exception("expecting filename to have .jpeg or .png extension")
+    extension = imagerequest.check_image(filename, bytes)
 
     # bucketkey = "310final-authenticate-facial-images-storage/" + filename
 
-    print("S3 bucketkey:", filename)
-
-    #
-    # finally, upload to S3:
-    #
-    print("**Uploading data file to S3**")
-
-    bucket.upload_file(local_filename, 
-                       filename, 
-                       ExtraArgs={
-                         'ACL': 'public-read',
-                         'ContentType': 'application/'+extension
-                       })
-
     #
-    # respond in an HTTP-like way, i.e. with a status
-    # code and body in JSON format:
+    # archive into the authentication bucket in the background; matching
+    # works on the in-memory bytes, so S3 is not on the critical path. The
+    # key is the content hash, so a retried or repeated image is stored
+    # (and uploaded) only once:
     #
-    print("**DONE UPLOADING TO S3 AUTHENTICATION BUCKET**")
-
-    print("This is the bucket:", bucketname)
-    # object_key = event['Records'][0]['s3']['object']['key']
-    object_key = filename
-    print("This is the object key:", object_key)
-    #get image in bytes
-    s3 = boto3.client('s3')
-    image_bytes = s3.get_object(Bucket=bucketname, Key=object_key)['Body'].read()
+    digest = objectstore.content_hash(bytes)
+    archive_key = objectstore.content_key(digest, extension)
+
+    archive = lambda_init.get_executor().submit(
+      requestlog.timed("s3", objectstore.put_if_absent),
+      s3, bucketname, archive_key, bytes, extension)
+
+    try:
+      return authenticate_image(matcher, db, body, bytes, digest)
+    finally:
+      #
+      # the container is frozen once we return, so let the archive finish,
+      # also when the search failed; a failed archive is logged but does
+      # not fail the authentication:
+      #
+      finish_archive(archive, bucketname, archive_key)
 
+  except Exception as err:
+    requestlog.error("authentication failed", error=str(err))
     #
-    # configure for RDS access
+    # still throttled after the governor's retries: 429 tells the client
+    # to back off and retry
     #
-    rds_endpoint = configur.get('rds', 'endpoint')
-    rds_portnum = int(configur.get('rds', 'port_number'))
-    rds_username = configur.get('rds', 'user_name')
-    rds_pwd = configur.get('rds', 'user_pwd')
-    rds_dbname = configur.get('rds', 'db_name')
-
-    #configure for rekognition access
-    rekognition = boto3.client('rekognition', region_name='us-east-2')
-
-    response = rekognition.search_faces_by_image(
-      CollectionId='database-faces',
-      Image={'Bytes':image_bytes}
-    )
-
-    print(response)
-
-    for match in response['FaceMatches']:
-      print(match['Face']['FaceId'], match['Face']['Confidence'])
-
-      print("**Opening connection**")
-
-      dbConn = datatier.get_dbConn(rds_endpoint, rds_portnum, rds_username, rds_pwd, rds_dbname)
-
-      sql = """
-        SELECT * FROM faces WHERE rekognitionid = %s;
-        """
-      row = datatier.retrieve_one_row(dbConn, sql, [match['Face']['FaceId']])
-
-      if row:
-        print("Face Matched!!", row)
-        return {
-          'statusCode': 200,
-          'body': json.dumps(row)
-        }
-
-  except Exception as err:
     return {
-      'statusCode': 400, 
+      'statusCode': governor.error_status(err), 
       'body': json.dumps(str(err))
     }
-
-  return {
-    'statusCode': 403, 
-    'body': json.dumps("No Face Match Found!")
-  }
\ No newline at end of file
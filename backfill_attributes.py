@@ -0,0 +1,72 @@
+#
+# One-off backfill of faces.attributes for rows registered before
+# register_faces started storing them.
+#
+# Run from a directory containing the lambdas' config.ini:
+#
+#   python backfill_attributes.py [batch size] [concurrency]
+#
+# Applies pending schema migrations (which add the attributes column), then
+# walks the rows that have no attributes in entryid order, calling
+# detect_faces on each registered image (a bounded number at a time) and
+# storing the result.
+# It can be stopped and rerun at any time; finished rows are skipped.
+#
+import sys
+import dataaccess
+import lambda_init
+import requestlog
+import attributestore
+
+from concurrent.futures import ThreadPoolExecutor
+
+
+def backfill(batch_size=100, concurrency=4):
+  db = lambda_init.get_db()
+  rekognition = lambda_init.get_rekognition()
+  bucketname = lambda_init.get_config().get('s3', 'bucket_name')
+
+  dataaccess.migrate(db)
+
+  sql = """
+    SELECT entryid, bucketkey FROM faces
+    WHERE attributes IS NULL AND entryid > %s
+    ORDER BY entryid LIMIT %s;
+    """
+
+  def detect(row):
+    entryid, bucketkey = row
+    try:
+      return entryid, attributestore.detect(rekognition, bucketname, bucketkey), None
+    except Exception as err:
+      return entryid, None, str(err)
+
+  after_entryid = 0
+  done = 0
+  failed = 0
+
+  with ThreadPoolExecutor(max_workers=concurrency) as pool:
+    while True:
+      rows = db.retrieve_all_rows(sql, [after_entryid, batch_size])
+      if not rows:
+        break
+
+      for entryid, attributes, err in pool.map(detect, rows):
+        if err is not None:
+          print("entry", entryid, "failed:", err)
+          failed += 1
+          continue
+        attributestore.store(db, entryid, attributes)
+        done += 1
+
+      after_entryid = rows[-1][0]
+      print("**backfilled through entry", after_entryid, "**")
+
+  print("**DONE** updated:", done, "failed:", failed)
+
+
+if __name__ == "__main__":
+  batch_size = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+  concurrency = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+  requestlog.configure()
+  backfill(batch_size, concurrency)
@@ -0,0 +1,424 @@
+#
+# Local end-to-end benchmark of the four lambda handlers.
+#
+# The handlers run in-process against the stand-ins in standins.py for S3
+# and Rekognition and an SQLite faces table (dataaccess), injected through
+# lambda_init's cached clients, so no AWS account is needed:
+#
+#   python benchmark.py --gallery 200 --requests 500 --rekognition-ms 80
+#
+# Phases, in order: register the synthetic gallery, authenticate a mix of
+# registered people, repeated frames and strangers, single and bulk
+# face_attributes, and see_registered (one page and the full list).
+#
+# For each handler it reports latency percentiles and throughput, the time
+# spent in every S3 / Rekognition / database call ("stages"), the handler's
+# own per-request stage spans (requestlog), and, from a second pass under
+# tracemalloc, the peak memory allocated per invocation and the number of
+# blocks still held afterwards. Results are written as
+# JSON; --compare prints the change against an earlier results file and
+# exits non-zero when a handler's p50 regressed by more than --tolerance.
+#
+import os
+import sys
+import json
+import time
+import base64
+import random
+import argparse
+import platform
+import subprocess
+import contextlib
+import tracemalloc
+
+from configparser import ConfigParser
+
+import latency
+import governor
+import standins
+import dataaccess
+import requestlog
+import objectstore
+import lambda_init
+import resultcache
+
+
+###################################################################
+#
+# setup
+#
+def install(args, recorder):
+  """
+  Points lambda_init's cached config, clients and database at the
+  stand-ins. Returns the StubS3, StubRekognition and database models so
+  their call / throttle counts can be reported.
+  """
+  configur = ConfigParser()
+  configur.read_dict({
+    "s3": {"bucket_name": "benchmark-bucket"},
+    "rds": {"engine": "sqlite", "sqlite_path": ":memory:"},
+    "matcher": {"backend": "rekognition"},
+    "cache": {
+      "enabled": str(not args.no_cache).lower(),
+      "phash_distance": "0"
+    },
+    "governor": {
+      "enabled": str(not args.no_governor).lower(),
+      "tps": str(args.tps)
+    },
+    "shards": {"count": str(args.shards)}
+  })
+
+  def model(base_ms, throttle_code, seed):
+    return standins.ServiceModel(base_ms, args.jitter_ms, args.throttle_rate, throttle_code, seed)
+
+  s3 = standins.StubS3(model(args.s3_ms, "SlowDown", args.seed))
+  rekognition = standins.StubRekognition(
+    s3, model(args.rekognition_ms, "ProvisionedThroughputExceededException", args.seed + 1))
+  rekognition.create_collection(CollectionId="database-faces")
+
+  #
+  # the database is only slowed down, never throttled:
+  #
+  db_model = standins.ServiceModel(args.db_ms, args.jitter_ms, 0.0, seed=args.seed + 2)
+  db = dataaccess.from_config(configur)
+  dataaccess.migrate(db)
+
+  lambda_init._config = configur
+  lambda_init._s3_resource = standins.StubS3Resource(s3)
+  lambda_init._s3_client = standins.Instrumented(s3, "s3", recorder)
+  lambda_init._rekognition = standins.Instrumented(rekognition, "rekognition", recorder)
+  lambda_init._governor = None
+
+  gov = lambda_init.get_governor()
+  if gov is not None:
+    lambda_init._rekognition = governor.GovernedClient(lambda_init._rekognition, gov)
+  lambda_init._db = standins.Instrumented(db, "db", recorder, db_model)
+  lambda_init._matcher = None
+  resultcache._cache = None
+
+  return {"s3": s3.model, "rekognition": rekognition.model, "db": db_model}
+
+
+###################################################################
+#
+# events
+#
+def image_event(filename, image_bytes):
+  return {
+    "headers": {"Content-Type": "application/octet-stream"},
+    "queryStringParameters": {"filename": filename},
+    "body": base64.b64encode(image_bytes).decode(),
+    "isBase64Encoded": True
+  }
+
+
+def json_event(body):
+  return {"body": json.dumps(body)}
+
+
+def query_event(params):
+  return {"queryStringParameters": {key: str(value) for key, value in params.items()}}
+
+
+def gallery_events(count, rng, start=0):
+  for i in range(start, start + count):
+    person = "Person%05d" % i
+    filename = person + "_Gallery.jpeg"
+    yield image_event(filename, standins.synthetic_image(person, rng=rng))
+
+
+def probe_events(count, gallery_size, rng, repeat_rate, stranger_rate):
+  """
+  Authentication requests: a registered person in a new frame, an exact
+  repeat of an earlier frame (a kiosk re-submitting), or a stranger
+  """
+  sent = []
+
+  for i in range(count):
+    r = rng.random()
+    if sent and r < repeat_rate:
+      image_bytes = rng.choice(sent)
+    elif r < repeat_rate + stranger_rate:
+      image_bytes = standins.synthetic_image("Stranger%05d" % i, rng=rng)
+    else:
+      person = "Person%05d" % rng.randrange(gallery_size)
+      image_bytes = standins.synthetic_image(person, rng=rng)
+
+    sent.append(image_bytes)
+    yield image_event("probe%06d.jpeg" % i, image_bytes)
+
+
+###################################################################
+#
+# measurement
+#
+def stage_summary(durations_ms):
+  values = sorted(durations_ms)
+  return {
+    "calls": len(values),
+    "total_ms": round(sum(values), 1),
+    "p50_ms": round(latency.percentile(values, 50), 2),
+    "p90_ms": round(latency.percentile(values, 90), 2),
+    "p99_ms": round(latency.percentile(values, 99), 2)
+  }
+
+
+def invoke(handler, event, devnull):
+  """
+  Returns (status code, milliseconds); the handlers' log output is
+  discarded so it does not dominate the timings
+  """
+  t0 = time.perf_counter()
+  with contextlib.redirect_stdout(devnull):
+    response = handler(event, None)
+  return response.get("statusCode"), (time.perf_counter() - t0) * 1000
+
+
+def run_phase(handler, events, recorder, devnull):
+  recorder.clear()
+  latencies = []
+  statuses = {}
+  spans = {}
+
+  start = time.perf_counter()
+  for event in events:
+    status, ms = invoke(handler, event, devnull)
+    latencies.append(ms)
+    statuses[str(status)] = statuses.get(str(status), 0) + 1
+
+    for stage, span in requestlog.last_invocation.span_summary().items():
+      spans.setdefault(stage, []).append(span["ms"])
+  elapsed = time.perf_counter() - start
+
+  return {
+    "latency": latency.summarize(latencies, elapsed),
+    "status": statuses,
+    "errors": sum(n for status, n in statuses.items() if status not in ("200", "403")),
+    "stages": {stage: stage_summary(values) for stage, values in sorted(recorder.durations.items())},
+    "spans": {stage: stage_summary(values) for stage, values in sorted(spans.items())}
+  }
+
+
+def memory_phase(handler, events, devnull):
+  """
+  Runs the events under tracemalloc: peak bytes allocated during each
+  invocation, and the blocks / bytes still allocated after all of them
+  """
+  peaks = []
+
+  tracemalloc.start()
+  try:
+    before = tracemalloc.take_snapshot()
+
+    for event in events:
+      base = tracemalloc.get_traced_memory()[0]
+      tracemalloc.reset_peak()
+      invoke(handler, event, devnull)
+      peaks.append(tracemalloc.get_traced_memory()[1] - base)
+
+    after = tracemalloc.take_snapshot()
+  finally:
+    tracemalloc.stop()
+
+  diff = after.compare_to(before, "filename")
+  peaks.sort()
+
+  return {
+    "invocations": len(peaks),
+    "peak_kib_p50": round(latency.percentile(peaks, 50) / 1024, 1),
+    "peak_kib_max": round(peaks[-1] / 1024, 1) if peaks else 0.0,
+    "retained_blocks": sum(stat.count_diff for stat in diff),
+    "retained_kib": round(sum(stat.size_diff for stat in diff) / 1024, 1)
+  }
+
+
+###################################################################
+#
+# benchmark
+#
+def git_commit():
+  try:
+    return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                          text=True, check=True).stdout.strip()
+  except Exception:
+    return None
+
+
+def benchmark(args):
+  import register_faces
+  import authenticate_faces
+  import face_attributes
+  import see_registered
+
+  recorder = standins.StageRecorder()
+  models = install(args, recorder)
+  rng = random.Random(args.seed)
+
+  def attribute_events(count):
+    for _ in range(count):
+      yield json_event({"entryid": rng.randint(1, args.gallery)})
+
+  def bulk_attribute_events(count):
+    for _ in range(count):
+      yield json_event({"entryids": rng.sample(range(1, args.gallery + 1), min(100, args.gallery))})
+
+  def page_events(count):
+    for _ in range(count):
+      yield query_event({"after_entryid": rng.randrange(args.gallery), "limit": 100})
+
+  #
+  # (name, handler, timed events, memory-pass events)
+  #
+  phases = [
+    ("register_faces", register_faces.lambda_handler,
+     lambda: gallery_events(args.gallery, rng),
+     lambda: gallery_events(args.memory_samples, rng, start=args.gallery)),
+    ("authenticate_faces", authenticate_faces.lambda_handler,
+     lambda: probe_events(args.requests, args.gallery, rng, args.repeat_rate, args.stranger_rate),
+     lambda: probe_events(args.memory_samples, args.gallery, rng, args.repeat_rate, args.stranger_rate)),
+    ("face_attributes", face_attributes.lambda_handler,
+     lambda: attribute_events(args.requests),
+     lambda: attribute_events(args.memory_samples)),
+    ("face_attributes_bulk", face_attributes.lambda_handler,
+     lambda: bulk_attribute_events(max(1, args.requests // 20)),
+     lambda: bulk_attribute_events(max(1, args.memory_samples // 10))),
+    ("see_registered_page", see_registered.lambda_handler,
+     lambda: page_events(args.requests),
+     lambda: page_events(args.memory_samples)),
+    ("see_registered_all", see_registered.lambda_handler,
+     lambda: (query_event({}) for _ in range(max(1, args.requests // 20))),
+     lambda: (query_event({}) for _ in range(max(1, args.memory_samples // 10)))),
+  ]
+
+  results = {}
+
+  with open(os.devnull, "w") as devnull:
+    for name, handler, timed_events, memory_events in phases:
+      print("**", name, "**", file=sys.stderr)
+      results[name] = run_phase(handler, timed_events(), recorder, devnull)
+
+    if args.memory_samples > 0:
+      for name, handler, timed_events, memory_events in phases:
+        results[name]["memory"] = memory_phase(handler, memory_events(), devnull)
+
+  cache = resultcache.get_cache(lambda_init.get_config())
+
+  return {
+    "meta": {
+      "commit": git_commit(),
+      "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+      "python": platform.python_version(),
+      "platform": platform.platform(),
+      "args": vars(args)
+    },
+    "handlers": results,
+    "services": {name: model.stats() for name, model in models.items()},
+    "storage": objectstore.stats(),
+    "governor": lambda_init._governor.stats() if lambda_init._governor is not None else None,
+    "cache": cache.stats() if cache is not None else None
+  }
+
+
+def print_results(results):
+  print()
+  print("%-22s %7s %9s %9s %9s %9s %7s" % ("handler", "count", "req/s", "p50 ms", "p90 ms", "p99 ms", "errors"))
+
+  for name, result in results["handlers"].items():
+    summary = result["latency"]
+    print("%-22s %7d %9.1f %9.2f %9.2f %9.2f %7d" % (
+      name, summary["count"], summary["throughput_per_s"],
+      summary["p50_ms"], summary["p90_ms"], summary["p99_ms"], result["errors"]))
+
+    for stage, stats in result["stages"].items():
+      print("    %-36s %6d calls  p50 %7.2f ms  p99 %7.2f ms" % (
+        stage, stats["calls"], stats["p50_ms"], stats["p99_ms"]))
+
+    print("    spans per request: " + ", ".join(
+      "%s p50 %.2f ms" % (stage, stats["p50_ms"]) for stage, stats in result["spans"].items()))
+
+    if "memory" in result:
+      memory = result["memory"]
+      print("    memory: peak p50 %.1f KiB, max %.1f KiB, retained %d blocks / %.1f KiB" % (
+        memory["peak_kib_p50"], memory["peak_kib_max"],
+        memory["retained_blocks"], memory["retained_kib"]))
+
+  print()
+  print("services:", results["services"])
+  print("storage:", results["storage"])
+  if results["governor"] is not None:
+    print("governor:", results["governor"])
+  if results["cache"] is not None:
+    print("cache:", results["cache"])
+
+
+def compare(results, baseline, tolerance):
+  """
+  Prints the p50 / p90 change per handler against a baseline results
+  file. Returns True if no handler's p50 got worse by more than tolerance
+  percent.
+  """
+  ok = True
+
+  print()
+  print("compared with", baseline["meta"].get("commit") or "baseline")
+
+  for name, result in results["handlers"].items():
+    old = baseline["handlers"].get(name)
+    if old is None:
+      continue
+
+    changes = []
+    for key in ("p50_ms", "p90_ms"):
+      before = old["latency"][key]
+      after = result["latency"][key]
+      change = (after - before) / before * 100 if before > 0 else 0.0
+      changes.append("%s %.2f -> %.2f (%+.1f%%)" % (key, before, after, change))
+
+      if key == "p50_ms" and change > tolerance:
+        ok = False
+        changes[-1] += " REGRESSION"
+
+    print("  %-22s %s" % (name, "  ".join(changes)))
+
+  return ok
+
+
+def parse_args(argv):
+  parser = argparse.ArgumentParser(description="Benchmark the lambda handlers against local stand-ins")
+  parser.add_argument("--gallery", type=int, default=200, help="people to register")
+  parser.add_argument("--requests", type=int, default=500, help="requests per handler")
+  parser.add_argument("--repeat-rate", type=float, default=0.2, help="share of repeated frames")
+  parser.add_argument("--stranger-rate", type=float, default=0.1, help="share of unregistered faces")
+  parser.add_argument("--s3-ms", type=float, default=0.0, help="injected S3 latency per call")
+  parser.add_argument("--rekognition-ms", type=float, default=0.0, help="injected Rekognition latency per call")
+  parser.add_argument("--db-ms", type=float, default=0.0, help="injected database latency per call")
+  parser.add_argument("--jitter-ms", type=float, default=0.0, help="uniform random extra latency per call")
+  parser.add_argument("--throttle-rate", type=float, default=0.0, help="probability an AWS call is throttled")
+  parser.add_argument("--no-cache", action="store_true", help="disable the authentication result cache")
+  parser.add_argument("--no-governor", action="store_true", help="call Rekognition without the throughput governor")
+  parser.add_argument("--tps", type=float, default=0.0, help="governor's Rekognition calls per second (0 = no cap)")
+  parser.add_argument("--shards", type=int, default=0, help="hash-sharded collections (0 = one collection)")
+  parser.add_argument("--memory-samples", type=int, default=50, help="invocations per handler under tracemalloc (0 = skip)")
+  parser.add_argument("--seed", type=int, default=1)
+  parser.add_argument("--out", default="benchmark-results.json", help="JSON results file")
+  parser.add_argument("--compare", help="earlier results file to compare against")
+  parser.add_argument("--tolerance", type=float, default=10.0, help="allowed p50 regression, percent")
+  return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+  args = parse_args(sys.argv[1:])
+
+  results = benchmark(args)
+  print_results(results)
+
+  with open(args.out, "w") as outfile:
+    json.dump(results, outfile, indent=2)
+  print("results written to", args.out)
+
+  if args.compare:
+    with open(args.compare) as infile:
+      baseline = json.load(infile)
+    if not compare(results, baseline, args.tolerance):
+      sys.exit(1)
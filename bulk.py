@@ -0,0 +1,468 @@
+#
+# Bulk client commands for the facial recognition web service.
+#
+# bulk_register enrolls a whole directory (or a manifest CSV) of images
+# through a bounded pool of worker threads that share one keep-alive HTTP
+# session. Throttled requests are retried with exponential backoff (5xx
+# responses and dropped connections are not: the registration may have
+# gone through), and finished images are appended to a checkpoint file so
+# a crashed run can be restarted without registering anyone twice.
+#
+# batch_authenticate streams a directory (or a list of paths on stdin)
+# through a read/encode stage and a send stage running concurrently.
+# Byte-identical images that are already in flight share one request, and
+# each result is written as a JSON line as soon as it is known.
+#
+# Both send through a governor.Governor: an optional requests-per-second
+# cap, a limit on requests in flight that is halved when the service
+# throttles and recovers as requests succeed, and jittered retries.
+#
+import sys
+import csv
+import json
+import time
+import hashlib
+import pathlib
+import threading
+import requests
+
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor
+
+import uploads
+import latency
+import governor
+
+image_extensions = {".jpeg", ".jpg", ".png"}
+
+
+###################################################################
+#
+# shared helpers
+#
+def make_session(workers):
+  """
+  Returns a requests Session whose connection pool is large enough for
+  all worker threads to keep their connections alive
+  """
+  session = requests.Session()
+  adapter = HTTPAdapter(pool_connections=1, pool_maxsize=workers)
+  session.mount("https://", adapter)
+  session.mount("http://", adapter)
+  return session
+
+
+def is_throttled(res, transient=True):
+  return governor.is_retryable_response(res.status_code, res.text, transient)
+
+
+def make_governor(workers, tps=None, max_retries=5):
+  """
+  Governor for a bulk run: starts with every worker allowed in flight and
+  backs off from there when throttled
+  """
+  return governor.Governor(tps=tps, concurrency=workers, max_concurrency=workers,
+                           max_retries=max_retries, base_delay=0.5, max_delay=20.0)
+
+
+def governed_put(session, url, args, gov, transient=True):
+  """
+  PUTs to url through the governor. A throttled response (or a dropped
+  connection) counts as throttling: the governor backs off and retries.
+  With transient=False only throttling is retried: a 5xx or a dropped
+  connection may come after the request was carried out, so a request
+  that must not run twice (registration) fails instead.
+
+  Returns
+  -------
+  (response, number of retries); the last throttled response if the
+  governor gave up
+  """
+  attempts = 0
+
+  def put():
+    nonlocal attempts
+    attempts += 1
+    try:
+      res = session.put(url, timeout=60, **args)
+    except requests.exceptions.ConnectionError as err:
+      if not transient:
+        raise
+      raise governor.ThrottledResponse(None) from err
+    if is_throttled(res, transient):
+      raise governor.ThrottledResponse(res)
+    return res
+
+  try:
+    res = gov.call(put) if transient else gov.call_once(put)
+  except governor.ThrottledResponse as err:
+    if err.response is None:
+      raise err.__cause__
+    res = err.response
+
+  return res, attempts - 1
+
+
+###################################################################
+#
+# checkpoint
+#
+class Checkpoint:
+  """
+  Append-only record of finished items, one JSON object per line
+  """
+
+  def __init__(self, path):
+    self.path = pathlib.Path(path)
+    self.lock = threading.Lock()
+    self.done = set()
+
+    if self.path.is_file():
+      with open(self.path, "r") as infile:
+        for line in infile:
+          line = line.strip()
+          if not line:
+            continue
+          try:
+            self.done.add(json.loads(line)["image"])
+          except (ValueError, KeyError):
+            pass  # partially written last line after a crash
+
+    self.outfile = open(self.path, "a")
+
+  def record(self, image, **info):
+    with self.lock:
+      self.outfile.write(json.dumps(dict(image=image, **info)) + "\n")
+      self.outfile.flush()
+      self.done.add(image)
+
+  def close(self):
+    self.outfile.close()
+
+
+###################################################################
+#
+# bulk_register
+#
+def read_entries(source):
+  """
+  Yields (image path, firstname, lastname) from either a directory of
+  FIRSTNAME_LASTNAME.EXT images or a manifest CSV with the columns
+  image,firstname,lastname (an optional header row is skipped). As in
+  register_faces, a filename is split at its first "_".
+  """
+  path = pathlib.Path(source)
+
+  if path.is_dir():
+    for image in sorted(path.iterdir()):
+      if image.suffix.lower() not in image_extensions:
+        continue
+      firstname, _, lastname = image.stem.partition("_")
+      if not firstname or not lastname:
+        print("Skipping", image, "(expected FIRSTNAME_LASTNAME.EXT)")
+        continue
+      yield str(image), firstname, lastname
+    return
+
+  with open(path, newline="") as infile:
+    for row in csv.reader(infile):
+      if not row or row[0].strip().lower() == "image":
+        continue
+      if len(row) < 3:
+        print("Skipping manifest row", row, "(expected image,firstname,lastname)")
+        continue
+      image = pathlib.Path(row[0].strip())
+      if not image.is_absolute():
+        image = path.parent / image
+      yield str(image), row[1].strip(), row[2].strip()
+
+
+def register_one(session, url, entry, binary, preprocessor, gov):
+  image, firstname, lastname = entry
+
+  extension = pathlib.Path(image).suffix.lower().lstrip(".")
+  if extension == "jpg":
+    extension = "jpeg"
+
+  filename = uploads.registration_filename(firstname, lastname, extension)
+
+  with open(image, "rb") as infile:
+    bytes = infile.read()
+
+  if preprocessor is not None:
+    filename, bytes, report = preprocessor.process(filename, bytes)
+
+  start = time.perf_counter()
+  #
+  # registering is not idempotent, so only throttled requests are retried:
+  #
+  res, retries = governed_put(session, url, uploads.image_upload_args(filename, bytes, binary), gov,
+                              transient=False)
+  elapsed_ms = (time.perf_counter() - start) * 1000
+
+  return res, retries, elapsed_ms
+
+
+def bulk_register(baseurl, source, workers=4, checkpoint_file=None, binary=True, preprocessor=None,
+                  tps=None):
+  """
+  Registers every image in a directory or manifest CSV
+
+  Parameters
+  ----------
+  baseurl: baseurl for web service
+  source: directory of FIRSTNAME_LASTNAME.EXT images, or manifest CSV
+  workers: number of concurrent registrations
+  checkpoint_file: progress file; defaults to <source>.checkpoint
+  binary: send raw bytes (True) or base64 JSON (False)
+  preprocessor: optional preprocess.Preprocessor
+  tps: optional cap on requests per second
+
+  Returns
+  -------
+  summary dictionary (see latency.summarize) with ok/failed/skipped counts
+  and the governor's counters
+  """
+  url = baseurl + '/register_faces'
+
+  if checkpoint_file is None:
+    checkpoint_file = str(pathlib.Path(source)) + ".checkpoint"
+
+  checkpoint = Checkpoint(checkpoint_file)
+  session = make_session(workers)
+  gov = make_governor(workers, tps)
+
+  latencies = []
+  counts = {"ok": 0, "failed": 0, "skipped": 0, "retries": 0}
+  lock = threading.Lock()
+
+  #
+  # keep at most 2 x workers items in flight so a huge directory is not
+  # read into memory up front:
+  #
+  slots = threading.BoundedSemaphore(workers * 2)
+
+  def work(entry):
+    try:
+      res, retries, elapsed_ms = register_one(session, url, entry, binary, preprocessor, gov)
+
+      with lock:
+        counts["retries"] += retries
+        latencies.append(elapsed_ms)
+
+      if res.status_code == 200:
+        checkpoint.record(entry[0], firstname=entry[1], lastname=entry[2])
+        with lock:
+          counts["ok"] += 1
+      else:
+        print("Failed:", entry[0], res.status_code, res.text)
+        with lock:
+          counts["failed"] += 1
+
+    except Exception as e:
+      print("Failed:", entry[0], str(e))
+      with lock:
+        counts["failed"] += 1
+    finally:
+      slots.release()
+
+  start = time.perf_counter()
+
+  try:
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+      for entry in read_entries(source):
+        if entry[0] in checkpoint.done:
+          counts["skipped"] += 1
+          continue
+        slots.acquire()
+        pool.submit(work, entry)
+  finally:
+    checkpoint.close()
+    session.close()
+
+  summary = latency.summarize(latencies, time.perf_counter() - start)
+  summary.update(counts)
+  summary["governor"] = gov.stats()
+
+  latency.print_summary("bulk registration", summary)
+  print("  registered:", counts["ok"], " failed:", counts["failed"],
+        " skipped (checkpoint):", counts["skipped"], " retries:", counts["retries"])
+  print("  governor:", summary["governor"])
+
+  return summary
+
+
+###################################################################
+#
+# batch_authenticate
+#
+def read_paths(source):
+  """
+  Yields image paths from a directory, or one path per line from stdin
+  when source is "-"
+  """
+  if source == "-":
+    for line in sys.stdin:
+      line = line.strip()
+      if line:
+        yield line
+    return
+
+  for image in sorted(pathlib.Path(source).iterdir()):
+    if image.suffix.lower() in image_extensions:
+      yield str(image)
+
+
+def authenticate_result(path, res, elapsed_ms, deduplicated):
+  result = {
+    "image": path,
+    "status": res.status_code if res is not None else None,
+    "latency_ms": round(elapsed_ms, 1),
+    "deduplicated": deduplicated
+  }
+
+  if res is None:
+    return result
+
+  try:
+    body = res.json()
+  except ValueError:
+    body = res.text
+
+  if res.status_code == 200:
+    result["match"] = {"entryid": body[0], "firstname": body[1], "lastname": body[2]}
+  else:
+    result["match"] = None
+    result["message"] = body
+
+  return result
+
+
+def batch_authenticate(baseurl, source, workers=8, out=None, binary=True, preprocessor=None,
+                       tps=None):
+  """
+  Authenticates every image in a directory, or every path listed on stdin
+
+  Parameters
+  ----------
+  baseurl: baseurl for web service
+  source: directory of images, or "-" to read paths from stdin
+  workers: number of concurrent requests (reading / encoding uses as many
+           threads again, so it can stay ahead of the senders)
+  out: writable text stream for the JSON-lines results (default stdout)
+  binary: send raw bytes (True) or base64 JSON (False)
+  preprocessor: optional preprocess.Preprocessor
+  tps: optional cap on requests per second
+
+  Returns
+  -------
+  summary dictionary (see latency.summarize) with the governor's counters
+  """
+  url = baseurl + '/authenticate_faces'
+
+  if out is None:
+    out = sys.stdout
+
+  session = make_session(workers)
+  gov = make_governor(workers, tps)
+
+  lock = threading.Lock()
+  out_lock = threading.Lock()
+  latencies = []
+  counts = {"matched": 0, "unmatched": 0, "failed": 0, "deduplicated": 0, "retries": 0}
+
+  # content hash -> paths waiting on the request that is in flight:
+  inflight = {}
+
+  # bound the images held in memory between the two stages:
+  slots = threading.BoundedSemaphore(workers * 4)
+
+  def emit(result):
+    with lock:
+      if result["status"] == 200:
+        counts["matched"] += 1
+      elif result["status"] == 403:
+        counts["unmatched"] += 1
+      else:
+        counts["failed"] += 1
+      if result["deduplicated"]:
+        counts["deduplicated"] += 1
+    with out_lock:
+      out.write(json.dumps(result) + "\n")
+      out.flush()
+
+  def send(digest, filename, bytes):
+    res = None
+    start = time.perf_counter()
+    try:
+      res, retries = governed_put(session, url, uploads.image_upload_args(filename, bytes, binary), gov)
+      with lock:
+        counts["retries"] += retries
+    except Exception as e:
+      print("Failed:", filename, str(e), file=sys.stderr)
+    elapsed_ms = (time.perf_counter() - start) * 1000
+
+    with lock:
+      latencies.append(elapsed_ms)
+      waiters = inflight.pop(digest)
+
+    for i, path in enumerate(waiters):
+      emit(authenticate_result(path, res, elapsed_ms, i > 0))
+      slots.release()
+
+  def prepare(path):
+    digest = None  # set once this path's request owns the inflight entry
+
+    try:
+      with open(path, "rb") as infile:
+        bytes = infile.read()
+
+      with lock:
+        key = hashlib.sha256(bytes).hexdigest()
+        if key in inflight:
+          inflight[key].append(path)  # identical image already on its way
+          return
+        inflight[key] = [path]
+        digest = key
+
+      filename = pathlib.Path(path).name
+      if preprocessor is not None:
+        filename, bytes, report = preprocessor.process(filename, bytes)
+
+      send_pool.submit(send, digest, filename, bytes)
+
+    except Exception as e:
+      #
+      # identical images may have joined this one while it was being
+      # preprocessed; they fail with it:
+      #
+      waiters = [path]
+      if digest is not None:
+        with lock:
+          waiters = inflight.pop(digest)
+
+      for i, waiter in enumerate(waiters):
+        emit({"image": waiter, "status": None, "latency_ms": 0.0,
+              "deduplicated": i > 0, "match": None, "message": str(e)})
+        slots.release()
+
+  start = time.perf_counter()
+
+  try:
+    with ThreadPoolExecutor(max_workers=workers) as send_pool:
+      with ThreadPoolExecutor(max_workers=workers) as read_pool:
+        for path in read_paths(source):
+          slots.acquire()
+          read_pool.submit(prepare, path)
+  finally:
+    session.close()
+
+  summary = latency.summarize(latencies, time.perf_counter() - start)
+  summary.update(counts)
+  summary["governor"] = gov.stats()
+
+  with out_lock:
+    out.write(json.dumps({"summary": summary}) + "\n")
+    out.flush()
+
+  return summary
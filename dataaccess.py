@@ -0,0 +1,488 @@
+#
+# Data-access layer for the faces database.
+#
+# Replaces the one-statement-at-a-time datatier calls with a Database
+# object that
+#
+#   - reuses one connection per thread, pinging it before reuse when it has
+#     been idle for a while and reconnecting if it is dead
+#   - keeps datatier's retrieve_one_row / retrieve_all_rows / perform_action
+#     so existing SQL moves over unchanged
+#   - adds multi-row inserts (insert_many), chunked IN-list fetches
+#     (retrieve_in) and streaming scans over a server-side cursor (iter_rows)
+#   - runs against MySQL (RDS, via pymysql) or SQLite for local runs and
+#     tests; SQL is always written with %s placeholders
+#
+# Versioned schema migrations live at the bottom of this file:
+#
+#   python dataaccess.py migrate [config file]
+#
+import time
+import uuid
+import sqlite3
+import threading
+import requestlog
+
+from contextlib import contextmanager
+
+#
+# seconds a connection may sit idle before it is pinged on reuse:
+#
+ping_interval = 30
+
+#
+# most values per IN list / multi-row insert statement:
+#
+default_chunk_size = 500
+
+
+class Database:
+
+  def __init__(self, engine, connect):
+    """
+    Parameters
+    ----------
+    engine: 'mysql' or 'sqlite'
+    connect: function taking no arguments that opens a new DB-API
+             connection in autocommit mode
+    """
+    if engine not in ("mysql", "sqlite"):
+      raise Exception("unknown database engine '" + engine + "'")
+
+    self.engine = engine
+    self.connect = connect
+    self.local = threading.local()
+    self.connections = []
+    self.lock = threading.Lock()
+
+  #
+  # connections
+  #
+  def connection(self):
+    """
+    Returns this thread's connection, opening or reviving it as needed
+    """
+    conn = getattr(self.local, "conn", None)
+    now = time.monotonic()
+
+    if conn is not None and now - self.local.last_used > ping_interval:
+      try:
+        self.ping(conn)
+      except Exception as err:
+        requestlog.warning("cached connection is dead, reconnecting", error=str(err))
+        self.discard(conn)
+        conn = None
+
+    if conn is None:
+      requestlog.info("opening database connection", engine=self.engine)
+      conn = self.connect()
+      self.local.conn = conn
+      with self.lock:
+        self.connections.append(conn)
+
+    self.local.last_used = now
+    return conn
+
+  def ping(self, conn):
+    if self.engine == "mysql":
+      conn.ping(reconnect=True)
+    else:
+      conn.execute("SELECT 1;")
+
+  def discard(self, conn):
+    try:
+      conn.close()
+    except Exception:
+      pass
+    with self.lock:
+      if conn in self.connections:
+        self.connections.remove(conn)
+    self.local.conn = None
+
+  def close(self):
+    with self.lock:
+      connections, self.connections = self.connections, []
+    for conn in connections:
+      try:
+        conn.close()
+      except Exception:
+        pass
+    self.local = threading.local()
+
+  def sql(self, sql):
+    """
+    Converts %s placeholders to the engine's parameter style
+    """
+    if self.engine == "sqlite":
+      return sql.replace("%s", "?")
+    return sql
+
+  @contextmanager
+  def cursor(self, conn=None):
+    #
+    # every statement runs through here, so this is the "db" span:
+    #
+    with requestlog.span("db"):
+      conn = conn or self.connection()
+      cur = conn.cursor()
+      try:
+        yield cur
+      finally:
+        cur.close()
+
+  @contextmanager
+  def transaction(self):
+    """
+    Runs the enclosed statements as one transaction on this thread's
+    connection (connections are otherwise in autocommit mode)
+    """
+    conn = self.connection()
+    if self.engine == "mysql":
+      conn.begin()
+    else:
+      conn.execute("BEGIN;")
+    try:
+      yield conn
+      conn.commit()
+    except Exception:
+      conn.rollback()
+      raise
+
+  #
+  # datatier-compatible calls
+  #
+  def retrieve_one_row(self, sql, parameters=[]):
+    """
+    Returns the first row, or () if there are none
+    """
+    with self.cursor() as cur:
+      cur.execute(self.sql(sql), parameters)
+      row = cur.fetchone()
+    return row if row is not None else ()
+
+  def retrieve_all_rows(self, sql, parameters=[]):
+    """
+    Returns a list of rows (possibly empty)
+    """
+    with self.cursor() as cur:
+      cur.execute(self.sql(sql), parameters)
+      rows = cur.fetchall()
+    return list(rows) if rows is not None else []
+
+  def perform_action(self, sql, parameters=[]):
+    """
+    Runs an INSERT / UPDATE / DELETE / DDL statement and returns the
+    number of rows modified
+    """
+    with self.cursor() as cur:
+      cur.execute(self.sql(sql), parameters)
+      return cur.rowcount
+
+  #
+  # bulk calls
+  #
+  def insert_many(self, table, columns, rows, chunk_size=default_chunk_size):
+    """
+    Inserts rows (sequences of values in column order) with multi-row
+    INSERT statements, all in one transaction
+
+    Returns
+    -------
+    number of rows inserted
+    """
+    rows = list(rows)
+    if not rows:
+      return 0
+
+    row_placeholder = "(" + ", ".join(["%s"] * len(columns)) + ")"
+    inserted = 0
+
+    with self.transaction() as conn:
+      with self.cursor(conn) as cur:
+        for start in range(0, len(rows), chunk_size):
+          chunk = rows[start:start + chunk_size]
+          sql = "INSERT INTO " + table + "(" + ", ".join(columns) + ") VALUES " + \
+            ", ".join([row_placeholder] * len(chunk)) + ";"
+          cur.execute(self.sql(sql), [value for row in chunk for value in row])
+          inserted += cur.rowcount
+
+    return inserted
+
+  def retrieve_in(self, sql, values, parameters=[], chunk_size=default_chunk_size):
+    """
+    Runs sql once per chunk of values, with the {in} marker in sql replaced
+    by that chunk's placeholders, e.g.
+
+      db.retrieve_in("SELECT * FROM faces WHERE entryid IN ({in});", ids)
+
+    parameters (if any) are passed before the IN-list values.
+
+    Returns
+    -------
+    list of rows from all chunks
+    """
+    values = list(values)
+    rows = []
+
+    for start in range(0, len(values), chunk_size):
+      chunk = values[start:start + chunk_size]
+      chunk_sql = sql.replace("{in}", ", ".join(["%s"] * len(chunk)))
+      rows.extend(self.retrieve_all_rows(chunk_sql, list(parameters) + chunk))
+
+    return rows
+
+  def iter_rows(self, sql, parameters=[], batch_size=1000):
+    """
+    Streams the rows of a large query without loading them all into
+    memory. MySQL uses a server-side (unbuffered) cursor on a dedicated
+    connection, since the connection cannot be used for anything else
+    until the scan is finished.
+    """
+    conn = self.connect()
+    try:
+      if self.engine == "mysql":
+        import pymysql.cursors
+        cur = conn.cursor(pymysql.cursors.SSCursor)
+      else:
+        cur = conn.cursor()
+
+      try:
+        cur.execute(self.sql(sql), parameters)
+        while True:
+          rows = cur.fetchmany(batch_size)
+          if not rows:
+            break
+          for row in rows:
+            yield row
+      finally:
+        cur.close()
+    finally:
+      conn.close()
+
+  #
+  # schema inspection
+  #
+  def has_column(self, table, column):
+    if self.engine == "sqlite":
+      rows = self.retrieve_all_rows("PRAGMA table_info(" + table + ");")
+      return any(row[1] == column for row in rows)
+
+    row = self.retrieve_one_row("""
+      SELECT COUNT(*) FROM information_schema.columns
+      WHERE table_schema = DATABASE() AND table_name = %s AND column_name = %s;
+      """, [table, column])
+    return row[0] > 0
+
+  def has_index(self, table, index):
+    if self.engine == "sqlite":
+      rows = self.retrieve_all_rows("PRAGMA index_list(" + table + ");")
+      return any(row[1] == index for row in rows)
+
+    row = self.retrieve_one_row("""
+      SELECT COUNT(*) FROM information_schema.statistics
+      WHERE table_schema = DATABASE() AND table_name = %s AND index_name = %s;
+      """, [table, index])
+    return row[0] > 0
+
+
+###################################################################
+#
+# construction
+#
+def mysql_connector(endpoint, portnum, username, pwd, dbname):
+  def connect():
+    import pymysql
+    return pymysql.connect(host=endpoint, port=portnum, user=username,
+                           passwd=pwd, database=dbname, autocommit=True)
+  return connect
+
+
+def sqlite_connector(path):
+  #
+  # ":memory:" would give every thread its own empty database, so use a
+  # named shared-cache in-memory database instead (a fresh name each time,
+  # so every Database gets its own):
+  #
+  if path == ":memory:":
+    path = "file:faces-" + uuid.uuid4().hex + "?mode=memory&cache=shared"
+
+  def connect():
+    conn = sqlite3.connect(path, uri=path.startswith("file:"), isolation_level=None)
+    return conn
+
+  return connect
+
+
+def from_config(configur):
+  """
+  Builds a Database from the [rds] section of the config. Set
+  engine = sqlite (and optionally sqlite_path) to run locally.
+  """
+  engine = configur.get('rds', 'engine', fallback='mysql')
+
+  if engine == 'sqlite':
+    db = Database('sqlite', sqlite_connector(configur.get('rds', 'sqlite_path', fallback=':memory:')))
+    db.keeper = db.connection()  # keeps a shared in-memory database alive
+    return db
+
+  return Database('mysql', mysql_connector(
+    configur.get('rds', 'endpoint'),
+    int(configur.get('rds', 'port_number')),
+    configur.get('rds', 'user_name'),
+    configur.get('rds', 'user_pwd'),
+    configur.get('rds', 'db_name')))
+
+
+###################################################################
+#
+# migrations
+#
+def m001_faces_table(db):
+  if db.engine == "sqlite":
+    db.perform_action("""
+      CREATE TABLE IF NOT EXISTS faces (
+        entryid       INTEGER PRIMARY KEY AUTOINCREMENT,
+        firstname     VARCHAR(64) NOT NULL,
+        lastname      VARCHAR(64) NOT NULL,
+        rekognitionid VARCHAR(64) NOT NULL,
+        bucketkey     VARCHAR(256)
+      );
+      """)
+  else:
+    db.perform_action("""
+      CREATE TABLE IF NOT EXISTS faces (
+        entryid       INT NOT NULL AUTO_INCREMENT,
+        firstname     VARCHAR(64) NOT NULL,
+        lastname      VARCHAR(64) NOT NULL,
+        rekognitionid VARCHAR(64) NOT NULL,
+        bucketkey     VARCHAR(256),
+        PRIMARY KEY (entryid)
+      );
+      """)
+
+
+def m002_faces_attributes(db):
+  if not db.has_column("faces", "attributes"):
+    column_type = "TEXT" if db.engine == "sqlite" else "JSON"
+    db.perform_action("ALTER TABLE faces ADD COLUMN attributes " + column_type + " NULL;")
+
+
+def m003_rekognitionid_index(db):
+  #
+  # authenticate_faces looks rows up by rekognitionid (entryid lookups use
+  # the primary key):
+  #
+  if not db.has_index("faces", "faces_rekognitionid"):
+    db.perform_action("CREATE INDEX faces_rekognitionid ON faces(rekognitionid);")
+
+
+def m004_faces_imagehash(db):
+  #
+  # SHA-256 of the registered image, which is also its S3 key (see
+  # objectstore); NULL for rows registered under the old filename keys:
+  #
+  if not db.has_column("faces", "imagehash"):
+    db.perform_action("ALTER TABLE faces ADD COLUMN imagehash CHAR(64) NULL;")
+  if not db.has_index("faces", "faces_imagehash"):
+    db.perform_action("CREATE INDEX faces_imagehash ON faces(imagehash);")
+
+
+def m005_shards(db):
+  #
+  # the shard key a face was registered with and the collection it is in
+  # (NULL: the unsharded collection), plus the shard map of keys that have
+  # their own collection (see shards):
+  #
+  if not db.has_column("faces", "shardkey"):
+    db.perform_action("ALTER TABLE faces ADD COLUMN shardkey VARCHAR(64) NULL;")
+  if not db.has_column("faces", "collectionid"):
+    db.perform_action("ALTER TABLE faces ADD COLUMN collectionid VARCHAR(128) NULL;")
+  if not db.has_index("faces", "faces_collection"):
+    db.perform_action("CREATE INDEX faces_collection ON faces(collectionid, rekognitionid);")
+
+  db.perform_action("""
+    CREATE TABLE IF NOT EXISTS shards (
+      shardkey     VARCHAR(64) NOT NULL PRIMARY KEY,
+      collectionid VARCHAR(128) NOT NULL
+    );
+    """)
+
+
+def m006_face_changes(db):
+  #
+  # a counter bumped by every tool that updates or deletes faces rows
+  # (shards.py rebalance, reconcile.py --delete-dangling); with MAX(entryid)
+  # it is the result cache's generation (see resultcache):
+  #
+  db.perform_action("""
+    CREATE TABLE IF NOT EXISTS face_changes (
+      id      INTEGER NOT NULL PRIMARY KEY,
+      changes BIGINT NOT NULL
+    );
+    """)
+  if not db.retrieve_one_row("SELECT id FROM face_changes WHERE id = 1;"):
+    db.perform_action("INSERT INTO face_changes(id, changes) VALUES(1, 0);")
+
+
+migrations = [
+  (1, "faces table", m001_faces_table),
+  (2, "faces.attributes column", m002_faces_attributes),
+  (3, "index on faces.rekognitionid", m003_rekognitionid_index),
+  (4, "faces.imagehash column", m004_faces_imagehash),
+  (5, "shard columns and shard map", m005_shards),
+  (6, "face_changes counter", m006_face_changes),
+]
+
+
+def schema_version(db):
+  db.perform_action("""
+    CREATE TABLE IF NOT EXISTS schema_version (
+      version     INTEGER NOT NULL PRIMARY KEY,
+      description VARCHAR(256) NOT NULL,
+      applied_at  VARCHAR(32) NOT NULL
+    );
+    """)
+  row = db.retrieve_one_row("SELECT MAX(version) FROM schema_version;")
+  return row[0] or 0
+
+
+def migrate(db):
+  """
+  Applies every migration newer than the recorded schema version, in
+  order. Each migration checks before it changes anything, so running
+  this against a database that was set up by hand is safe.
+
+  Returns
+  -------
+  the schema version after migrating
+  """
+  current = schema_version(db)
+
+  for version, description, apply in migrations:
+    if version <= current:
+      continue
+
+    requestlog.info("applying migration", version=version, description=description)
+    apply(db)
+
+    db.perform_action(
+      "INSERT INTO schema_version(version, description, applied_at) VALUES(%s, %s, %s);",
+      [version, description, time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime())])
+    current = version
+
+  return current
+
+
+if __name__ == "__main__":
+  import sys
+  from configparser import ConfigParser
+
+  if len(sys.argv) < 2 or sys.argv[1] != "migrate":
+    print("usage: python dataaccess.py migrate [config file]")
+    sys.exit(1)
+
+  configur = ConfigParser()
+  configur.read(sys.argv[2] if len(sys.argv) > 2 else 'config.ini')
+
+  requestlog.configure()
+  print("schema version:", migrate(from_config(configur)))
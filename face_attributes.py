@@ -1,89 +1,134 @@
 import json
-import boto3
-import os
-import uuid
-import base64
-import pathlib
-import datatier
-
-from configparser import ConfigParser
-
+import governor
+import lambda_init
+import requestlog
+import attributestore
+
+#
+# most entry IDs accepted in one bulk request:
+#
+max_bulk_entries = 1000
+
+#
+# bulk_attributes
+#
+# Serves {"entryids": [...]}: one IN query for all rows, stored attributes
+# where we have them, and detect_faces for the rest fanned out on the
+# shared (bounded) thread pool. Results are keyed by entry ID; each item
+# is either the attributes or {"error": message}.
+#
+def bulk_attributes(entryids, rekognition, bucketname, db):
+  if not isinstance(entryids, list) or not entryids:
+    raise Exception("entryids must be a non-empty list")
+  if len(entryids) > max_bulk_entries:
+    raise Exception("at most " + str(max_bulk_entries) + " entryids per request")
+
+  ids = []
+  for entryid in entryids:
+    try:
+      ids.append(int(entryid))
+    except (TypeError, ValueError):
+      raise Exception("invalid entryid: " + str(entryid))
+  ids = list(dict.fromkeys(ids))  # drop duplicates, keep order
+
+
+  sql = """
+      SELECT """ + attributestore.columns + """, attributes FROM faces
+      WHERE entryid IN ({in})
+  """
+
+  rows = db.retrieve_in(sql, ids)
+  found = {row[0]: row for row in rows}
+
+  results = {}
+  pending = {}
+
+  for entryid in ids:
+    row = found.get(entryid)
+
+    if row is None:
+      results[str(entryid)] = {"error": "Entry does not exist!"}
+      continue
+
+    attributes = attributestore.decode(row[5])
+    if attributes is None:
+      pending[entryid] = lambda_init.get_executor().submit(
+        attributestore.detect, rekognition, bucketname, row[4])
+      continue
+
+    results[str(entryid)] = dict(attributes, Name=row[1] + " " + row[2])
+
+  requestlog.info("bulk attributes", entries=len(ids), stored=len(results), detecting=len(pending))
+
+  for entryid, future in pending.items():
+    row = found[entryid]
+    try:
+      attributes = future.result()
+      attributestore.store(db, entryid, attributes)
+      results[str(entryid)] = dict(attributes, Name=row[1] + " " + row[2])
+    except Exception as err:
+      results[str(entryid)] = {"error": str(err)}
+
+  return {
+    "statusCode": 200,
+    "body": json.dumps(results)
+  }
+
+
+@requestlog.handler("face_attributes")
 def lambda_handler(event, context):
   try: 
-    print("**STARTING REGISTRATION**")
-    print("PRINTING EVENT:\n", event)
-
-    config_file = 'config.ini'
-    os.environ['AWS_SHARED_CREDENTIALS_FILE'] = config_file
-
-    configur = ConfigParser()
-    configur.read(config_file)
-
-    s3_profile = 's3readwrite+rekognition'
-    boto3.setup_default_session(profile_name=s3_profile)
-
-    bucketname = configur.get('s3', 'bucket_name')
-
-    s3 = boto3.resource('s3')
-    bucket = s3.Bucket(bucketname)
+    #
+    # config, clients and db connection are cached across warm invocations:
+    #
+    bucket, rekognition, db = lambda_init.timed_setup(
+      "face_attributes",
+      lambda_init.get_bucket,
+      lambda_init.get_rekognition,
+      lambda_init.get_db)
 
-    print("**Accessing request body**")
+    bucketname = bucket.name
 
     if "body" not in event:
       raise Exception("event has no body")
 
-    body = json.loads(event["body"]) # parse the json
+    with requestlog.span("parse"):
+      body = json.loads(event["body"]) # parse the json
+
+    if "entryids" in body:
+      return bulk_attributes(body["entryids"], rekognition, bucketname, db)
 
     if "entryid" not in body:
       raise Exception("event has a body but no entryid")
 
     entryid = body["entryid"]
 
-    print("entryid: ", entryid)
-
-    #
-    # configure for RDS access
-    #
-    rds_endpoint = configur.get('rds', 'endpoint')
-    rds_portnum = int(configur.get('rds', 'port_number'))
-    rds_username = configur.get('rds', 'user_name')
-    rds_pwd = configur.get('rds', 'user_pwd')
-    rds_dbname = configur.get('rds', 'db_name')
-
-    print("**Opening connection**")
-
-    dbConn = datatier.get_dbConn(rds_endpoint, rds_portnum, rds_username, rds_pwd, rds_dbname)
+    requestlog.info("attributes", entryid=entryid)
 
     sql = """
-        SELECT * FROM faces WHERE entryid = %s
+        SELECT """ + attributestore.columns + """, attributes FROM faces WHERE entryid = %s
     """
 
-    desired_face = datatier.retrieve_one_row(dbConn, sql, [entryid])
+    desired_face = db.retrieve_one_row(sql, [entryid])
 
     if desired_face:
-        s3 = boto3.client('s3')
-        image_bytes = s3.get_object(Bucket=bucketname, Key=desired_face[4])['Body'].read()
-        rekognition = boto3.client('rekognition', region_name='us-east-2')
-
-        response = rekognition.detect_faces(
-            Image= { 
-                'S3Object':
-                {
-                  'Bucket': bucketname,
-                  'Name': desired_face[4]
-                }
-            },
-                Attributes=["ALL"]
-        )
-
-        print(response)
+        attributes = attributestore.decode(desired_face[5])
+
+        #
+        # rows registered before attributes were stored: detect once and
+        # save them, so the next request for this entry is a plain read
+        #
+        if attributes is None:
+            requestlog.info("no stored attributes, calling detect_faces", entryid=entryid)
+            attributes = attributestore.detect(rekognition, bucketname, desired_face[4])
+            attributestore.store(db, entryid, attributes)
 
         return {
             "statusCode": 200, 
             "body": json.dumps({
-              "Gender": response["FaceDetails"][0]["Gender"],
-              "AgeRange": response["FaceDetails"][0]["AgeRange"],
-              "Emotions": response["FaceDetails"][0]["Emotions"], 
+              "Gender": attributes["Gender"],
+              "AgeRange": attributes["AgeRange"],
+              "Emotions": attributes["Emotions"], 
               "Name": desired_face[1] + " " + desired_face[2]
               })
         }
@@ -95,9 +140,8 @@ def lambda_handler(event, context):
           }
 
   except Exception as err:
-    print("**ERROR**")
-    print(str(err))
+    requestlog.error("face_attributes failed", error=str(err))
     return {
-      "statusCode": 400,
+      "statusCode": governor.error_status(err),
       "body": json.dumps(str(err))
     }
\ No newline at end of file
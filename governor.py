@@ -0,0 +1,428 @@
+#
+# Throughput governor for rate-limited service calls.
+#
+# Rekognition throttles with ProvisionedThroughputExceededException when
+# calls exceed the account's TPS quota. Instead of failing the request,
+# every call goes through a Governor that
+#
+#   - takes a token from a token bucket refilled at the configured TPS (with
+#     a burst allowance), so a burst queues instead of hitting the quota
+#   - limits the calls in flight with an adaptive (AIMD) limit: halved on a
+#     throttle, at most once per cooldown, and raised again by about one
+#     per limit's worth of successful calls
+#   - retries throttled calls with exponential backoff and full jitter
+#
+# Transient service failures (5xx, ServiceUnavailable, dropped connections)
+# are retried the same way, since botocore's own retries are off for the
+# governed clients, but they do not lower the concurrency limit: they are
+# not a sign of too many calls. A call that must not run twice (IndexFaces:
+# a repeat indexes the face again, leaving an orphan in the collection)
+# goes through call_once, which retries only failures where the request
+# never reached the service (no connection could be made).
+#
+# It counts calls, queued calls, throttles, transient failures, retries
+# and calls that gave up.
+#
+# GovernedClient wraps a boto3 client so every API call goes through the
+# governor. The same Governor also governs the bulk client's HTTP requests
+# (see bulk.py), with a throttled response turned into ThrottledResponse.
+#
+import time
+import random
+import threading
+
+throttle_codes = {
+  "ProvisionedThroughputExceededException",
+  "ThrottlingException",
+  "Throttling",
+  "TooManyRequestsException",
+  "RequestLimitExceeded",
+  "SlowDown"
+}
+
+#
+# for HTTP clients of the lambdas: statuses worth retrying, plus lambda
+# error messages (sent with a 400) that mean throttling. The 5xx statuses
+# may come back after the lambda did its work (API Gateway times out at
+# 29 s), so they are only retried for requests that are safe to repeat.
+#
+retry_statuses = {429, 500, 502, 503, 504}
+transient_statuses = {500, 502, 503, 504}
+throttle_markers = ("Throttl", "ProvisionedThroughputExceeded", "Rate exceeded", "TooManyRequests")
+
+
+#
+# error codes and botocore exception classes of failures that are worth
+# retrying but are not throttling. Classes are matched by name within
+# botocore only: requests (bulk.py) and the builtins have exceptions
+# called ConnectionError too, which the caller handles itself.
+#
+transient_codes = {
+  "InternalServerError",
+  "InternalServerException",
+  "InternalFailure",
+  "ServiceUnavailable",
+  "ServiceUnavailableException",
+  "ServiceFailure"
+}
+
+transient_errors = {
+  "ConnectionClosedError",
+  "ReadTimeoutError"
+}
+
+#
+# failures before the request was sent (EndpointConnectionError and
+# ConnectTimeoutError are botocore ConnectionErrors), safe to retry for
+# any call:
+#
+unsent_errors = {
+  "ConnectionError"
+}
+
+
+class Throttled(Exception):
+  """
+  Raised when a call is still throttled after all retries
+  """
+  pass
+
+
+def is_throttle(err):
+  """
+  True for a botocore ClientError carrying a throttling error code (or a
+  Throttled / ThrottledResponse from this module)
+  """
+  if isinstance(err, (Throttled, ThrottledResponse)):
+    return True
+  response = getattr(err, "response", None)
+  if not isinstance(response, dict):
+    return False
+  return response.get("Error", {}).get("Code") in throttle_codes
+
+
+def is_retryable_response(status, text, transient=True):
+  """
+  True for an HTTP response from the lambdas that should be retried;
+  with transient=False (requests that must not run twice, e.g.
+  registration) only for throttling
+  """
+  if status in transient_statuses:
+    return transient
+  if status in retry_statuses:
+    return True
+  return status == 400 and any(marker in text for marker in throttle_markers)
+
+
+def botocore_classes(err):
+  return {cls.__name__ for cls in type(err).__mro__ if cls.__module__.startswith("botocore")}
+
+
+def is_transient(err, sent=True):
+  """
+  True for a failure that is worth retrying but is not throttling: a 5xx
+  ClientError, ServiceUnavailable and the like, or a dropped connection.
+  With sent=False (a call that must not run twice) only for a failure
+  before the request was sent: a 5xx or a read timeout may come after
+  the service carried it out.
+  """
+  if is_throttle(err):
+    return False
+
+  classes = botocore_classes(err)
+  if classes & unsent_errors:
+    return True
+  if not sent:
+    return False
+  if classes & transient_errors:
+    return True
+
+  response = getattr(err, "response", None)
+  if not isinstance(response, dict):
+    return False
+
+  status = response.get("ResponseMetadata", {}).get("HTTPStatusCode")
+  return response.get("Error", {}).get("Code") in transient_codes or \
+    (isinstance(status, int) and status >= 500)
+
+
+def error_status(err):
+  """
+  HTTP status for a lambda error response: 429 when the request failed
+  because of throttling (clients retry those), 503 when the service kept
+  failing transiently, else 400
+  """
+  if is_throttle(err):
+    return 429
+  return 503 if is_transient(err) else 400
+
+
+class ThrottledResponse(Exception):
+  """
+  Lets a caller report a throttled HTTP response (which is not an
+  exception) to the governor; .response is the response itself
+  """
+
+  def __init__(self, response):
+    super().__init__("throttled")
+    self.response = response
+
+
+###################################################################
+#
+# token bucket
+#
+class TokenBucket:
+
+  def __init__(self, rate, burst=None):
+    self.rate = float(rate)                      # tokens per second
+    self.capacity = float(burst or max(1.0, rate))
+    self.tokens = self.capacity
+    self.updated = time.monotonic()
+    self.lock = threading.Lock()
+
+  def acquire(self):
+    """
+    Takes one token, sleeping until one is available
+
+    Returns
+    -------
+    seconds spent waiting
+    """
+    waited = 0.0
+
+    while True:
+      with self.lock:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+        if self.tokens >= 1.0:
+          self.tokens -= 1.0
+          return waited
+
+        delay = (1.0 - self.tokens) / self.rate
+
+      time.sleep(delay)
+      waited += delay
+
+
+###################################################################
+#
+# adaptive concurrency
+#
+class AdaptiveLimit:
+
+  def __init__(self, initial=8, minimum=1, maximum=64, cooldown=1.0):
+    self.limit = float(initial)
+    self.minimum = minimum
+    self.maximum = maximum
+    self.cooldown = cooldown  # seconds between two decreases
+    self.in_flight = 0
+    self.last_decrease = 0.0
+    self.condition = threading.Condition()
+
+  def acquire(self):
+    """
+    Waits for a free slot; returns seconds spent waiting
+    """
+    start = time.monotonic()
+    with self.condition:
+      while self.in_flight >= int(self.limit):
+        self.condition.wait()
+      self.in_flight += 1
+    return time.monotonic() - start
+
+  def release(self, throttled):
+    with self.condition:
+      self.in_flight -= 1
+
+      if throttled:
+        now = time.monotonic()
+        #
+        # the calls in flight when the quota ran out all come back
+        # throttled; count that as one signal, not one per call:
+        #
+        if now - self.last_decrease >= self.cooldown:
+          self.limit = max(self.minimum, self.limit / 2)
+          self.last_decrease = now
+      else:
+        self.limit = min(self.maximum, self.limit + 1.0 / self.limit)
+
+      self.condition.notify_all()
+
+
+###################################################################
+#
+# governor
+#
+class Governor:
+
+  def __init__(self, tps=None, burst=None, concurrency=8, min_concurrency=1, max_concurrency=64,
+               max_retries=6, base_delay=0.1, max_delay=5.0):
+    """
+    Parameters
+    ----------
+    tps: calls per second allowed (None or 0 => no token bucket)
+    burst: calls that may start at once after an idle period (default tps)
+    concurrency: initial limit on calls in flight, adapted between
+                 min_concurrency and max_concurrency
+    max_retries: retries of a throttled call before giving up
+    base_delay, max_delay: backoff bounds, seconds
+    """
+    self.bucket = TokenBucket(tps, burst) if tps else None
+    self.limiter = AdaptiveLimit(concurrency, min_concurrency, max_concurrency)
+    self.max_retries = max_retries
+    self.base_delay = base_delay
+    self.max_delay = max_delay
+
+    self.lock = threading.Lock()
+    self.calls = 0
+    self.queued = 0
+    self.queue_ms = 0.0
+    self.throttled = 0
+    self.transient = 0
+    self.retried = 0
+    self.failed = 0
+
+  def count(self, **increments):
+    with self.lock:
+      for name, value in increments.items():
+        setattr(self, name, getattr(self, name) + value)
+
+  def wait_turn(self):
+    waited = self.bucket.acquire() if self.bucket is not None else 0.0
+    waited += self.limiter.acquire()
+
+    if waited > 0.001:
+      self.count(queued=1, queue_ms=waited * 1000)
+
+  def call(self, function, *args, **kwargs):
+    """
+    Calls function(*args, **kwargs) under the governor, retrying while it
+    is throttled or fails transiently
+
+    Returns
+    -------
+    whatever function returns; raises Throttled when still throttled after
+    max_retries retries (transient and other errors are raised unchanged)
+    """
+    return self.attempt(function, args, kwargs, True)
+
+  def call_once(self, function, *args, **kwargs):
+    """
+    Like call, for a call that must not run twice: throttling (which means
+    the call was refused) is retried, other transient failures only when
+    the request was never sent
+    """
+    return self.attempt(function, args, kwargs, False)
+
+  def attempt(self, function, args, kwargs, repeatable):
+    self.count(calls=1)
+    attempt = 0
+
+    while True:
+      self.wait_turn()
+
+      try:
+        result = function(*args, **kwargs)
+      except Exception as err:
+        throttled = is_throttle(err)
+        transient = not throttled and is_transient(err, sent=repeatable)
+        self.limiter.release(throttled)
+
+        if throttled:
+          self.count(throttled=1)
+        elif transient:
+          self.count(transient=1)
+        else:
+          raise
+
+        if attempt >= self.max_retries:
+          self.count(failed=1)
+          if transient or isinstance(err, ThrottledResponse):
+            raise
+          raise Throttled(str(err)) from err
+
+        delay = min(self.max_delay, self.base_delay * (2 ** attempt))
+        time.sleep(random.uniform(0, delay))
+        attempt += 1
+        self.count(retried=1)
+        continue
+
+      self.limiter.release(False)
+      return result
+
+  def stats(self):
+    with self.lock:
+      stats = {
+        "calls": self.calls,
+        "queued": self.queued,
+        "queue_ms": round(self.queue_ms, 1),
+        "throttled": self.throttled,
+        "transient": self.transient,
+        "retried": self.retried,
+        "failed": self.failed
+      }
+    stats["concurrency_limit"] = round(self.limiter.limit, 2)
+    stats["in_flight"] = self.limiter.in_flight
+    return stats
+
+
+class GovernedClient:
+  """
+  Proxy for a boto3 client that sends every API call through a Governor;
+  anything else (meta, exceptions, paginators) passes straight through
+  """
+
+  passthrough = {"can_paginate", "get_paginator", "get_waiter", "close", "generate_presigned_url"}
+
+  #
+  # calls that must not run twice (see call_once):
+  #
+  once = {"index_faces"}
+
+  def __init__(self, client, governor):
+    self.client = client
+    self.governor = governor
+
+  def __getattr__(self, attr):
+    value = getattr(self.client, attr)
+    if not callable(value) or attr in self.passthrough:
+      return value
+
+    call = self.governor.call_once if attr in self.once else self.governor.call
+
+    def governed(*args, **kwargs):
+      return call(value, *args, **kwargs)
+
+    return governed
+
+
+def from_config(configur):
+  """
+  Builds a Governor from the optional [governor] section of the config:
+
+    [governor]
+    enabled = true
+    tps = 50           (our Rekognition TPS quota per container)
+    burst = 50
+    concurrency = 8
+    max_concurrency = 64
+    max_retries = 6
+
+  Returns None when disabled.
+  """
+  section = 'governor'
+
+  if not configur.getboolean(section, 'enabled', fallback=True):
+    return None
+
+  tps = configur.getfloat(section, 'tps', fallback=50.0)
+
+  return Governor(
+    tps=tps,
+    burst=configur.getfloat(section, 'burst', fallback=tps),
+    concurrency=configur.getint(section, 'concurrency', fallback=8),
+    max_concurrency=configur.getint(section, 'max_concurrency', fallback=64),
+    max_retries=configur.getint(section, 'max_retries', fallback=6))
@@ -0,0 +1,217 @@
+#
+# Client-side gate that rejects unusable images before they are uploaded.
+#
+# An image with the wrong format, a tiny image or a picture with no face
+# in it would otherwise be rejected by the lambda only after the upload,
+# an S3 write and a Rekognition call. The gate checks, cheapest first:
+#
+#   1. the file's magic bytes are JPEG or PNG (whatever the extension says)
+#   2. the width / height read from the PNG IHDR chunk or the JPEG SOF
+#      marker, without decoding the image, are at least min_edge pixels
+#   3. optionally, OpenCV's frontal-face Haar cascade finds a face in a
+#      reduced-size decode (JPEG draft mode decodes at 1/2 .. 1/8 scale);
+#      an image that fails to decode there (e.g. truncated) is rejected
+#      as corrupt
+#
+# The face check needs OpenCV and Pillow; without OpenCV it is skipped and
+# only the header checks apply. Every rejection counts as a round trip
+# avoided.
+#
+import struct
+import pathlib
+
+png_signature = b"\x89PNG\r\n\x1a\n"
+jpeg_signature = b"\xff\xd8\xff"
+
+extensions = {".jpeg": "jpeg", ".jpg": "jpeg", ".png": "png"}
+
+#
+# JPEG start-of-frame markers (baseline, progressive, ...); C4, C8 and CC
+# share the range but are not frames:
+#
+sof_markers = set(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+
+
+def sniff(head):
+  """
+  Returns "jpeg", "png" or None from the first bytes of a file
+  """
+  if head.startswith(jpeg_signature):
+    return "jpeg"
+  if head.startswith(png_signature):
+    return "png"
+  return None
+
+
+def png_size(infile):
+  """
+  (width, height) from the IHDR chunk, which must come first
+  """
+  infile.seek(8)
+  chunk = infile.read(16)
+  if len(chunk) < 16 or chunk[4:8] != b"IHDR":
+    return None
+  return struct.unpack(">II", chunk[8:16])
+
+
+def jpeg_size(infile):
+  """
+  (width, height) from the first start-of-frame marker, skipping over the
+  other marker segments without reading the image data
+  """
+  infile.seek(2)
+
+  while True:
+    byte = infile.read(1)
+    while byte and byte != b"\xff":
+      byte = infile.read(1)
+    while byte == b"\xff":  # markers may be padded with extra 0xFF bytes
+      byte = infile.read(1)
+    if not byte:
+      return None
+
+    marker = byte[0]
+    if marker in (0xD8, 0x01) or 0xD0 <= marker <= 0xD7:  # no length field
+      continue
+    if marker == 0xD9:  # end of image
+      return None
+
+    length = infile.read(2)
+    if len(length) < 2:
+      return None
+    length = struct.unpack(">H", length)[0]
+
+    if marker in sof_markers:
+      frame = infile.read(5)
+      if len(frame) < 5:
+        return None
+      height, width = struct.unpack(">HH", frame[1:5])
+      return width, height
+
+    infile.seek(length - 2, 1)
+
+
+def image_info(path):
+  """
+  Returns ("jpeg" / "png" / None, (width, height) or None), reading
+  only the file header
+  """
+  with open(path, "rb") as infile:
+    kind = sniff(infile.read(8))
+    if kind == "png":
+      return kind, png_size(infile)
+    if kind == "jpeg":
+      return kind, jpeg_size(infile)
+    return None, None
+
+
+class Gate:
+
+  def __init__(self, enabled=True, min_edge=80, detect_faces=True, detect_edge=480):
+    self.enabled = enabled
+    self.min_edge = min_edge          # smallest acceptable width / height
+    self.detect_faces = detect_faces  # run the Haar cascade
+    self.detect_edge = detect_edge    # longest edge of the image the cascade sees
+
+    self.cascade = None
+    self.checked = 0
+    self.passed = 0
+    self.rejected = {}  # reason -> count
+
+  def check(self, path):
+    """
+    Returns None if the image looks usable, otherwise the reason it is not
+    """
+    if not self.enabled:
+      return None
+
+    self.checked += 1
+    reason = self.reason(path)
+
+    if reason is None:
+      self.passed += 1
+    else:
+      key = reason.split(":")[0]
+      self.rejected[key] = self.rejected.get(key, 0) + 1
+
+    return reason
+
+  def reason(self, path):
+    path = pathlib.Path(path)
+
+    if path.suffix.lower() not in extensions:
+      return "unsupported extension: must be .jpeg, .jpg or .png"
+
+    kind, size = image_info(path)
+
+    if kind is None:
+      return "not an image: file is neither JPEG nor PNG"
+    if kind != extensions[path.suffix.lower()]:
+      return "wrong format: file is " + kind + " but named " + path.suffix
+    if size is None:
+      return "corrupt image: no dimensions in header"
+    if min(size) < self.min_edge:
+      return "too small: %dx%d, need at least %d pixels per side" % (size[0], size[1], self.min_edge)
+
+    if self.detect_faces:
+      return self.face_reason(path)
+
+    return None
+
+  def face_reason(self, path):
+    """
+    None if the cascade finds a face, or if OpenCV is not installed (the
+    server then decides); otherwise the reason: no face, or an image the
+    headers pass but that does not decode (e.g. truncated)
+    """
+    try:
+      import cv2
+      import numpy
+      from PIL import Image, ImageOps
+    except ImportError:
+      return True
+
+    if self.cascade is None:
+      self.cascade = cv2.CascadeClassifier(cv2.data.haarcascades + "haarcascade_frontalface_default.xml")
+
+    try:
+      image = Image.open(path)
+      image.draft("L", (self.detect_edge, self.detect_edge))  # JPEG: decode at reduced scale
+      image = ImageOps.exif_transpose(image).convert("L")
+      image.thumbnail((self.detect_edge, self.detect_edge))
+    except Exception as err:
+      return "corrupt image: " + str(err)
+
+    faces = self.cascade.detectMultiScale(numpy.asarray(image), scaleFactor=1.1, minNeighbors=4)
+    if len(faces) == 0:
+      return "no face: no face detected locally"
+    return None
+
+  def round_trips_avoided(self):
+    return sum(self.rejected.values())
+
+  def stats(self):
+    return {
+      "checked": self.checked,
+      "passed": self.passed,
+      "rejected": dict(self.rejected),
+      "round_trips_avoided": self.round_trips_avoided()
+    }
+
+
+def from_config(configur):
+  """
+  Builds a Gate from the optional [gate] section of the client config, e.g.
+
+    [gate]
+    enabled = true
+    min_edge = 80
+    detect_faces = true
+  """
+  section = 'gate'
+
+  return Gate(
+    enabled=configur.getboolean(section, 'enabled', fallback=True),
+    min_edge=configur.getint(section, 'min_edge', fallback=80),
+    detect_faces=configur.getboolean(section, 'detect_faces', fallback=True),
+    detect_edge=configur.getint(section, 'detect_edge', fallback=480))
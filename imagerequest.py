@@ -0,0 +1,126 @@
+#
+# Parses the image upload sent to register_faces / authenticate_faces.
+#
+# Two request formats are accepted:
+#
+#   binary: PUT with Content-Type application/octet-stream, the raw image
+#           bytes as the body and the filename in the query string
+#           (?filename=...). API Gateway hands binary bodies to the lambda
+#           base64-encoded with isBase64Encoded set, so there is exactly one
+#           decode and no JSON parse of the image.
+#
+#   json:   the original {"filename": ..., "data": <base64 string>} body,
+#           kept so older clients continue to work.
+#
+import json
+import base64
+import pathlib
+import requestlog
+
+binary_content_type = 'application/octet-stream'
+
+#
+# accepted extensions and the magic bytes each one's data must start with:
+#
+image_signatures = {
+  ".jpeg": b"\xff\xd8\xff",
+  ".jpg": b"\xff\xd8\xff",
+  ".png": b"\x89PNG\r\n\x1a\n"
+}
+
+
+def get_header(event, name):
+  """
+  Case-insensitive header lookup (REST APIs keep the client's casing,
+  HTTP APIs lowercase everything)
+  """
+  headers = event.get("headers") or {}
+  name = name.lower()
+
+  for key, value in headers.items():
+    if key.lower() == name:
+      return value
+
+  return None
+
+
+def is_binary(event):
+  content_type = get_header(event, 'Content-Type') or ''
+  return content_type.split(';')[0].strip().lower() == binary_content_type
+
+
+def parse_image_request(event):
+  """
+  Extracts the filename and raw image bytes from the lambda event
+
+  Parameters
+  ----------
+  event: API Gateway proxy event
+
+  Returns
+  -------
+  (filename, bytes, body) where body is the parsed JSON body for json
+  requests and the query-string parameters for binary requests
+  """
+  if "body" not in event or event["body"] is None:
+    raise Exception("event has no body")
+
+  if is_binary(event):
+    params = event.get("queryStringParameters") or {}
+
+    if "filename" not in params:
+      raise Exception("binary upload has no filename query parameter")
+
+    filename = params["filename"]
+    data = event["body"]
+
+    with requestlog.span("decode"):
+      if event.get("isBase64Encoded"):
+        bytes = base64.b64decode(data)
+      elif isinstance(data, str):
+        bytes = data.encode('latin-1')
+      else:
+        bytes = data
+
+    requestlog.info("image upload", format="binary", filename=filename, bytes=len(bytes))
+
+    return filename, bytes, params
+
+  with requestlog.span("parse"):
+    body = json.loads(event["body"]) # parse the json
+
+  if "filename" not in body:
+    raise Exception("event has a body but no filename")
+  if "data" not in body:
+    raise Exception("event has a body but no data")
+
+  filename = body["filename"]
+  datastr = body["data"]
+
+  with requestlog.span("decode"):
+    base64_bytes = datastr.encode()        # string -> base64 bytes
+    bytes = base64.b64decode(base64_bytes) # base64 bytes -> raw bytes
+
+  requestlog.info("image upload", format="json", filename=filename, bytes=len(bytes))
+
+  return filename, bytes, body
+
+
+def check_image(filename, bytes):
+  """
+  Rejects anything that is not a JPEG or PNG before it costs an S3 write
+  or a Rekognition call
+
+  Returns
+  -------
+  the lowercased extension (.jpeg, .jpg or .png)
+  """
+  extension = pathlib.Path(filename).suffix.lower()
+
+  if extension not in image_signatures:
+    raise Exception("expecting filename to have .jpeg, .jpg or .png extension")
+
+  if not bytes.startswith(image_signatures[extension]):
+    raise Exception("image data is not " + extension.lstrip(".") + " format")
+
+  return extension
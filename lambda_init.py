@@ -0,0 +1,255 @@
+#
+# Shared, once-per-container setup for the facial recognition lambdas.
+#
+# Lambda keeps the python process (and therefore module globals) alive
+# between invocations of a warm container, so the config file, the boto3
+# session, the S3/Rekognition clients and the database connections are built
+# once here and handed back to every later invocation.
+#
+import os
+import time
+import boto3
+import governor
+import dataaccess
+import requestlog
+
+from configparser import ConfigParser
+from concurrent.futures import ThreadPoolExecutor
+
+config_file = 'config.ini'
+s3_profile = 's3readwrite+rekognition'
+rekognition_region = 'us-east-2'
+
+# defaults for search_faces_by_image, overridable in a [rekognition] section:
+default_match_threshold = 80.0
+default_max_faces = 10
+
+# threads for S3/Rekognition calls that run alongside the main request path:
+executor_workers = 4
+
+_config = None
+_session = None
+_s3_resource = None
+_s3_client = None
+_rekognition = None
+_db = None
+_executor = None
+_matcher = None
+_governor = None
+
+_invocations = 0
+_container_start = time.perf_counter()
+
+
+def get_config():
+  """
+  Returns the parsed config.ini, reading it only on the first call
+  """
+  global _config
+
+  if _config is None:
+    os.environ['AWS_SHARED_CREDENTIALS_FILE'] = config_file
+
+    configur = ConfigParser()
+    configur.read(config_file)
+    _config = configur
+
+  return _config
+
+
+def get_session():
+  """
+  Returns the boto3 session built from the s3readwrite+rekognition profile
+  """
+  global _session
+
+  if _session is None:
+    get_config()  # sets AWS_SHARED_CREDENTIALS_FILE
+    boto3.setup_default_session(profile_name=s3_profile)
+    _session = boto3.DEFAULT_SESSION
+
+  return _session
+
+
+def get_bucket():
+  """
+  Returns the S3 Bucket resource named in the [s3] section of the config
+  """
+  global _s3_resource
+
+  if _s3_resource is None:
+    _s3_resource = get_session().resource('s3')
+
+  bucketname = get_config().get('s3', 'bucket_name')
+  return _s3_resource.Bucket(bucketname)
+
+
+def get_s3():
+  """
+  Returns a low-level S3 client
+  """
+  global _s3_client
+
+  if _s3_client is None:
+    _s3_client = get_session().client('s3')
+
+  return _s3_client
+
+
+def get_governor():
+  """
+  Returns the container's Rekognition throughput governor (see governor
+  and the optional [governor] section of the config), or None if it is
+  disabled
+  """
+  global _governor
+
+  if _governor is None:
+    _governor = governor.from_config(get_config())
+
+    if _governor is not None:
+      requestlog.add_metrics("rekognition_governor", _governor.stats)
+
+  return _governor
+
+
+def get_rekognition():
+  """
+  Returns the Rekognition client. Calls go through the governor, which
+  queues, paces and retries them (throttling and transient failures such
+  as 5xx or dropped connections); botocore's own retries are then turned
+  off so throttling reaches the governor.
+  """
+  global _rekognition
+
+  if _rekognition is None:
+    gov = get_governor()
+
+    if gov is None:
+      _rekognition = get_session().client('rekognition', region_name=rekognition_region)
+    else:
+      from botocore.config import Config
+
+      client = get_session().client(
+        'rekognition', region_name=rekognition_region,
+        config=Config(retries={'mode': 'standard', 'max_attempts': 1}))
+      _rekognition = governor.GovernedClient(client, gov)
+
+  return _rekognition
+
+
+def get_matcher():
+  """
+  Returns the face matcher chosen in the optional [matcher] section of the
+  config (Rekognition by default), sharded over several collections when
+  the [shards] section sets a count
+  """
+  global _matcher
+
+  if _matcher is None:
+    import shards
+    import matchers
+
+    configur = get_config()
+    rekognition = None
+    if configur.get('matcher', 'backend', fallback='rekognition') == 'rekognition':
+      rekognition = get_rekognition()
+
+    _matcher = shards.from_config(configur, rekognition, get_db) or \
+      matchers.from_config(configur, rekognition)
+
+  return _matcher
+
+
+def get_executor():
+  """
+  Returns a thread pool for running S3/Rekognition calls concurrently;
+  boto3 clients are thread-safe, so the cached clients can be shared
+  """
+  global _executor
+
+  if _executor is None:
+    _executor = ThreadPoolExecutor(max_workers=executor_workers)
+
+  return _executor
+
+
+def get_search_params():
+  """
+  Returns (FaceMatchThreshold, MaxFaces) for search_faces_by_image, taken
+  from the optional [rekognition] section of the config
+  """
+  configur = get_config()
+
+  threshold = configur.getfloat('rekognition', 'match_threshold', fallback=default_match_threshold)
+  max_faces = configur.getint('rekognition', 'max_faces', fallback=default_max_faces)
+
+  return threshold, max_faces
+
+
+def get_db():
+  """
+  Returns the faces Database (see dataaccess). Connections are reused
+  across warm invocations and health-checked before reuse. With
+  auto_migrate = true in the [rds] section, pending schema migrations are
+  applied on the first call.
+  """
+  global _db
+
+  if _db is None:
+    configur = get_config()
+    _db = dataaccess.from_config(configur)
+
+    if configur.getboolean('rds', 'auto_migrate', fallback=False):
+      dataaccess.migrate(_db)
+
+  return _db
+
+
+def start(name):
+  """
+  Marks the start of an invocation and records in the request's summary
+  line whether this container is cold (first invocation) or warm
+
+  Parameters
+  ----------
+  name: name of the lambda
+
+  Returns
+  -------
+  True if this is a cold start, False if warm
+  """
+  global _invocations
+
+  _invocations += 1
+  cold = _invocations == 1
+
+  requestlog.annotate(cold=cold, container_invocation=_invocations)
+
+  if cold:
+    since_load = (time.perf_counter() - _container_start) * 1000
+    requestlog.info("cold start", since_load_ms=round(since_load, 1))
+
+  return cold
+
+
+def timed_setup(name, *getters):
+  """
+  Runs the given getters (e.g. get_bucket, get_db) and records how long
+  the setup took as the "setup" span, so cold vs. warm setup cost shows
+  up in the logs
+
+  Returns
+  -------
+  list of whatever the getters returned, in order
+  """
+  cold = start(name)
+
+  t0 = time.perf_counter()
+  with requestlog.span("setup"):
+    results = [getter() for getter in getters]
+  elapsed = (time.perf_counter() - t0) * 1000
+
+  requestlog.debug("setup", cold=cold, ms=round(elapsed, 1))
+
+  return results
@@ -0,0 +1,45 @@
+#
+# Latency / throughput summaries for the bulk client commands.
+#
+
+
+def percentile(sorted_values, p):
+  """
+  Returns the p-th percentile (0..100) of an already sorted list, using
+  linear interpolation between the closest ranks
+  """
+  if not sorted_values:
+    return 0.0
+
+  k = (len(sorted_values) - 1) * p / 100.0
+  lo = int(k)
+  hi = min(lo + 1, len(sorted_values) - 1)
+
+  return sorted_values[lo] + (sorted_values[hi] - sorted_values[lo]) * (k - lo)
+
+
+def summarize(latencies_ms, elapsed_s):
+  """
+  Builds a summary dictionary from per-item latencies (milliseconds) and
+  the wall-clock time of the whole run (seconds)
+  """
+  values = sorted(latencies_ms)
+
+  return {
+    "count": len(values),
+    "elapsed_s": round(elapsed_s, 3),
+    "throughput_per_s": round(len(values) / elapsed_s, 2) if elapsed_s > 0 else 0.0,
+    "p50_ms": round(percentile(values, 50), 1),
+    "p90_ms": round(percentile(values, 90), 1),
+    "p99_ms": round(percentile(values, 99), 1),
+    "max_ms": round(values[-1], 1) if values else 0.0
+  }
+
+
+def print_summary(title, summary):
+  print()
+  print("**", title, "**")
+  print("  items:", summary["count"], " elapsed: %.2f s" % summary["elapsed_s"],
+        " throughput: %.2f/s" % summary["throughput_per_s"])
+  print("  latency p50: %.1f ms  p90: %.1f ms  p99: %.1f ms  max: %.1f ms"
+        % (summary["p50_ms"], summary["p90_ms"], summary["p99_ms"], summary["max_ms"]))
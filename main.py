@@ -3,40 +3,59 @@
 # a set of lambda functions in AWS through API Gateway.
 # Adapted from benford app client-side. 
 #
+# Without arguments the app prompts for the config file and commands. For
+# scripts, the same commands run non-interactively:
+#
+#   python main.py [--config FILE] [--json] list
+#   python main.py register IMAGE FIRSTNAME LASTNAME
+#   python main.py authenticate IMAGE [--group]
+#   python main.py attributes ENTRYID
+#
+# With --json the result is printed as JSON (list: one object per line)
+# and failures exit with status 1. The HTTP client (aiohttp), requests and
+# OpenCV are only imported by the commands that use them, so starting the
+# app stays fast; startup.py checks that.
+#
 
-import requests
-import jsons
-
-import uuid
+import sys
+import json
 import pathlib
 import logging
-import sys
-import os
-import base64
+import argparse
+import preprocess
+import imagegate
 
 from configparser import ConfigParser
-import matplotlib.pyplot as plt
-import matplotlib.image as img
 
-###################################################################
 #
-# classes
+# send images as raw application/octet-stream bytes; set binary_uploads
+# to false in the [client] section of the config to fall back to the
+# base64-in-JSON format:
+#
+binary_uploads = True
+
+#
+# images are downscaled / recompressed before upload, see the optional
+# [preprocess] section of the config:
 #
-class Face:
+preprocessor = preprocess.Preprocessor()
 
-  def __init__(self, entryid, firstname, lastname, rekognitionid, bucketkey):
-    self.entryid = entryid # these must match columns from DB table
-    self.firstname = firstname
-    self.lastname = lastname
-    self.rekognitionid = rekognitionid
-    self.bucketkey = bucketkey
+#
+# unusable images (wrong format, too small, no face) are rejected locally
+# instead of after an upload, see the optional [gate] section:
+#
+gate = imagegate.Gate()
 
-class Attributes:
+#
+# optional requests-per-second cap for the bulk commands (max_tps in the
+# [client] section); they also back off on their own when throttled:
+#
+bulk_tps = None
 
-  def __init__(self, gender, agerange, emotions):
-    self.gender = gender
-    self.agerange = agerange
-    self.emotions = emotions
+#
+# print results as JSON (--json) instead of text:
+#
+json_output = False
 
 ############################################################
 #
@@ -61,6 +80,10 @@ def prompt():
   print("   2 => register face")
   print("   3 => authenticate face")
   print("   4 => see facial attributes")
+  print("   5 => bulk register a directory / manifest")
+  print("   6 => batch authenticate a directory / stdin list")
+  print("   7 => authenticate everyone in a group photo")
+  print("   8 => authenticate a video clip")
   
 
   cmd = input()
@@ -76,306 +99,335 @@ def prompt():
 
 ###################################################################
 #
-# see_registered
+# client
 #
-def see_registered(baseurl):
+def run_client(baseurl, command):
   """
-  Prints out all the faces in the database
+  Runs command(client) on a FacialRecognitionClient configured from the
+  client config, and returns its result
 
   Parameters
   ----------
   baseurl: baseurl for web service
+  command: coroutine function taking the client
 
   Returns
   -------
-  nothing
+  whatever command returns
   """
+  import asyncio
+  import asyncclient
 
-  try:
-    #
-    # call the web service:
-    #
-    api = '/registered_faces'
-    url = baseurl + api
+  #
+  # the per-upload report is text, keep it out of JSON output:
+  #
+  on_upload = None if json_output else preprocess.print_report
 
-    res = requests.get(url)
+  async def run():
+    async with asyncclient.FacialRecognitionClient(
+        baseurl, binary=binary_uploads, preprocessor=preprocessor,
+        on_upload=on_upload) as client:
+      return await command(client)
 
-    #
-    # let's look at what we got back:
-    #
-    if res.status_code != 200:
-      # failed:
-      print("Failed with status code:", res.status_code)
-      print("url: " + url)
-      if res.status_code == 400:  # we'll have an error message
-        body = res.json()
-        print("Error message:", body["message"])
-      #
-      return
+  return asyncio.run(run())
 
-    #
-    # deserialize and extract users:
-    #
-    body = res.json()
-    # print(body)
-    #
-    # let's map each dictionary into a User object:
-    #
-    faces = []
-    for row in body:
-      # print(row)
-      face = Face(row[0], row[1], row[2], row[3], row[4])
-      faces.append(face)
-    #
-    # Now we can think OOP:
-    #
-    for face in faces:
+
+def gate_rejects(local_filename):
+  """
+  Runs the local image gate; prints why and returns True if the image
+  should not be uploaded
+  """
+  reason = gate.check(local_filename)
+  if reason is None:
+    return False
+
+  if json_output:
+    print(json.dumps({"error": "not uploading: " + reason}))
+    return True
+
+  print("Not uploading:", reason)
+  print("  (round trips avoided this session:", gate.round_trips_avoided(), ")")
+  return True
+
+
+def missing_file(kind, local_filename):
+  if json_output:
+    print(json.dumps({"error": kind + " file '" + local_filename + "' does not exist"}))
+  else:
+    print(kind, "file '", local_filename, "' does not exist...")
+
+
+def print_failure(e):
+  if json_output:
+    print(json.dumps({"error": str(e.message), "status": e.status, "url": e.url}))
+    return
+
+  print("Failed with status code:", e.status)
+  print("url: " + e.url)
+  if e.status == 400:
+    # we'll have an error message
+    print("Error message:", e.message)
+
+
+def log_failure(name, e):
+  if json_output:
+    print(json.dumps({"error": str(e)}))
+  logging.error(name + "() failed:")
+  logging.error(e)
+
+
+def face_json(face):
+  return {slot: getattr(face, slot) for slot in face.__slots__}
+
+
+class NoClientError(Exception):
+  pass
+
+
+def client_error():
+  """
+  The client's HTTP error class. Does not import the client: a
+  ClientError can only come from a client that was imported, and a
+  failed import (no aiohttp) must reach the generic failure handling.
+  """
+  asyncclient = sys.modules.get("asyncclient")
+  return asyncclient.ClientError if asyncclient is not None else NoClientError
+
+###################################################################
+#
+# see_registered
+#
+def see_registered(baseurl):
+  """
+  Prints out all the faces in the database
+
+  Parameters
+  ----------
+  baseurl: baseurl for web service
+
+  Returns
+  -------
+  True on success
+  """
+
+  #
+  # pages are fetched on demand, so only one page is in memory at a time:
+  #
+  async def print_faces(client):
+    async for face in client.iter_registered():
+      if json_output:
+        print(json.dumps(face_json(face)))
+        continue
       print(face.entryid)
       print("Last Name, First Name: ", face.lastname + ",", face.firstname)
       print("Rekognition Id: " , face.rekognitionid)
       print("Bucket Key: ", face.bucketkey)
 
+  try:
+    run_client(baseurl, print_faces)
+    return True
+
+  except client_error() as e:
+    print_failure(e)
+
   except Exception as e:
-    logging.error("see_registered() failed:")
-    logging.error("url: " + url)
-    logging.error(e)
-    return
+    log_failure("see_registered", e)
+
+  return False
 
 ############################################################
 #
 # register face
 #
-def register(baseurl):
+def register(baseurl, local_filename=None, firstname=None, lastname=None):
   """
   Uploads face to S3 Registration bucket, gets RekognitionId, and updates the database
 
   Parameters
   ----------
   baseurl: baseurl for web service
+  local_filename, firstname, lastname: prompted for when None
 
   Returns
   -------
-  nothing
+  True on success
   """
 
-  print("Enter facial image to register (must be jpeg or png file format)>")
-  local_filename = input()
-
-  extension = local_filename.split('.')[1]
-
-  if extension != 'jpeg' and extension != 'png':
-    print("File must be jpeg or png format")
-    return
+  if local_filename is None:
+    print("Enter facial image to register (must be jpeg or png file format)>")
+    local_filename = input()
 
   if not pathlib.Path(local_filename).is_file():
-    print("Image file '", local_filename, "' does not exist...")
-    return
-
-  print("Enter registration's first name>")
-  firstname = input()
-
-  print("Enter registration's last name>")
-  lastname = input()
+    missing_file("Image", local_filename)
+    return False
 
-  try:
-    #
-    # build the data packet:
-    #
-    infile = open(local_filename, "rb")
-    bytes = infile.read()
-    infile.close()
-
-    #
-    # now encode the image as base64. Note b64encode returns
-    # a bytes object, not a string. So then we have to convert
-    # (decode) the bytes -> string, and then we can serialize
-    # the string as JSON for upload to server:
-    #
-    data = base64.b64encode(bytes)
-    datastr = data.decode()
+  if gate_rejects(local_filename):
+    return False
 
-    new_filename = firstname+"_"+lastname+"."+extension
+  if firstname is None:
+    print("Enter registration's first name>")
+    firstname = input()
 
-    data = {"filename": new_filename, "data": datastr}
-    #
-    # call the web service:
-    #
-    api = '/register_faces'
-    url = baseurl + api
+  if lastname is None:
+    print("Enter registration's last name>")
+    lastname = input()
 
-    res = requests.put(url, json=data)
+  try:
+    message = run_client(
+      baseurl, lambda client: client.register(local_filename, firstname, lastname))
 
-    #
-    # let's look at what we got back:
-    #
-    if res.status_code != 200:
-      # failed:
-      print("Failed with status code:", res.status_code)
-      print("url: " + url)
-      if res.status_code == 400:
-        # we'll have an error message
-        body = res.json()
-        print("Error message:", body)
-      #
-      return
+    if json_output:
+      print(json.dumps({"message": message}))
+    else:
+      print(message)
+    return True
 
-    #
-    # successful registration?
-    #
-    body = res.json()
-    print(body)
-    return
+  except client_error() as e:
+    print_failure(e)
 
   except Exception as e:
-    logging.error("register() failed:")
-    logging.error("url: " + url)
-    logging.error(e)
-    return
+    log_failure("register", e)
+
+  return False
 
 
 ############################################################
 #
 # authenticate face
 #
-def authenticate(baseurl):
+def authenticate(baseurl, local_filename=None):
   """
   Uploads image to Authentication S3 bucket and returns whether their face is a match
 
   Parameters
   ----------
   baseurl: baseurl for web service
+  local_filename: prompted for when None
 
   Returns
   -------
-  nothing
+  True if the request succeeded (matched or not)
   """
 
-  print("Enter facial image to authenticate (must be jpeg or png file format)>")
-  local_filename = input()
+  if local_filename is None:
+    print("Enter facial image to authenticate (must be jpeg or png file format)>")
+    local_filename = input()
 
   if not pathlib.Path(local_filename).is_file():
-    print("Image file '", local_filename, "' does not exist...")
-    return
+    missing_file("Image", local_filename)
+    return False
 
-  extension = local_filename.split('.')[1]
-
-  if extension != 'jpeg' and extension != 'png':
-    print("File must be jpeg or png format")
-    return
+  if gate_rejects(local_filename):
+    return False
 
   try:
-    #
-    # build the data packet:
-    #
-    infile = open(local_filename, "rb")
-    bytes = infile.read()
-    infile.close()
+    face = run_client(baseurl, lambda client: client.authenticate(local_filename))
 
-    #
-    # now encode the image as base64. Note b64encode returns
-    # a bytes object, not a string. So then we have to convert
-    # (decode) the bytes -> string, and then we can serialize
-    # the string as JSON for upload to server:
-    #
-    data = base64.b64encode(bytes)
-    datastr = data.decode()
+    if json_output:
+      print(json.dumps({"matched": face is not None,
+                        "face": face_json(face) if face is not None else None}))
+    elif face is None:
+      print("No Face Match Found!")
+    else:
+      print("Hello, " + face.firstname + " " + face.lastname + "!")
+    return True
 
-    data = {"filename": local_filename, "data": datastr}
-    #
-    # call the web service:
-    #
-    api = '/authenticate_faces'
-    url = baseurl + api
+  except client_error() as e:
+    print_failure(e)
 
-    res = requests.put(url, json=data)
+  except Exception as e:
+    log_failure("authenticate", e)
 
-    # image_to_display = img.imread(local_filename)
-    # plt.imshow(image_to_display)
-    # plt.show()
-    
-    #
-    # let's look at what we got back:
-    #
-    if res.status_code == 403: 
-      body = res.json()
-      print(body)
-      return
-    if res.status_code != 200:
-      # failed:
-      print("Failed with status code:", res.status_code)
-      print("url: " + url)
-      if res.status_code == 400:
-        # we'll have an error message
-        body = res.json()
-        print("Error message:", body)
-      #
-      return
+  return False
+
+############################################################
+#
+# authenticate group photo
+#
+def authenticate_group(baseurl, local_filename=None):
+  """
+  Uploads a group photo and prints everyone who was identified in it
+
+  Parameters
+  ----------
+  baseurl: baseurl for web service
+  local_filename: prompted for when None
+
+  Returns
+  -------
+  True if the request succeeded
+  """
+
+  if local_filename is None:
+    print("Enter group photo to authenticate (must be jpeg or png file format)>")
+    local_filename = input()
+
+  if not pathlib.Path(local_filename).is_file():
+    missing_file("Image", local_filename)
+    return False
+
+  if gate_rejects(local_filename):
+    return False
+
+  try:
+    people, unidentified = run_client(
+      baseurl, lambda client: client.authenticate_group(local_filename))
+
+    if json_output:
+      print(json.dumps({
+        "faces": [{"face": face_json(face), "box": box, "similarity": similarity}
+                  for face, box, similarity in people],
+        "unidentified": unidentified
+      }))
+      return True
+
+    for face, box, similarity in people:
+      print("Hello, " + face.firstname + " " + face.lastname + "!",
+            " (similarity %.1f, box left %.2f top %.2f)" % (similarity, box['Left'], box['Top']))
+
+    if not people:
+      print("No Face Match Found!")
+    if unidentified:
+      print(unidentified, "face(s) not identified")
+    return True
+
+  except client_error() as e:
+    print_failure(e)
 
-    #
-    # successful authentication?
-    #
-    if res.status_code == 200:
-      body = res.json()
-      face = body
-      print("Hello, " + face[1] + " " + face[2] + "!")
-      return
-    else:
-      print("Something else went wrong...")
-      return
-  
   except Exception as e:
-    logging.error("authenticate() failed:")
-    logging.error("url: " + url)
-    logging.error(e)
-    return
+    log_failure("authenticate_group", e)
+
+  return False
 
 ###################################################################
 #
 # face_attributes
 #
-def face_attributes(baseurl):
+def face_attributes(baseurl, entryid=None):
   """
   Prints out all the attributes of a face
 
   Parameters
   ----------
   baseurl: baseurl for web service
+  entryid: prompted for when None
 
   Returns
   -------
-  nothing
+  True on success
   """
 
-  entryid = input("Enter Entry Id> ")
+  if entryid is None:
+    entryid = input("Enter Entry Id> ")
   
   try:
-    #
-    # call the web service:
-    #
-    api = '/face_attributes'
-    url = baseurl + api
+    attributes = run_client(baseurl, lambda client: client.face_attributes(entryid))
 
-    data = {"entryid": entryid}
+    if json_output:
+      print(json.dumps({slot: getattr(attributes, slot) for slot in attributes.__slots__}))
+      return True
 
-    res = requests.get(url, json=data)
-
-    #
-    # let's look at what we got back:
-    #
-    if res.status_code != 200:
-      # failed:
-      print("Failed with status code:", res.status_code)
-      print("url: " + url)
-      if res.status_code == 400:  # we'll have an error message
-        body = res.json()
-        print("Error message:", body["message"])
-      #
-      return
-
-    body = res.json()
-    attributes = Attributes(body['Gender'], body['AgeRange'], body['Emotions'])
-
-    print('\nAttributes For', body['Name'])
+    print('\nAttributes For', attributes.name)
     print("\n~Gender~\n  Prediction: ", attributes.gender['Value'])
     print("  Confidence: ", attributes.gender['Confidence'])
     print("\n~Age Range~\n  Low: ", attributes.agerange['Low'])
@@ -385,45 +437,173 @@ def face_attributes(baseurl):
     print("  Second Highest Emotion: ", attributes.emotions[1]['Type'])
     print("  Confidence: ", attributes.emotions[1]['Confidence'])
     
+    return True
+
+  except client_error() as e:
+    print_failure(e)
+
+  except Exception as e:
+    log_failure("face_attributes", e)
+
+  return False
+
+############################################################
+#
+# bulk register
+#
+def bulk_register(baseurl):
+  """
+  Registers every image in a directory (FIRSTNAME_LASTNAME.EXT files) or
+  a manifest CSV (image,firstname,lastname) using a pool of workers
+
+  Parameters
+  ----------
+  baseurl: baseurl for web service
+
+  Returns
+  -------
+  nothing
+  """
+
+  print("Enter directory or manifest CSV to register>")
+  source = input()
+
+  if not pathlib.Path(source).exists():
+    print("'", source, "' does not exist...")
     return
-  
+
+  print("Number of concurrent workers? (ENTER for 4)>")
+  s = input()
+  workers = int(s) if s.isnumeric() and int(s) > 0 else 4
+
+  try:
+    import bulk
+    bulk.bulk_register(baseurl, source, workers=workers,
+                       binary=binary_uploads, preprocessor=preprocessor, tps=bulk_tps)
+
   except Exception as e:
-    logging.error("face_attributes() failed:")
-    logging.error("url: " + url)
+    logging.error("bulk_register() failed:")
     logging.error(e)
     return
 
 ############################################################
-# main
 #
-try:
-  print('** Welcome to FacialRecognitionApp **')
-  print()
+# batch authenticate
+#
+def batch_authenticate(baseurl):
+  """
+  Authenticates every image in a directory (or every path listed on
+  stdin), printing one JSON line per image followed by a summary line
 
-  # eliminate traceback so we just get error message:
-  sys.tracebacklimit = 0
+  Parameters
+  ----------
+  baseurl: baseurl for web service
 
-  #
-  # what config file should we use for this session?
-  #
-  config_file = 'facialrecognitionapp-client-config.ini'
+  Returns
+  -------
+  nothing
+  """
+
+  print("Enter directory of images to authenticate, or - to read paths from stdin>")
+  source = input()
+
+  if source != "-" and not pathlib.Path(source).is_dir():
+    print("Directory '", source, "' does not exist...")
+    return
 
-  print("Config file to use for this session?")
-  print("Press ENTER to use default, or")
-  print("enter config file name>")
+  print("Number of concurrent requests? (ENTER for 8)>")
   s = input()
+  workers = int(s) if s.isnumeric() and int(s) > 0 else 8
 
-  if s == "":  # use default
-    pass  # already set
-  else:
-    config_file = s
+  try:
+    import bulk
+    bulk.batch_authenticate(baseurl, source, workers=workers,
+                            binary=binary_uploads, preprocessor=preprocessor, tps=bulk_tps)
+
+  except Exception as e:
+    logging.error("batch_authenticate() failed:")
+    logging.error(e)
+    return
+
+###################################################################
+#
+# authenticate_video
+#
+def authenticate_video(baseurl):
+  """
+  Samples frames from a video clip, authenticates the frames that changed
+  and prints who appeared when
+
+  Parameters
+  ----------
+  baseurl: baseurl for web service
+
+  Returns
+  -------
+  nothing
+  """
+
+  print("Enter video file to authenticate>")
+  local_filename = input()
+
+  if not pathlib.Path(local_filename).is_file():
+    print("Video file '", local_filename, "' does not exist...")
+    return
+
+  print("Frames per second to sample? (ENTER for 2)>")
+  s = input()
+  sample_fps = float(s) if s.replace(".", "", 1).isnumeric() and float(s) > 0 else 2.0
+
+  try:
+    import video
+    result = video.authenticate_video(baseurl, local_filename, sample_fps=sample_fps,
+                                      binary=binary_uploads)
+
+    for span in result["timeline"]:
+      print("%7.2f s - %7.2f s  %s" % (span["start"], span["end"], span["name"]))
+
+    if not result["timeline"]:
+      print("No Face Match Found!")
+
+    stats = result["stats"]
+    print("frames decoded:", stats["frames_decoded"],
+          " sampled:", stats["frames_sampled"],
+          " sent:", stats["frames_sent"],
+          " API calls saved:", stats["api_calls_saved"])
+
+  except Exception as e:
+    logging.error("authenticate_video() failed:")
+    logging.error(e)
+    return
+
+############################################################
+#
+# setup
+#
+default_config_file = 'facialrecognitionapp-client-config.ini'
+
+
+def setup(config_file):
+  """
+  Reads the client config and sets this session's options
+
+  Parameters
+  ----------
+  config_file: path of the client config
+
+  Returns
+  -------
+  baseurl for web service, or None (after printing why) if the config
+  cannot be used
+  """
+  global binary_uploads, preprocessor, gate, bulk_tps
 
   #
   # does config file exist?
   #
   if not pathlib.Path(config_file).is_file():
     print("**ERROR: config file '", config_file, "' does not exist, exiting")
-    sys.exit(0)
+    return None
 
   #
   # setup base URL to web service:
@@ -431,50 +611,172 @@ try:
   configur = ConfigParser()
   configur.read(config_file)
   baseurl = configur.get('client', 'webservice')
+  binary_uploads = configur.getboolean('client', 'binary_uploads', fallback=True)
+  preprocessor = preprocess.from_config(configur)
+  gate = imagegate.from_config(configur)
+  bulk_tps = configur.getfloat('client', 'max_tps', fallback=0.0) or None
 
   #
   # make sure baseurl does not end with /, if so remove:
   #
   if len(baseurl) < 16:
     print("**ERROR: baseurl '", baseurl, "' is not nearly long enough...")
-    sys.exit(0)
+    return None
 
   if baseurl == "https://YOUR_GATEWAY_API.amazonaws.com":
     print("**ERROR: update config.ini file with your gateway endpoint")
-    sys.exit(0)
+    return None
 
   lastchar = baseurl[len(baseurl) - 1]
   if lastchar == "/":
     baseurl = baseurl[:-1]
 
-  #
-  # main processing loop:
-  #
-  cmd = prompt()
+  return baseurl
+
+
+############################################################
+#
+# command line
+#
+def parse_args(argv):
+  parser = argparse.ArgumentParser(description="FacialRecognitionApp client")
+  parser.add_argument("--config", default=default_config_file, help="client config file")
+  parser.add_argument("--json", action="store_true", help="print results as JSON")
+
+  commands = parser.add_subparsers(dest="command", required=True)
+
+  commands.add_parser("list", help="see who's registered")
+
+  register_args = commands.add_parser("register", help="register a face")
+  register_args.add_argument("image")
+  register_args.add_argument("firstname")
+  register_args.add_argument("lastname")
+
+  authenticate_args = commands.add_parser("authenticate", help="authenticate a face")
+  authenticate_args.add_argument("image")
+  authenticate_args.add_argument("--group", action="store_true",
+                                 help="identify everyone in a group photo")
+
+  attributes_args = commands.add_parser("attributes", help="see a face's attributes")
+  attributes_args.add_argument("entryid")
+
+  return parser.parse_args(argv)
+
+
+def run_command(argv):
+  """
+  Runs one command given on the command line
+
+  Returns
+  -------
+  exit status: 0 on success, 1 on failure
+  """
+  global json_output
 
-  while cmd != 0:
+  args = parse_args(argv)
+  json_output = args.json
+
+  # eliminate traceback so we just get error message:
+  sys.tracebacklimit = 0
+
+  baseurl = setup(args.config)
+  if baseurl is None:
+    return 1
+
+  if args.command == "list":
+    ok = see_registered(baseurl)
+  elif args.command == "register":
+    ok = register(baseurl, args.image, args.firstname, args.lastname)
+  elif args.command == "authenticate" and args.group:
+    ok = authenticate_group(baseurl, args.image)
+  elif args.command == "authenticate":
+    ok = authenticate(baseurl, args.image)
+  else:
+    ok = face_attributes(baseurl, args.entryid)
+
+  return 0 if ok else 1
+
+
+############################################################
+#
+# interactive session
+#
+def interactive():
+  try:
+    print('** Welcome to FacialRecognitionApp **')
+    print()
+
+    # eliminate traceback so we just get error message:
+    sys.tracebacklimit = 0
+
+    #
+    # what config file should we use for this session?
     #
-    if cmd == 1:
-      see_registered(baseurl)
-    elif cmd == 2:
-      register(baseurl)
-    elif cmd == 3:
-      authenticate(baseurl)
-    elif cmd == 4:
-      face_attributes(baseurl)
+    config_file = default_config_file
+
+    print("Config file to use for this session?")
+    print("Press ENTER to use default, or")
+    print("enter config file name>")
+    s = input()
+
+    if s == "":  # use default
+      pass  # already set
     else:
-      print("** Unknown command, try again...")
+      config_file = s
+
+    baseurl = setup(config_file)
+    if baseurl is None:
+      sys.exit(0)
+
+    #
+    # main processing loop:
     #
     cmd = prompt()
 
-  #
-  # done
-  #
-  print()
-  print('** done **')
-  sys.exit(0)
+    while cmd != 0:
+      #
+      if cmd == 1:
+        see_registered(baseurl)
+      elif cmd == 2:
+        register(baseurl)
+      elif cmd == 3:
+        authenticate(baseurl)
+      elif cmd == 4:
+        face_attributes(baseurl)
+      elif cmd == 5:
+        bulk_register(baseurl)
+      elif cmd == 6:
+        batch_authenticate(baseurl)
+      elif cmd == 7:
+        authenticate_group(baseurl)
+      elif cmd == 8:
+        authenticate_video(baseurl)
+      else:
+        print("** Unknown command, try again...")
+      #
+      cmd = prompt()
 
-except Exception as e:
-  logging.error("**ERROR: main() failed:")
-  logging.error(e)
-  sys.exit(0)
\ No newline at end of file
+    #
+    # done
+    #
+    if gate.checked:
+      print()
+      print("image gate:", gate.stats())
+
+    print()
+    print('** done **')
+    sys.exit(0)
+
+  except Exception as e:
+    logging.error("**ERROR: main() failed:")
+    logging.error(e)
+
+
+############################################################
+# main
+#
+if __name__ == "__main__":
+  if len(sys.argv) > 1:
+    sys.exit(run_command(sys.argv[1:]))
+
+  interactive()
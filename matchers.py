@@ -0,0 +1,392 @@
+#
+# Face matching backends used by register_faces and authenticate_faces.
+#
+# A matcher indexes a face image and later searches for the closest indexed
+# faces. Search results use the same shape as Rekognition's FaceMatches
+#
+#   [{'Face': {'FaceId': ...}, 'Similarity': 0..100}, ...]
+#
+# so the handlers do not care which backend produced them.
+#
+#   RekognitionMatcher:  the AWS Rekognition collection (default)
+#   ShardedMatcher:      Rekognition collections partitioned by shard key
+#                        or image hash (see shards; [shards] count > 0)
+#   LocalVectorMatcher:  face embeddings in a memory-mapped NumPy matrix with
+#                        vectorized top-k cosine search, and an optional
+#                        coarse partitioned (IVF) index for large galleries
+#
+# The local matcher turns images into vectors with a pluggable embedder;
+# StubEmbedder is a deterministic stand-in for tests and offline runs.
+#
+import json
+import uuid
+import hashlib
+import pathlib
+import importlib
+import threading
+import requestlog
+
+
+###################################################################
+#
+# Matcher interface
+#
+class Matcher:
+
+  def route(self, shard_key=None, imagehash=None):
+    """
+    Returns the collection a face with this shard key / image hash belongs
+    in, to pass to index_face and search (and store with the face); None
+    when the backend has a single gallery, or for a search of every shard
+    (see shards)
+    """
+    return None
+
+  def index_face(self, image_bytes, collection_id=None):
+    """
+    Adds the (largest) face in the image to the gallery
+
+    Returns
+    -------
+    (face id, face detail dictionary or None)
+    """
+    raise NotImplementedError()
+
+  def search(self, image_bytes, threshold, max_faces, collection_id=None):
+    """
+    Returns up to max_faces matches with Similarity >= threshold, most
+    similar first, in Rekognition's FaceMatches format
+    """
+    raise NotImplementedError()
+
+  def detect_faces(self, image_bytes):
+    """
+    Returns the BoundingBox (ratios of the image width / height, as
+    Rekognition reports them) of every face in the image
+    """
+    raise NotImplementedError()
+
+
+class RekognitionMatcher(Matcher):
+
+  def __init__(self, rekognition, collection_id='database-faces'):
+    self.rekognition = rekognition
+    self.collection_id = collection_id
+
+  def route(self, shard_key=None, imagehash=None):
+    return self.collection_id
+
+  def index_face(self, image_bytes, collection_id=None):
+    #
+    # MaxFaces=1: only the largest face is registered, so a group photo
+    # does not leave the other faces behind as orphans in the collection
+    #
+    with requestlog.span("rekognition"):
+      response = self.rekognition.index_faces(
+        Image={'Bytes': image_bytes},
+        CollectionId=collection_id or self.collection_id,
+        DetectionAttributes=['ALL'],
+        MaxFaces=1
+      )
+    requestlog.debug("index_faces", indexed=len(response['FaceRecords']),
+                     unindexed=len(response.get('UnindexedFaces', [])))
+
+    if not response['FaceRecords']:
+      raise Exception("no face detected in image")
+
+    record = response['FaceRecords'][0]
+    return record['Face']['FaceId'], record.get('FaceDetail')
+
+  def search(self, image_bytes, threshold, max_faces, collection_id=None):
+    with requestlog.span("rekognition"):
+      response = self.rekognition.search_faces_by_image(
+        CollectionId=collection_id or self.collection_id,
+        Image={'Bytes': image_bytes},
+        FaceMatchThreshold=threshold,
+        MaxFaces=max_faces
+      )
+    requestlog.debug("search_faces_by_image", matches=len(response['FaceMatches']))
+
+    return response['FaceMatches']
+
+  def detect_faces(self, image_bytes):
+    with requestlog.span("rekognition"):
+      response = self.rekognition.detect_faces(Image={'Bytes': image_bytes})
+    return [detail['BoundingBox'] for detail in response['FaceDetails']]
+
+
+###################################################################
+#
+# embedders
+#
+class Embedder:
+
+  dim = 128
+
+  def embed(self, image_bytes):
+    """
+    Returns a 1-D float32 numpy vector of length self.dim
+    """
+    raise NotImplementedError()
+
+
+class StubEmbedder(Embedder):
+  """
+  Deterministic embedder for tests: the same bytes always map to the same
+  unit vector, and different bytes to (nearly) orthogonal ones
+  """
+
+  def __init__(self, dim=128):
+    self.dim = dim
+
+  def embed(self, image_bytes):
+    import numpy
+
+    seed = int.from_bytes(hashlib.sha256(image_bytes).digest()[:8], "little")
+    vector = numpy.random.default_rng(seed).standard_normal(self.dim).astype(numpy.float32)
+    return vector / numpy.linalg.norm(vector)
+
+
+def load_embedder(spec, dim):
+  """
+  Builds an embedder from a "module:ClassName" spec; the class is called
+  with dim=...
+  """
+  module_name, class_name = spec.split(":")
+  cls = getattr(importlib.import_module(module_name), class_name)
+  return cls(dim=dim)
+
+
+###################################################################
+#
+# local vector search
+#
+class LocalVectorMatcher(Matcher):
+  """
+  Stores unit-length embeddings in <path>.npy (memory-mapped, grown by
+  doubling) and their face ids in <path>.ids, one per line and appended
+  as faces are indexed (an older <path>.ids.json is converted on load)
+  """
+
+  def __init__(self, path, embedder, partitions=0, nprobe=4, min_partition_size=64):
+    import numpy
+
+    self.np = numpy
+    self.path = pathlib.Path(path)
+    self.matrix_file = self.path.with_suffix(".npy")
+    self.ids_file = self.path.with_suffix(".ids")
+    self.legacy_ids_file = self.path.with_suffix(".ids.json")
+    self.embedder = embedder
+    self.dim = embedder.dim
+
+    self.partitions = partitions  # 0 => exact search over every vector
+    self.nprobe = nprobe
+    self.min_partition_size = min_partition_size
+
+    self.lock = threading.Lock()
+    self.ids = []
+    self.ids_out = None
+    self.matrix = None
+
+    self.centroids = None
+    self.assignments = None
+    self.indexed_count = 0
+
+    self.load()
+
+  def load(self):
+    np = self.np
+
+    if self.ids_file.is_file():
+      self.ids = self.read_ids()
+    elif self.legacy_ids_file.is_file():
+      with open(self.legacy_ids_file) as infile:
+        self.ids = json.load(infile)
+      self.write_ids()
+
+    if self.matrix_file.is_file():
+      self.matrix = np.load(self.matrix_file, mmap_mode="r+")
+    else:
+      self.matrix = self.allocate(64)
+
+  def read_ids(self):
+    with open(self.ids_file, "rb+") as infile:
+      data = infile.read()
+      end = data.rfind(b"\n") + 1
+      if end < len(data):
+        infile.truncate(end)  # partly written last id from a crash
+    return data[:end].decode("utf-8").split()
+
+  def write_ids(self):
+    """
+    Rewrites the whole ids file (only when converting), via a temporary
+    file so a crash leaves the old one intact
+    """
+    self.path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = self.ids_file.with_suffix(".ids.tmp")
+    with open(tmp, "w") as outfile:
+      outfile.write("".join(face_id + "\n" for face_id in self.ids))
+    tmp.replace(self.ids_file)
+
+  def append_id(self, face_id):
+    if self.ids_out is None:
+      self.path.parent.mkdir(parents=True, exist_ok=True)
+      self.ids_out = open(self.ids_file, "a")
+    self.ids_out.write(face_id + "\n")
+    self.ids_out.flush()
+
+  def allocate(self, capacity):
+    from numpy.lib.format import open_memmap
+
+    self.path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = self.matrix_file.with_suffix(".tmp.npy")
+    matrix = open_memmap(tmp, mode="w+", dtype=self.np.float32, shape=(capacity, self.dim))
+
+    if self.matrix is not None:
+      matrix[:len(self.ids)] = self.matrix[:len(self.ids)]
+      matrix.flush()
+      del self.matrix
+
+    tmp.replace(self.matrix_file)
+    return matrix
+
+  def index_face(self, image_bytes, collection_id=None):
+    with requestlog.span("embed"):
+      vector = self.embedder.embed(image_bytes)
+    vector = vector / self.np.linalg.norm(vector)
+    face_id = str(uuid.uuid4())
+
+    with self.lock:
+      n = len(self.ids)
+      if n >= self.matrix.shape[0]:
+        self.matrix = self.allocate(self.matrix.shape[0] * 2)
+
+      #
+      # the vector is flushed before its id is appended, so every id on
+      # disk has its row:
+      #
+      self.matrix[n] = vector
+      self.matrix.flush()
+      self.append_id(face_id)
+      self.ids.append(face_id)
+
+      if self.assignments is not None:
+        # keep the coarse index usable until the next rebuild:
+        nearest = int(self.np.argmax(self.centroids @ vector))
+        self.assignments[nearest] = self.np.append(self.assignments[nearest], n)
+
+    return face_id, None
+
+  def build_partitions(self, iterations=10):
+    """
+    (Re)builds the coarse index: k-means over the stored vectors, then each
+    vector is assigned to its nearest centroid
+    """
+    np = self.np
+    n = len(self.ids)
+    k = min(self.partitions, max(1, n // self.min_partition_size))
+    data = np.asarray(self.matrix[:n])
+
+    rng = np.random.default_rng(0)
+    centroids = data[rng.choice(n, size=k, replace=False)].copy()
+
+    for _ in range(iterations):
+      labels = np.argmax(data @ centroids.T, axis=1)
+      for c in range(k):
+        members = data[labels == c]
+        if len(members):
+          centroid = members.mean(axis=0)
+          centroids[c] = centroid / (np.linalg.norm(centroid) or 1.0)
+
+    labels = np.argmax(data @ centroids.T, axis=1)
+
+    self.centroids = centroids
+    self.assignments = [np.flatnonzero(labels == c) for c in range(k)]
+    self.indexed_count = n
+
+  def candidates(self, query):
+    """
+    Row numbers to score: everything, or only the rows in the nprobe
+    partitions whose centroids are closest to the query
+    """
+    np = self.np
+    n = len(self.ids)
+
+    if self.partitions <= 0 or n < self.partitions * self.min_partition_size:
+      return None
+
+    if self.centroids is None or n > 2 * self.indexed_count:
+      self.build_partitions()
+
+    nearest = np.argsort(-(self.centroids @ query))[:self.nprobe]
+    return np.concatenate([self.assignments[c] for c in nearest])
+
+  def search(self, image_bytes, threshold, max_faces, collection_id=None):
+    np = self.np
+
+    with requestlog.span("embed"):
+      query = self.embedder.embed(image_bytes)
+    query = query / np.linalg.norm(query)
+
+    with self.lock, requestlog.span("vector_search"):
+      n = len(self.ids)
+      if n == 0:
+        return []
+
+      rows = self.candidates(query)
+      if rows is None:
+        scores = self.matrix[:n] @ query
+        rows = np.arange(n)
+      else:
+        scores = self.matrix[rows] @ query
+
+    k = min(max_faces, len(rows))
+    top = np.argpartition(-scores, k - 1)[:k]
+    top = top[np.argsort(-scores[top])]
+
+    matches = []
+    for i in top:
+      similarity = float(max(0.0, scores[i])) * 100.0
+      if similarity < threshold:
+        break
+      matches.append({'Face': {'FaceId': self.ids[int(rows[i])]}, 'Similarity': similarity})
+
+    return matches
+
+  def detect_faces(self, image_bytes):
+    #
+    # embedders work on whole images, so the image is treated as one face
+    #
+    return [{'Left': 0.0, 'Top': 0.0, 'Width': 1.0, 'Height': 1.0}]
+
+
+def from_config(configur, rekognition=None):
+  """
+  Builds the matcher named by the optional [matcher] section of the config:
+
+    [matcher]
+    backend = rekognition       (or local)
+    collection_id = database-faces
+    index_path = /tmp/faces     (local only)
+    embedder = matchers:StubEmbedder
+    dim = 128
+    partitions = 0
+    nprobe = 4
+  """
+  section = 'matcher'
+  backend = configur.get(section, 'backend', fallback='rekognition')
+
+  if backend == 'rekognition':
+    return RekognitionMatcher(rekognition,
+                              configur.get(section, 'collection_id', fallback='database-faces'))
+
+  if backend == 'local':
+    dim = configur.getint(section, 'dim', fallback=128)
+    embedder = load_embedder(configur.get(section, 'embedder', fallback='matchers:StubEmbedder'), dim)
+    return LocalVectorMatcher(
+      configur.get(section, 'index_path', fallback='/tmp/faces'),
+      embedder,
+      partitions=configur.getint(section, 'partitions', fallback=0),
+      nprobe=configur.getint(section, 'nprobe', fallback=4))
+
+  raise Exception("unknown matcher backend '" + backend + "'")
@@ -0,0 +1,114 @@
+#
+# Content-addressed image storage in S3.
+#
+# Images are stored under the SHA-256 of their bytes plus the extension,
+# e.g. 9f86d081...0f00a08.jpeg, instead of the client's filename, so
+#
+#   - two people with the same name no longer overwrite each other's image
+#   - re-submitting the same image (client retries, kiosks sending the same
+#     frame) does not upload or store it again: a HEAD request finds the
+#     existing object and the PUT is skipped
+#
+# Keys known to exist are remembered for the life of the container, so a
+# repeated image costs neither the HEAD nor the PUT. Objects are never
+# overwritten with different bytes, because the key is derived from them.
+#
+import hashlib
+import threading
+
+from collections import OrderedDict
+
+#
+# most keys remembered as already stored, per container:
+#
+known_keys_limit = 10000
+
+content_types = {
+  ".jpeg": "image/jpeg",
+  ".jpg": "image/jpeg",
+  ".png": "image/png"
+}
+
+_known = OrderedDict()
+_lock = threading.Lock()
+
+uploads = 0
+skipped = 0
+
+
+def content_hash(bytes):
+  return hashlib.sha256(bytes).hexdigest()
+
+
+def content_key(digest, extension):
+  """
+  Returns the bucket key for an image with the given SHA-256 hex digest
+  """
+  extension = extension.lower()
+  return digest + (".jpeg" if extension == ".jpg" else extension)
+
+
+def content_type(extension):
+  return content_types.get(extension.lower(), "application/octet-stream")
+
+
+def remember(key):
+  with _lock:
+    _known[key] = True
+    _known.move_to_end(key)
+    while len(_known) > known_keys_limit:
+      _known.popitem(last=False)
+
+
+def is_known(key):
+  with _lock:
+    return key in _known
+
+
+def exists(s3, bucketname, key):
+  """
+  True if the object is already in the bucket (HEAD request)
+  """
+  from botocore.exceptions import ClientError
+
+  try:
+    s3.head_object(Bucket=bucketname, Key=key)
+    return True
+  except ClientError as err:
+    if err.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound"):
+      return False
+    raise
+
+
+def put_if_absent(s3, bucketname, key, bytes, extension):
+  """
+  Uploads the image unless an object with this key already exists
+
+  Returns
+  -------
+  True if the image was uploaded, False if it was already stored
+  """
+  global uploads, skipped
+
+  if is_known(key) or exists(s3, bucketname, key):
+    remember(key)
+    with _lock:
+      skipped += 1
+    return False
+
+  s3.put_object(
+    Bucket=bucketname,
+    Key=key,
+    Body=bytes,
+    ACL='public-read',
+    ContentType=content_type(extension))
+
+  remember(key)
+  with _lock:
+    uploads += 1
+  return True
+
+
+def stats():
+  with _lock:
+    return {"uploads": uploads, "skipped": skipped, "known_keys": len(_known)}
@@ -0,0 +1,147 @@
+#
+# Client-side image preprocessing before upload.
+#
+# Phone photos are often several megapixels, far more than Rekognition
+# needs to match a face. Shrinking the longest edge and recompressing as
+# JPEG (optionally after cropping to the detected face) cuts upload bytes
+# and Rekognition processing time.
+#
+# Pillow is required; OpenCV is only needed when crop_face is on. Both are
+# imported on first use so the rest of the client does not pay for them.
+#
+import io
+import time
+import pathlib
+
+
+class Preprocessor:
+
+  def __init__(self, enabled=True, max_edge=1024, jpeg_quality=85, crop_face=False, face_margin=0.4):
+    self.enabled = enabled
+    self.max_edge = max_edge          # longest edge in pixels after resizing
+    self.jpeg_quality = jpeg_quality  # 1..95
+    self.crop_face = crop_face        # crop to the largest detected face
+    self.face_margin = face_margin    # extra context around the face, as a fraction of its size
+
+  def process(self, filename, bytes):
+    """
+    Downscales / recompresses an image
+
+    Parameters
+    ----------
+    filename: original filename (the extension may change to .jpeg)
+    bytes: original image bytes
+
+    Returns
+    -------
+    (filename, bytes, report) where report is a dictionary with the byte
+    counts before and after and the time spent preprocessing. If the
+    result would not be smaller, the original filename and bytes are
+    returned unchanged.
+    """
+    report = {
+      "original_bytes": len(bytes),
+      "processed_bytes": len(bytes),
+      "bytes_saved": 0,
+      "preprocess_ms": 0.0,
+      "cropped": False
+    }
+
+    if not self.enabled:
+      return filename, bytes, report
+
+    from PIL import Image, ImageOps
+
+    start = time.perf_counter()
+
+    image = Image.open(io.BytesIO(bytes))
+    image = ImageOps.exif_transpose(image)  # phone photos are often rotated via EXIF
+
+    if self.crop_face:
+      box = self.find_face(image)
+      if box is not None:
+        image = image.crop(box)
+        report["cropped"] = True
+
+    if max(image.size) > self.max_edge:
+      image.thumbnail((self.max_edge, self.max_edge), Image.LANCZOS)
+
+    if image.mode != "RGB":
+      image = image.convert("RGB")
+
+    out = io.BytesIO()
+    image.save(out, format="JPEG", quality=self.jpeg_quality, optimize=True)
+    processed = out.getvalue()
+
+    report["preprocess_ms"] = (time.perf_counter() - start) * 1000
+
+    if len(processed) >= len(bytes) and not report["cropped"]:
+      return filename, bytes, report
+
+    report["processed_bytes"] = len(processed)
+    report["bytes_saved"] = len(bytes) - len(processed)
+
+    new_filename = str(pathlib.Path(filename).with_suffix(".jpeg"))
+
+    return new_filename, processed, report
+
+  def find_face(self, image):
+    """
+    Returns the (left, top, right, bottom) crop box around the largest
+    face found by OpenCV's frontal-face Haar cascade, or None
+    """
+    import cv2
+    import numpy
+
+    gray = numpy.asarray(image.convert("L"))
+
+    cascade = cv2.CascadeClassifier(cv2.data.haarcascades + "haarcascade_frontalface_default.xml")
+    faces = cascade.detectMultiScale(gray, scaleFactor=1.1, minNeighbors=5)
+
+    if len(faces) == 0:
+      return None
+
+    x, y, w, h = max(faces, key=lambda f: f[2] * f[3])
+
+    dx = int(w * self.face_margin)
+    dy = int(h * self.face_margin)
+
+    left = max(0, x - dx)
+    top = max(0, y - dy)
+    right = min(image.width, x + w + dx)
+    bottom = min(image.height, y + h + dy)
+
+    return (left, top, right, bottom)
+
+
+def from_config(configur):
+  """
+  Builds a Preprocessor from the optional [preprocess] section of the
+  client config, e.g.
+
+    [preprocess]
+    enabled = true
+    max_edge = 1024
+    jpeg_quality = 85
+    crop_face = false
+  """
+  section = 'preprocess'
+
+  return Preprocessor(
+    enabled=configur.getboolean(section, 'enabled', fallback=True),
+    max_edge=configur.getint(section, 'max_edge', fallback=1024),
+    jpeg_quality=configur.getint(section, 'jpeg_quality', fallback=85),
+    crop_face=configur.getboolean(section, 'crop_face', fallback=False),
+    face_margin=configur.getfloat(section, 'face_margin', fallback=0.4))
+
+
+def print_report(report, request_ms):
+  """
+  Prints the preprocessing report together with the request latency
+  """
+  print("  bytes:", report["original_bytes"], "->", report["processed_bytes"],
+        "(saved %d)" % report["bytes_saved"])
+  if report["cropped"]:
+    print("  cropped to detected face")
+  print("  preprocess: %.1f ms, request: %.1f ms, total: %.1f ms"
+        % (report["preprocess_ms"], request_ms, report["preprocess_ms"] + request_ms))
@@ -0,0 +1,300 @@
+#
+# Reconciles the Rekognition collection with the faces table.
+#
+# Run from a directory containing the lambdas' config.ini:
+#
+#   python reconcile.py [--report FILE] [--purge-orphans] [--delete-dangling]
+#
+# With sharded collections (see shards) every collection is reconciled
+# with the rows recorded as being in it; rows from before sharding belong
+# to the [matcher] collection_id.
+#
+# Both sides are streamed in face id order and merge-joined, so neither is
+# loaded into memory: list_faces page by page, and the table through a
+# server-side cursor ordered by rekognitionid (which is indexed). Every
+# face id ends up as one of
+#
+#   matched:   in the collection and in the table
+#   orphan:    in the collection only (e.g. indexed, then the insert failed);
+#              it bloats the collection and can never be authenticated
+#   dangling:  in the table only (its face was deleted from the
+#              collection); the person has to be registered again
+#   duplicate: an extra row for a face id that already has a row
+#
+# Orphans and dangling rows are written to the report as JSON lines.
+# --purge-orphans deletes orphans from the collection with batched
+# delete_faces calls once the scan is done; each batch is checked against
+# the table once more first, so a registration that finished in the
+# meantime is not purged. --delete-dangling deletes the dangling rows.
+#
+# list_faces is expected to return faces in FaceId order; the job stops
+# with an error if either side is ever out of order, rather than report
+# wrong results.
+#
+import sys
+import json
+import argparse
+import tempfile
+
+import lambda_init
+import resultcache
+
+#
+# most face ids per delete_faces call (the API limit is 4096):
+#
+delete_batch_size = 1000
+
+
+def collection_faces(rekognition, collection_id, page_size=1000):
+  """
+  Yields the FaceId of every face in the collection, one page at a time
+  """
+  token = None
+
+  while True:
+    kwargs = {"CollectionId": collection_id, "MaxResults": page_size}
+    if token:
+      kwargs["NextToken"] = token
+
+    try:
+      response = rekognition.list_faces(**kwargs)
+    except Exception as err:
+      code = getattr(err, "response", {}).get("Error", {}).get("Code")
+      if token is None and code == "ResourceNotFoundException":
+        return  # a shard that never had a face
+      raise
+
+    for face in response["Faces"]:
+      yield face["FaceId"]
+
+    token = response.get("NextToken")
+    if not token:
+      return
+
+
+def table_faces(db, batch_size=1000, collection_id=None, legacy=False):
+  """
+  Yields (rekognitionid, entryid) in rekognitionid order for every row, or
+  with collection_id only for the rows in that collection (legacy: plus
+  the rows from before sharding, which have no collectionid)
+  """
+  if collection_id is None:
+    sql = "SELECT rekognitionid, entryid FROM faces ORDER BY rekognitionid, entryid;"
+    parameters = []
+  else:
+    sql = """
+      SELECT rekognitionid, entryid FROM faces
+      WHERE collectionid = %s""" + (" OR collectionid IS NULL" if legacy else "") + """
+      ORDER BY rekognitionid, entryid;
+      """
+    parameters = [collection_id]
+
+  for row in db.iter_rows(sql, parameters, batch_size):
+    yield row[0], row[1]
+
+
+def in_order(items, name, key=lambda item: item):
+  """
+  Passes items through, raising if they are not sorted by key
+  """
+  previous = None
+  for item in items:
+    value = key(item)
+    if previous is not None and value < previous:
+      raise Exception(name + " is not in face id order ('" + value + "' after '" +
+                      previous + "'), cannot merge")
+    previous = value
+    yield item
+
+
+def merge(faces, rows):
+  """
+  Merge-joins the sorted face ids with the sorted (rekognitionid, entryid)
+  rows
+
+  Yields
+  ------
+  (kind, face id, entryid or None) with kind one of "matched", "orphan",
+  "dangling" or "duplicate"
+  """
+  face = next(faces, None)
+  row = next(rows, None)
+  matched = None  # face id of the last match, to spot duplicate rows
+
+  while face is not None or row is not None:
+    if row is not None and row[0] == matched:
+      yield "duplicate", row[0], row[1]
+      row = next(rows, None)
+    elif row is None or (face is not None and face < row[0]):
+      yield "orphan", face, None
+      face = next(faces, None)
+    elif face is None or row[0] < face:
+      yield "dangling", row[0], row[1]
+      row = next(rows, None)
+    else:
+      yield "matched", face, row[1]
+      matched = face
+      face = next(faces, None)
+      row = next(rows, None)
+
+
+class Spool:
+  """
+  Holds ids found during the scan in a temporary file and hands them back
+  in batches afterwards, so a huge backlog does not have to fit in memory
+  and nothing is deleted while list_faces / the cursor are still paging
+  """
+
+  def __init__(self, batch_size=delete_batch_size):
+    self.batch_size = batch_size
+    self.file = tempfile.TemporaryFile("w+")
+
+  def add(self, value):
+    self.file.write(json.dumps(value) + "\n")
+
+  def batches(self):
+    self.file.seek(0)
+    batch = []
+    for line in self.file:
+      batch.append(json.loads(line))
+      if len(batch) >= self.batch_size:
+        yield batch
+        batch = []
+    if batch:
+      yield batch
+    self.file.close()
+
+
+def purge_faces(rekognition, db, collection_id, spool):
+  """
+  Deletes the spooled orphan face ids with batched delete_faces calls,
+  after checking once more that no row has appeared for them
+
+  Returns
+  -------
+  (faces deleted, faces kept because they are registered after all)
+  """
+  deleted = 0
+  kept = 0
+
+  for batch in spool.batches():
+    rows = db.retrieve_in("SELECT rekognitionid FROM faces WHERE rekognitionid IN ({in});", batch)
+    registered = {row[0] for row in rows}
+    batch = [face_id for face_id in batch if face_id not in registered]
+    kept += len(registered)
+
+    if batch:
+      response = rekognition.delete_faces(CollectionId=collection_id, FaceIds=batch)
+      deleted += len(response["DeletedFaces"])
+      print("**deleted", len(response["DeletedFaces"]), "orphans from", collection_id, "**")
+
+  return deleted, kept
+
+
+def delete_rows(db, spool):
+  """
+  Deletes the spooled entry ids from the faces table; returns the count
+  """
+  deleted = 0
+
+  for batch in spool.batches():
+    sql = "DELETE FROM faces WHERE entryid IN (" + ", ".join(["%s"] * len(batch)) + ");"
+    deleted += db.perform_action(sql, batch)
+
+  #
+  # cached authentications may return the deleted rows:
+  #
+  if deleted:
+    resultcache.rows_changed(db)
+
+  return deleted
+
+
+def reconcile(collection_id, report=None, purge_orphans=False, delete_dangling=False, page_size=1000,
+              sharded=False, legacy=False):
+  """
+  Streams the collection and the table (or with sharded, the table's rows
+  in this collection) through the merge join
+
+  Parameters
+  ----------
+  collection_id: Rekognition collection to reconcile
+  report: optional writable text stream for one JSON line per orphan /
+          dangling / duplicate
+  purge_orphans: delete orphan faces from the collection
+  delete_dangling: delete rows whose face is not in the collection
+  page_size: list_faces page size and cursor fetch size
+  sharded: compare only with the rows in this collection
+  legacy: this is the collection from before sharding
+
+  Returns
+  -------
+  dictionary of counts
+  """
+  db = lambda_init.get_db()
+  rekognition = lambda_init.get_rekognition()
+
+  counts = {"matched": 0, "orphan": 0, "dangling": 0, "duplicate": 0}
+
+  orphans = Spool() if purge_orphans else None
+  dangling = Spool() if delete_dangling else None
+
+  faces = in_order(collection_faces(rekognition, collection_id, page_size), "list_faces")
+  rows = in_order(table_faces(db, page_size, collection_id if sharded else None, legacy),
+                  "faces table", key=lambda row: row[0])
+
+  for kind, face_id, entryid in merge(faces, rows):
+    counts[kind] += 1
+
+    if kind == "matched":
+      continue
+
+    if report is not None:
+      report.write(json.dumps({"kind": kind, "collection": collection_id,
+                               "faceid": face_id, "entryid": entryid}) + "\n")
+
+    if kind == "orphan" and orphans is not None:
+      orphans.add(face_id)
+    elif kind == "dangling" and dangling is not None:
+      dangling.add(entryid)
+
+  if orphans is not None:
+    counts["orphans_deleted"], counts["orphans_kept"] = \
+      purge_faces(rekognition, db, collection_id, orphans)
+
+  if dangling is not None:
+    counts["dangling_deleted"] = delete_rows(db, dangling)
+
+  return counts
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Reconcile the Rekognition collection with the faces table")
+  parser.add_argument("--report", help="JSON-lines file for orphans / dangling rows (default stdout)")
+  parser.add_argument("--purge-orphans", action="store_true", help="delete orphan faces from the collection")
+  parser.add_argument("--delete-dangling", action="store_true", help="delete rows whose face is gone")
+  parser.add_argument("--page-size", type=int, default=1000)
+  args = parser.parse_args()
+
+  import shards
+
+  legacy_collection = lambda_init.get_config().get('matcher', 'collection_id', fallback='database-faces')
+
+  matcher = lambda_init.get_matcher()
+  sharded = isinstance(matcher, shards.ShardedMatcher)
+
+  collections = [legacy_collection]
+  if sharded:
+    collections = matcher.shard_map.collections()
+    if legacy_collection not in collections:
+      collections.append(legacy_collection)
+
+  report = open(args.report, "w") if args.report else sys.stdout
+  try:
+    for collection_id in collections:
+      counts = reconcile(collection_id, report, args.purge_orphans, args.delete_dangling, args.page_size,
+                         sharded, collection_id == legacy_collection)
+      print("**DONE**", collection_id, counts)
+  finally:
+    if report is not sys.stdout:
+      report.close()
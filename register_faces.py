@@ -1,162 +1,125 @@
 import json
-import boto3
-import os
-import uuid
-import base64
+import shards
 import pathlib
-import datatier
-
-from configparser import ConfigParser
-
+import governor
+import lambda_init
+import requestlog
+import imagerequest
+import objectstore
+import resultcache
+import attributestore
+
+def person_name(basename):
+  """
+  (first name, last name) from a FIRSTNAME_LASTNAME filename stem; split
+  at the first "_", so a last name may contain more (Ann_Van_Der_Berg)
+  """
+  first_name, _, last_name = basename.partition('_')
+  if not first_name or not last_name:
+    raise Exception("expecting filename of the form FIRSTNAME_LASTNAME.EXT")
+  return first_name, last_name
+
+
+@requestlog.handler("register_faces")
 def lambda_handler(event, context):
   try: 
-    print("**STARTING REGISTRATION**")
-    print("PRINTING EVENT:\n", event)
-
-    config_file = 'config.ini'
-    os.environ['AWS_SHARED_CREDENTIALS_FILE'] = config_file
-
-    configur = ConfigParser()
-    configur.read(config_file)
-
-    s3_profile = 's3readwrite+rekognition'
-    boto3.setup_default_session(profile_name=s3_profile)
-
-    bucketname = configur.get('s3', 'bucket_name')
-
-    s3 = boto3.resource('s3')
-    bucket = s3.Bucket(bucketname)
-
-    print("**Accessing request body**")
-
-    if "body" not in event:
-      raise Exception("event has no body")
-
-    body = json.loads(event["body"]) # parse the json
-
-    if "filename" not in body:
-      raise Exception("event has a body but no filename")
-    if "data" not in body:
-      raise Exception("event has a body but no data")
-
-    filename = body["filename"]
-    datastr = body["data"]
-
-    print("filename:", filename)
-    print("datastr (first 10 chars):", datastr[0:10])
-
-    base64_bytes = datastr.encode()        # string -> base64 bytes
-    bytes = base64.b64decode(base64_bytes) # base64 bytes -> raw bytes
-
     #
-    # write raw bytes to local filesystem for upload:
+    # config, clients and db connection are cached across warm invocations:
     #
-    print("**Writing local data file**")
+    bucket, s3, matcher, db = lambda_init.timed_setup(
+      "register_faces",
+      lambda_init.get_bucket,
+      lambda_init.get_s3,
+      lambda_init.get_matcher,
+      lambda_init.get_db)
 
-    local_filename = "/tmp/data.pdf"
+    bucketname = bucket.name
 
-    outfile = open(local_filename, "wb")
-    outfile.write(bytes)
-    outfile.close()
+    filename, bytes, body = imagerequest.parse_image_request(event)
 
     #
-    # generate unique filename in preparation for the S3 upload:
+    # check the name before anything is uploaded or indexed:
     #
-    print("**Uploading local file to S3**")
-
-    basename = pathlib.Path(filename).stem
-    extension = pathlib.Path(filename).suffix
-    print("basename:", basename)
-    print("extension:", extension)
-
-    if extension != ".jpeg" and extension != "png": 
-        raise Exception("expecting filename to have .jpeg or .png extension")
-
-
-    print("S3 bucketkey:", filename)
+    first_name, last_name = person_name(pathlib.Path(filename).stem)
+    extension = imagerequest.check_image(filename, bytes)
 
     #
-    # finally, upload to S3:
+    # the image is stored under the hash of its bytes, so people with the
+    # same name cannot overwrite each other and re-registering the same
+    # image does not upload it again:
     #
-    print("**Uploading data file to S3**")
-
-    bucket.upload_file(local_filename, 
-                       filename, 
-                       ExtraArgs={
-                         'ACL': 'public-read',
-                         'ContentType': 'application/'+extension
-                       })
+    imagehash = objectstore.content_hash(bytes)
+    object_key = objectstore.content_key(imagehash, extension)
 
     #
-    # respond in an HTTP-like way, i.e. with a status
-    # code and body in JSON format:
+    # with sharded collections, the face goes to its shard key's
+    # collection, or by image hash when there is no key:
     #
-    print("**DONE UPLOADING TO S3 REGISTRATION BUCKET**")
-
-    s3 = boto3.client('s3')
-    print("This is the bucket:", bucketname)
-    object_key = filename
-    print("This is the key:", object_key)
-
-    #
-    # configure for RDS access
-    #
-    rds_endpoint = configur.get('rds', 'endpoint')
-    rds_portnum = int(configur.get('rds', 'port_number'))
-    rds_username = configur.get('rds', 'user_name')
-    rds_pwd = configur.get('rds', 'user_pwd')
-    rds_dbname = configur.get('rds', 'db_name')
-
-    #configure for rekognition access
-    rekognition = boto3.client('rekognition', region_name='us-east-2')
+    shard_key = shards.shard_key(body)
+    collection_id = matcher.route(shard_key, imagehash)
 
     try:
-      response = rekognition.index_faces(
-        Image=
-          {'S3Object':
-            {
-              'Bucket': bucketname,
-              'Name': object_key
-            }
-          },
-        CollectionId= "database-faces"
-      )
-      print("HERE'S THE RESPONSE: ", response)
-      if response['ResponseMetadata']['HTTPStatusCode'] == 200:
-        face_id = response['FaceRecords'][0]['Face']['FaceId']
-        name = object_key.split('.')[0].split('_')
-        first_name = name[0]
-        last_name = name[1]
-
-        print("**Opening connection**")
-
-        dbConn = datatier.get_dbConn(rds_endpoint, rds_portnum, rds_username, rds_pwd, rds_dbname)
-
-        sql = """
-          INSERT INTO 
-          faces(firstname, lastname, rekognitionid)
-           values(%s, %s, %s);
-          """
-        datatier.perform_action(dbConn, sql, [first_name, last_name, face_id])
-
-      print("last print statement before returning")
+      #
+      # upload to S3 and index the same in-memory bytes concurrently;
+      # the DB insert waits for both:
+      #
+      upload = lambda_init.get_executor().submit(
+        requestlog.timed("s3", objectstore.put_if_absent),
+        s3, bucketname, object_key, bytes, extension)
+
+      try:
+        face_id, face_detail = matcher.index_face(bytes, collection_id)
+      except Exception:
+        #
+        # the container is frozen once we return, so let the upload
+        # finish before failing (exception() waits without raising):
+        #
+        upload.exception()
+        raise
+
+      with requestlog.span("s3_wait"):
+        uploaded = upload.result()
+      requestlog.debug("stored image", bucket=bucketname, key=object_key, uploaded=uploaded)
+
+      #
+      # index_faces already returned gender / age / emotions, store them
+      # so face_attributes never has to call Rekognition again:
+      #
+      attributes = attributestore.summarize(face_detail)
+
+      sql = """
+        INSERT INTO 
+        faces(firstname, lastname, rekognitionid, bucketkey, imagehash, attributes,
+              shardkey, collectionid)
+         values(%s, %s, %s, %s, %s, %s, %s, %s);
+        """
+      db.perform_action(sql, [first_name, last_name, face_id, object_key, imagehash,
+                              attributestore.encode(attributes), shard_key, collection_id])
+      requestlog.info("registered face", rekognitionid=face_id, key=object_key,
+                      collection=collection_id)
+
+      #
+      # cached "no match" outcomes may now match the new face:
+      #
+      resultcache.invalidate_unmatched()
+
       return {
         "statusCode": 200, 
         "body": json.dumps("Successful Registration!")
       }
 
     except Exception as e:
+      requestlog.error("registration failed", error=str(e))
       return {
-      "statusCode": 400,
+      "statusCode": governor.error_status(e),
       "body": json.dumps(str(e))
     }
       # print('Error processing employee image {} from bucket {}.'.format(object_key, bucketname))
       # raise e
 
   except Exception as err:
-    print("**ERROR**")
-    print(str(err))
+    requestlog.error("registration failed", error=str(err))
     return {
-      "statusCode": 400,
+      "statusCode": governor.error_status(err),
       "body": json.dumps(str(err))
     }
\ No newline at end of file
@@ -0,0 +1,276 @@
+#
+# Structured logging and per-stage timing for the lambda handlers.
+#
+# Every log line is one JSON object carrying the handler name and the
+# request id, so CloudWatch Logs Insights can filter and aggregate on
+# them. LOG_LEVEL (DEBUG, INFO, WARNING, ...; default INFO) sets how much
+# is written. Request payloads are never logged, only their sizes.
+#
+# A handler wrapped with @requestlog.handler("name") logs one summary line
+# per invocation with its status, duration and the time spent in each
+# stage. Code marks a stage with
+#
+#   with requestlog.span("rekognition"):
+#     ...
+#
+# Spans add up the time of every call in a stage, so stages whose calls
+# run concurrently (e.g. group-photo searches) can add up to more than
+# the request's wall-clock time.
+#
+# Profiling: with PROFILE_SAMPLE_RATE set (0..1), that share of
+# invocations run under cProfile and log their PROFILE_TOP (default 25)
+# most expensive functions; with PROFILE_DIR set the raw profile is also
+# saved there (e.g. /tmp) for snakeviz / pstats.
+#
+import os
+import sys
+import json
+import time
+import uuid
+import random
+import logging
+import threading
+import functools
+
+from contextlib import contextmanager
+
+log = logging.getLogger("facialrecognition")
+
+_configured = False
+_current = None          # the running Invocation (one per container at a time)
+last_invocation = None   # the most recent finished Invocation
+_metrics = {}            # name -> function returning a dictionary, see add_metrics
+
+
+class JsonFormatter(logging.Formatter):
+
+  def format(self, record):
+    entry = {
+      "ts": round(record.created, 3),
+      "level": record.levelname,
+      "msg": record.getMessage()
+    }
+
+    invocation = _current
+    if invocation is not None:
+      entry["function"] = invocation.name
+      entry["request_id"] = invocation.request_id
+
+    entry.update(getattr(record, "fields", {}))
+
+    if record.exc_info:
+      entry["exception"] = self.formatException(record.exc_info)
+
+    return json.dumps(entry, default=str)
+
+
+class StdoutHandler(logging.Handler):
+  """
+  Writes to whatever sys.stdout is at the time, so callers that redirect
+  stdout (e.g. benchmark.py) also capture the log
+  """
+
+  def emit(self, record):
+    try:
+      sys.stdout.write(self.format(record) + "\n")
+    except Exception:
+      self.handleError(record)
+
+
+def configure():
+  """
+  Installs the JSON handler on the app's logger (once per container)
+  """
+  global _configured
+
+  if _configured:
+    return
+
+  handler = StdoutHandler()
+  handler.setFormatter(JsonFormatter())
+
+  log.handlers = [handler]
+  log.propagate = False  # the Lambda runtime's root handler would log it again
+  log.setLevel(os.environ.get("LOG_LEVEL", "INFO").upper())
+
+  _configured = True
+
+
+def debug(msg, **fields):
+  log.debug(msg, extra={"fields": fields})
+
+
+def info(msg, **fields):
+  log.info(msg, extra={"fields": fields})
+
+
+def warning(msg, **fields):
+  log.warning(msg, extra={"fields": fields})
+
+
+def error(msg, **fields):
+  log.error(msg, extra={"fields": fields})
+
+
+###################################################################
+#
+# invocations and spans
+#
+class Invocation:
+
+  def __init__(self, name, request_id):
+    self.name = name
+    self.request_id = request_id
+    self.spans = {}   # stage -> [total ms, calls]
+    self.fields = {}
+    self.lock = threading.Lock()
+
+  def add(self, stage, ms):
+    with self.lock:
+      span = self.spans.setdefault(stage, [0.0, 0])
+      span[0] += ms
+      span[1] += 1
+
+  def span_summary(self):
+    with self.lock:
+      return {stage: {"ms": round(total, 2), "calls": calls}
+              for stage, (total, calls) in self.spans.items()}
+
+
+@contextmanager
+def span(stage):
+  """
+  Adds the time spent in the enclosed block to the current invocation's
+  stage; a no-op outside an invocation (scripts, tests)
+  """
+  invocation = _current
+  t0 = time.perf_counter()
+  try:
+    yield
+  finally:
+    if invocation is not None:
+      invocation.add(stage, (time.perf_counter() - t0) * 1000)
+
+
+def timed(stage, function):
+  """
+  Wraps function so each call is recorded as a span, e.g. for calls
+  handed to the thread pool
+  """
+  @functools.wraps(function)
+  def wrapper(*args, **kwargs):
+    with span(stage):
+      return function(*args, **kwargs)
+  return wrapper
+
+
+def annotate(**fields):
+  """
+  Adds fields to the current invocation's summary line
+  """
+  invocation = _current
+  if invocation is not None:
+    invocation.fields.update(fields)
+
+
+def add_metrics(name, function):
+  """
+  Adds function()'s result (e.g. a governor's counters) to every request
+  summary line under name
+  """
+  _metrics[name] = function
+
+
+def request_id(event, context):
+  rid = getattr(context, "aws_request_id", None)
+  if rid:
+    return rid
+  request_context = (event or {}).get("requestContext") or {}
+  return request_context.get("requestId") or str(uuid.uuid4())
+
+
+###################################################################
+#
+# profiling
+#
+def profile_sampled():
+  rate = float(os.environ.get("PROFILE_SAMPLE_RATE") or 0)
+  return rate > 0 and random.random() < rate
+
+
+def log_profile(profiler, invocation):
+  import pstats
+
+  stats = pstats.Stats(profiler)
+  top = int(os.environ.get("PROFILE_TOP") or 25)
+
+  rows = sorted(stats.stats.items(), key=lambda item: item[1][3], reverse=True)[:top]
+  functions = [{
+    "function": "%s:%d(%s)" % (filename, line, name),
+    "calls": calls,
+    "own_ms": round(own * 1000, 3),
+    "cumulative_ms": round(cumulative * 1000, 3)
+  } for (filename, line, name), (_, calls, own, cumulative, _) in rows]
+
+  info("profile", functions=functions)
+
+  directory = os.environ.get("PROFILE_DIR")
+  if directory:
+    path = os.path.join(directory, invocation.name + "-" + invocation.request_id + ".prof")
+    stats.dump_stats(path)
+    info("profile saved", path=path)
+
+
+###################################################################
+#
+# handler wrapper
+#
+def handler(name):
+  """
+  Decorator for a lambda_handler: sets up logging, tracks the request id
+  and stage spans, optionally profiles, and logs one summary line
+  """
+  def decorate(lambda_handler):
+
+    @functools.wraps(lambda_handler)
+    def wrapper(event, context):
+      global _current, last_invocation
+
+      configure()
+
+      invocation = Invocation(name, request_id(event, context))
+      _current = invocation
+
+      profiler = None
+      if profile_sampled():
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+      t0 = time.perf_counter()
+      status = None
+      try:
+        response = lambda_handler(event, context)
+        status = response.get("statusCode") if isinstance(response, dict) else None
+        return response
+      finally:
+        duration = (time.perf_counter() - t0) * 1000
+
+        if profiler is not None:
+          profiler.disable()
+          try:
+            log_profile(profiler, invocation)
+          except Exception as err:
+            warning("profile failed", error=str(err))
+
+        metrics = {metric: report() for metric, report in _metrics.items()}
+
+        info("request done", status=status, duration_ms=round(duration, 2),
+             spans=invocation.span_summary(), **invocation.fields, **metrics)
+
+        last_invocation = invocation
+        _current = None
+
+    return wrapper
+
+  return decorate
@@ -0,0 +1,225 @@
+#
+# Authentication result cache, kept in the warm lambda container.
+#
+# Entries are keyed by the SHA-256 of the image bytes (the digest that
+# objectstore also uses as the image's S3 key). Optionally a 64-bit
+# difference hash (dHash) of the image is kept too, so that a frame that is
+# only slightly different from a cached one (re-encoded, a pixel of noise)
+# is also a hit when the Hamming distance between the hashes is small.
+#
+# Both outcomes are cached: the matched registered row, and "no match".
+# Eviction is LRU with a size bound plus a TTL.
+#
+# Invalidation: the generation is the highest entryid in the faces table
+# plus the face_changes counter. When a new face has been registered,
+# "no match" outcomes are dropped because the new face may now match
+# them; matched outcomes stay, since registering someone else does not
+# change who this image already matched. Tools that update or delete rows
+# (shards.py rebalance, reconcile.py --delete-dangling) call rows_changed(),
+# which bumps the counter, and then every outcome is dropped: a cached
+# row may have been moved or deleted. Registrations in the same container
+# call invalidate_unmatched() directly. The generation is read from the
+# database at most every generation_seconds (refresh_generation), so a
+# cache hit is answered from memory; a change made elsewhere reaches this
+# cache within that time.
+#
+import time
+import threading
+
+from collections import OrderedDict
+
+no_match = "NO_MATCH"
+
+
+class ResultCache:
+
+  def __init__(self, max_entries=1024, ttl_seconds=300, phash_distance=0, generation_seconds=5):
+    self.max_entries = max_entries
+    self.ttl_seconds = ttl_seconds
+    self.phash_distance = phash_distance  # 0 => exact hash only
+    self.generation_seconds = generation_seconds  # most staleness of self.generation
+
+    self.entries = OrderedDict()  # sha256 -> (expires, generation, phash, outcome)
+    self.generation = None
+    self.generation_read = None  # time.monotonic() of the last read
+    self.lock = threading.Lock()
+
+    self.hits = 0
+    self.near_hits = 0
+    self.misses = 0
+    self.evictions = 0
+    self.invalidations = 0
+
+  def get(self, digest, phash=None):
+    """
+    Returns the cached outcome (a row, or no_match) or None on a miss
+    """
+    now = time.time()
+
+    with self.lock:
+      entry = self.entries.get(digest)
+
+      if entry is not None and entry[0] < now:
+        del self.entries[digest]
+        self.evictions += 1
+        entry = None
+
+      if entry is not None:
+        self.entries.move_to_end(digest)
+        self.hits += 1
+        return entry[3]
+
+      if phash is not None and self.phash_distance > 0:
+        for key, (expires, generation, other, outcome) in reversed(self.entries.items()):
+          if other is None or expires < now:
+            continue
+          if hamming(phash, other) <= self.phash_distance:
+            self.entries.move_to_end(key)
+            self.near_hits += 1
+            return outcome
+
+      self.misses += 1
+      return None
+
+  def put(self, digest, outcome, phash=None):
+    with self.lock:
+      self.entries[digest] = (time.time() + self.ttl_seconds, self.generation, phash, outcome)
+      self.entries.move_to_end(digest)
+
+      while len(self.entries) > self.max_entries:
+        self.entries.popitem(last=False)
+        self.evictions += 1
+
+  def set_generation(self, generation):
+    """
+    Records the current generation, (highest entryid, changes): a new
+    registration drops the "no match" outcomes, changed or deleted rows
+    drop every outcome
+    """
+    with self.lock:
+      previous = self.generation
+      self.generation = generation
+
+    if previous is None or generation == previous:
+      return
+
+    if generation[1] != previous[1]:
+      self.clear()
+    else:
+      self.invalidate_unmatched()
+
+  def refresh_generation(self, read_generation):
+    """
+    Calls read_generation() (e.g. current_generation(db)) and records the
+    result, unless the generation was read less than generation_seconds ago
+    """
+    now = time.monotonic()
+    with self.lock:
+      if self.generation_read is not None and now - self.generation_read < self.generation_seconds:
+        return
+      self.generation_read = now
+
+    self.set_generation(read_generation())
+
+  def invalidate_unmatched(self):
+    with self.lock:
+      stale = [key for key, entry in self.entries.items() if entry[3] == no_match]
+      for key in stale:
+        del self.entries[key]
+      self.invalidations += len(stale)
+
+  def clear(self):
+    with self.lock:
+      self.invalidations += len(self.entries)
+      self.entries.clear()
+
+  def stats(self):
+    with self.lock:
+      lookups = self.hits + self.near_hits + self.misses
+      return {
+        "entries": len(self.entries),
+        "hits": self.hits,
+        "near_hits": self.near_hits,
+        "misses": self.misses,
+        "hit_rate": round((self.hits + self.near_hits) / lookups, 3) if lookups else 0.0,
+        "evictions": self.evictions,
+        "invalidations": self.invalidations
+      }
+
+
+def perceptual_hash(bytes):
+  """
+  Returns the 64-bit dHash of the image, or None if Pillow is not
+  available or the image cannot be decoded
+  """
+  try:
+    import io
+    from PIL import Image
+
+    image = Image.open(io.BytesIO(bytes)).convert("L").resize((9, 8))
+    pixels = list(image.getdata())
+  except Exception:
+    return None
+
+  value = 0
+  for row in range(8):
+    for col in range(8):
+      left = pixels[row * 9 + col]
+      right = pixels[row * 9 + col + 1]
+      value = (value << 1) | (1 if left > right else 0)
+
+  return value
+
+
+def hamming(a, b):
+  return bin(a ^ b).count("1")
+
+
+def current_generation(db):
+  """
+  Returns (highest entryid in the faces table, face_changes counter): the
+  first changes whenever a face is registered, the second whenever rows
+  are updated or deleted
+  """
+  row = db.retrieve_one_row(
+    "SELECT (SELECT MAX(entryid) FROM faces), (SELECT changes FROM face_changes WHERE id = 1);")
+  return (row[0], row[1]) if row else None
+
+
+def rows_changed(db):
+  """
+  Called after updating or deleting faces rows; every container's cache
+  then drops its outcomes within generation_seconds
+  """
+  db.perform_action("UPDATE face_changes SET changes = changes + 1 WHERE id = 1;")
+
+
+_cache = None
+
+
+def get_cache(configur):
+  """
+  Returns the container-wide cache configured from the optional [cache]
+  section of config.ini, or None if it is disabled
+  """
+  global _cache
+
+  if not configur.getboolean('cache', 'enabled', fallback=True):
+    return None
+
+  if _cache is None:
+    _cache = ResultCache(
+      max_entries=configur.getint('cache', 'max_entries', fallback=1024),
+      ttl_seconds=configur.getint('cache', 'ttl_seconds', fallback=300),
+      phash_distance=configur.getint('cache', 'phash_distance', fallback=0),
+      generation_seconds=configur.getfloat('cache', 'generation_seconds', fallback=5.0))
+
+  return _cache
+
+
+def invalidate_unmatched():
+  """
+  Called after a registration in this container
+  """
+  if _cache is not None:
+    _cache.invalidate_unmatched()
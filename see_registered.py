@@ -1,70 +1,75 @@
 import json
-import boto3
-import os
-import datatier
+import lambda_init
+import requestlog
+import attributestore
 
-from configparser import ConfigParser
+#
+# page sizes for keyset pagination (?after_entryid=N&limit=M):
+#
+default_page_size = 500
+max_page_size = 1000
 
+@requestlog.handler("see_registered")
 def lambda_handler(event, context):
   try:
-    print("**STARTING**")
-    print("**lambda: registered_faces**")
-
     #adapted from project 3 users function
 
     #
-    # setup AWS based on config file:
+    # open connection to the database (cached across warm invocations):
     #
-    config_file = 'config.ini'
-    os.environ['AWS_SHARED_CREDENTIALS_FILE'] = config_file
-
-    configur = ConfigParser()
-    configur.read(config_file)
+    db, = lambda_init.timed_setup(
+      "see_registered",
+      lambda_init.get_db)
 
     #
-    # configure for S3 access:
-    #
-    #s3_profile = 's3readonly'
-    #boto3.setup_default_session(profile_name=s3_profile)
-    #
-    #bucketname = configur.get('s3', 'bucket_name')
+    # clients that pass after_entryid and/or limit get one page at a time;
+    # the cursor is the last entryid seen, so every page is an index range
+    # scan on the primary key no matter how deep the client has paged:
     #
-    #s3 = boto3.resource('s3')
-    #bucket = s3.Bucket(bucketname)
+    params = event.get("queryStringParameters") or {}
+    paginated = "after_entryid" in params or "limit" in params
 
-    #
-    # configure for RDS access
-    #
-    rds_endpoint = configur.get('rds', 'endpoint')
-    rds_portnum = int(configur.get('rds', 'port_number'))
-    rds_username = configur.get('rds', 'user_name')
-    rds_pwd = configur.get('rds', 'user_pwd')
-    rds_dbname = configur.get('rds', 'db_name')
+    if paginated:
+      after_entryid = int(params.get("after_entryid", 0))
+      limit = min(int(params.get("limit", default_page_size)), max_page_size)
 
-    #
-    # open connection to the database:
-    #
-    print("**Opening connection**")
+      if limit < 1:
+        raise Exception("limit must be at least 1")
 
-    dbConn = datatier.get_dbConn(rds_endpoint, rds_portnum, rds_username, rds_pwd, rds_dbname)
+      #
+      # fetch one extra row to know whether there is another page:
+      #
+      sql = "SELECT " + attributestore.columns + " FROM faces WHERE entryid > %s ORDER BY entryid LIMIT %s";
 
-    #
-    # now retrieve all the users:
-    #
-    print("**Retrieving data**")
+      rows = db.retrieve_all_rows(sql, [after_entryid, limit + 1])
 
-    sql = "SELECT * FROM faces ORDER BY entryid";
+      next_after_entryid = None
+      if len(rows) > limit:
+        rows = rows[:limit]
+        next_after_entryid = rows[-1][0]
 
-    rows = datatier.retrieve_all_rows(dbConn, sql)
+      requestlog.info("page", after_entryid=after_entryid, limit=limit, rows=len(rows))
 
-    for row in rows:
-      print(row)
+      return {
+        'statusCode': 200,
+        'body': json.dumps({
+          "faces": rows,
+          "next_after_entryid": next_after_entryid
+        })
+      }
+
+    #
+    # now retrieve all the users (original, unpaginated response):
+    #
+    sql = "SELECT " + attributestore.columns + " FROM faces ORDER BY entryid";
+
+    rows = db.retrieve_all_rows(sql)
 
     #
     # respond in an HTTP-like way, i.e. with a status
     # code and body in JSON format:
     #
-    print("**DONE, returning rows**")
+    requestlog.info("all rows", rows=len(rows))
 
     return {
       'statusCode': 200,
@@ -72,10 +77,9 @@ def lambda_handler(event, context):
     }
 
   except Exception as err:
-    print("**ERROR**")
-    print(str(err))
+    requestlog.error("see_registered failed", error=str(err))
 
     return {
       'statusCode': 400,
       'body': json.dumps(str(err))
-    }
\ No newline at end of file
+    }
@@ -0,0 +1,459 @@
+#
+# Sharded Rekognition collections.
+#
+# With one collection, search latency and cost grow with the gallery.
+# With sharding on, faces are spread over several collections:
+#
+#   - a face registered with a shard key (e.g. a site or tenant, sent as
+#     "shard" in the request) goes to the collection the shard map assigns
+#     to that key, or else to the hash shard of the key, so all of a key's
+#     faces are in one collection
+#   - a face registered without a key goes to the hash shard of its image
+#     hash, which spreads the gallery evenly
+#
+# Hash shard i is the collection <prefix>-<i>. The shard map (the shards
+# table) gives a key its own collection, e.g. a large tenant.
+#
+# authenticate_faces with a shard key searches only that key's collection
+# (and the pre-sharding one, see legacy below); without one it searches
+# every collection in parallel. Matches are merged by similarity. Every
+# row records its shard key and collection, so after the shard count or
+# the map changes
+#
+#   python shards.py rebalance
+#
+# re-indexes the faces that are now in the wrong collection from their S3
+# image and deletes them from the old one. Rows from before sharding (no
+# collectionid) are in the [matcher] collection_id, which every search
+# (keyed or not) also covers while legacy = true and such rows are left;
+# once rebalance has moved them all, searches stop calling it.
+#
+import sys
+import json
+import time
+import hashlib
+import argparse
+import threading
+import requestlog
+import objectstore
+import resultcache
+
+from matchers import Matcher, RekognitionMatcher
+from concurrent.futures import ThreadPoolExecutor
+
+#
+# longest shard key accepted (the faces.shardkey column):
+#
+max_key_length = 64
+
+
+def shard_key(params):
+  """
+  Returns the optional "shard" field of the request (JSON body or query
+  string), or None
+  """
+  key = params.get("shard") if params else None
+
+  if key is None or key == "":
+    return None
+  if not isinstance(key, str) or len(key) > max_key_length:
+    raise Exception("shard must be a string of at most " + str(max_key_length) + " characters")
+
+  return key
+
+
+def error_code(err):
+  response = getattr(err, "response", None)
+  if not isinstance(response, dict):
+    return None
+  return response.get("Error", {}).get("Code")
+
+
+def ensure_collection(rekognition, collection_id):
+  """
+  Creates the collection unless it already exists
+  """
+  try:
+    rekognition.create_collection(CollectionId=collection_id)
+    requestlog.info("created collection", collection=collection_id)
+  except Exception as err:
+    if error_code(err) != "ResourceAlreadyExistsException":
+      raise
+
+
+###################################################################
+#
+# shard map
+#
+class ShardMap:
+
+  def __init__(self, db, prefix="database-faces", count=4, ttl_seconds=60):
+    if count < 1:
+      raise Exception("shard count must be at least 1")
+
+    self.db = db
+    self.prefix = prefix
+    self.count = count
+    self.ttl_seconds = ttl_seconds  # how long a loaded map is used before re-reading it
+
+    self.lock = threading.Lock()
+    self.map = None
+    self.loaded = 0.0
+    self.legacy = None
+    self.legacy_loaded = 0.0
+
+  def hash_collection(self, value):
+    digest = hashlib.sha256(value.encode("utf-8")).digest()
+    return "%s-%d" % (self.prefix, int.from_bytes(digest[:8], "big") % self.count)
+
+  def hash_collections(self):
+    return ["%s-%d" % (self.prefix, i) for i in range(self.count)]
+
+  def mapped(self):
+    """
+    Returns the shard map, shard key -> collection id, re-read from the
+    database at most once per ttl_seconds
+    """
+    with self.lock:
+      now = time.monotonic()
+      if self.map is None or now - self.loaded > self.ttl_seconds:
+        rows = self.db.retrieve_all_rows("SELECT shardkey, collectionid FROM shards;")
+        self.map = {row[0]: row[1] for row in rows}
+        self.loaded = now
+      return self.map
+
+  def has_legacy_rows(self):
+    """
+    True while some faces are from before sharding (no collectionid),
+    re-checked at most once per ttl_seconds
+    """
+    with self.lock:
+      now = time.monotonic()
+      if self.legacy is None or now - self.legacy_loaded > self.ttl_seconds:
+        row = self.db.retrieve_one_row("SELECT entryid FROM faces WHERE collectionid IS NULL LIMIT 1;")
+        self.legacy = len(row) > 0
+        self.legacy_loaded = now
+      return self.legacy
+
+  def route(self, key, content=None):
+    """
+    Returns the collection for a face with this shard key (may be None) and
+    content (the image hash, used when there is no key)
+    """
+    if key is not None:
+      return self.mapped().get(key) or self.hash_collection("key:" + key)
+    if content is None:
+      raise Exception("a face without a shard key needs its image hash to be routed")
+    return self.hash_collection("image:" + content)
+
+  def collections(self):
+    """
+    Every collection faces are routed to: the hash shards, then the
+    collections of the shard map
+    """
+    collections = self.hash_collections()
+    for collection_id in sorted(set(self.mapped().values())):
+      if collection_id not in collections:
+        collections.append(collection_id)
+    return collections
+
+  def assign(self, key, collection_id):
+    self.db.perform_action("DELETE FROM shards WHERE shardkey = %s;", [key])
+    if collection_id is not None:
+      self.db.perform_action("INSERT INTO shards(shardkey, collectionid) VALUES(%s, %s);",
+                             [key, collection_id])
+    with self.lock:
+      self.map = None
+
+
+###################################################################
+#
+# matcher
+#
+class ShardedMatcher(Matcher):
+  """
+  RekognitionMatcher over every collection of a ShardMap
+  """
+
+  def __init__(self, rekognition, shard_map, legacy_collection=None, max_workers=16):
+    self.rekognition = rekognition
+    self.shard_map = shard_map
+    self.legacy_collection = legacy_collection  # pre-sharding collection, searched while it has rows
+    self.max_workers = max_workers
+
+    self.matchers = {}
+    self.executor = None
+    self.lock = threading.Lock()
+
+  def matcher(self, collection_id):
+    with self.lock:
+      if collection_id not in self.matchers:
+        self.matchers[collection_id] = RekognitionMatcher(self.rekognition, collection_id)
+      return self.matchers[collection_id]
+
+  def legacy(self):
+    """
+    The pre-sharding collection if it still has to be searched, else None
+    """
+    if self.legacy_collection and self.shard_map.has_legacy_rows():
+      return self.legacy_collection
+    return None
+
+  def search_collections(self):
+    collections = self.shard_map.collections()
+    legacy = self.legacy()
+    if legacy and legacy not in collections:
+      collections.append(legacy)
+    return collections
+
+  def get_executor(self):
+    #
+    # not lambda_init's executor: group photos already run their searches
+    # on that one, and a search waiting for its own fan-out on the same
+    # pool could deadlock it
+    #
+    with self.lock:
+      if self.executor is None:
+        self.executor = ThreadPoolExecutor(max_workers=self.max_workers)
+      return self.executor
+
+  def route(self, shard_key=None, imagehash=None):
+    if shard_key is None and imagehash is None:
+      return None  # search every shard
+    return self.shard_map.route(shard_key, imagehash)
+
+  def index_face(self, image_bytes, collection_id=None):
+    if collection_id is None:
+      collection_id = self.route(imagehash=objectstore.content_hash(image_bytes))
+
+    matcher = self.matcher(collection_id)
+    try:
+      return matcher.index_face(image_bytes)
+    except Exception as err:
+      if error_code(err) != "ResourceNotFoundException":
+        raise
+      #
+      # first face in this shard:
+      #
+      ensure_collection(self.rekognition, collection_id)
+      return matcher.index_face(image_bytes)
+
+  def search_one(self, collection_id, image_bytes, threshold, max_faces):
+    try:
+      return self.matcher(collection_id).search(image_bytes, threshold, max_faces)
+    except Exception as err:
+      if error_code(err) == "ResourceNotFoundException":
+        return []  # no face was ever routed here
+      raise
+
+  def search(self, image_bytes, threshold, max_faces, collection_id=None):
+    if collection_id is None:
+      collections = self.search_collections()
+    else:
+      #
+      # a shard key's own collection, plus the pre-sharding collection
+      # while the key's faces registered before sharding may still be there
+      #
+      collections = [collection_id]
+      legacy = self.legacy()
+      if legacy and legacy != collection_id:
+        collections.append(legacy)
+
+    if len(collections) == 1:
+      return self.search_one(collections[0], image_bytes, threshold, max_faces)
+
+    executor = self.get_executor()
+
+    searches = [executor.submit(self.search_one, collection_id, image_bytes, threshold, max_faces)
+                for collection_id in collections]
+
+    #
+    # a failed shard fails the search (e.g. throttled => 429, the client
+    # retries); ignoring it could deny someone whose face is in that shard
+    #
+    matches = []
+    for search in searches:
+      matches.extend(search.result())
+
+    requestlog.debug("fan-out search", collections=len(collections), matches=len(matches))
+
+    matches.sort(key=lambda match: match['Similarity'], reverse=True)
+    return matches[:max_faces]
+
+  def detect_faces(self, image_bytes):
+    return self.matcher(self.shard_map.hash_collections()[0]).detect_faces(image_bytes)
+
+
+def from_config(configur, rekognition, get_db):
+  """
+  Builds a ShardedMatcher from the optional [shards] section of the
+  config, or returns None when sharding is off (count = 0, the default):
+
+    [shards]
+    count = 4                  (hash shards)
+    prefix = database-faces    (hash shard i is collection <prefix>-<i>)
+    legacy = true              (also search the [matcher] collection_id
+                                while rows from before sharding are left)
+    map_ttl = 60               (seconds the shard map is cached)
+    max_workers = 16           (parallel searches per container)
+  """
+  section = 'shards'
+  count = configur.getint(section, 'count', fallback=0)
+
+  if count <= 0:
+    return None
+
+  if rekognition is None:
+    raise Exception("sharding needs the rekognition matcher backend")
+
+  shard_map = ShardMap(
+    get_db(),
+    prefix=configur.get(section, 'prefix', fallback='database-faces'),
+    count=count,
+    ttl_seconds=configur.getint(section, 'map_ttl', fallback=60))
+
+  legacy = None
+  if configur.getboolean(section, 'legacy', fallback=True):
+    legacy = configur.get('matcher', 'collection_id', fallback='database-faces')
+
+  return ShardedMatcher(rekognition, shard_map, legacy,
+                        max_workers=configur.getint(section, 'max_workers', fallback=16))
+
+
+###################################################################
+#
+# rebalancing
+#
+def rebalance(matcher, db, bucketname, legacy_collection, dry_run=False):
+  """
+  Moves every face whose collection is not the one its shard key / image
+  hash routes to now: index_faces from the image in S3 into the new
+  collection, update the row, then delete the face from the old one. A
+  crash between the steps leaves at worst an orphan in the new
+  collection, which reconcile.py finds.
+
+  Returns
+  -------
+  dictionary of counts
+  """
+  import reconcile
+
+  shard_map = matcher.shard_map
+  rekognition = matcher.rekognition
+
+  counts = {"rows": 0, "to_move": 0, "moved": 0, "failed": 0}
+  moves = reconcile.Spool(batch_size=100)
+
+  #
+  # collect first, move afterwards, so the scan does not see its own
+  # updates:
+  #
+  sql = "SELECT entryid, rekognitionid, bucketkey, shardkey, imagehash, collectionid FROM faces;"
+  for entryid, face_id, bucketkey, key, imagehash, collection_id in db.iter_rows(sql):
+    counts["rows"] += 1
+
+    current = collection_id or legacy_collection
+    target = shard_map.route(key, imagehash or bucketkey)
+
+    if current != target:
+      counts["to_move"] += 1
+      moves.add([entryid, face_id, bucketkey, current, target])
+
+  if dry_run:
+    for batch in moves.batches():
+      for move in batch:
+        print(json.dumps({"entryid": move[0], "from": move[3], "to": move[4]}))
+    return counts
+
+  for collection_id in shard_map.collections():
+    ensure_collection(rekognition, collection_id)
+
+  for batch in moves.batches():
+    deletes = {}  # old collection -> face ids moved out of it
+
+    for entryid, face_id, bucketkey, current, target in batch:
+      try:
+        response = rekognition.index_faces(
+          CollectionId=target,
+          Image={'S3Object': {'Bucket': bucketname, 'Name': bucketkey}},
+          MaxFaces=1)
+
+        if not response['FaceRecords']:
+          raise Exception("no face detected in image")
+
+        new_face_id = response['FaceRecords'][0]['Face']['FaceId']
+
+        db.perform_action("UPDATE faces SET rekognitionid = %s, collectionid = %s WHERE entryid = %s;",
+                          [new_face_id, target, entryid])
+
+        deletes.setdefault(current, []).append(face_id)
+        counts["moved"] += 1
+      except Exception as err:
+        counts["failed"] += 1
+        print("**move of entry", entryid, "to", target, "failed:", str(err), "**")
+
+    #
+    # cached authentications hold the rows' old rekognitionid:
+    #
+    if deletes:
+      resultcache.rows_changed(db)
+
+    for collection_id, face_ids in deletes.items():
+      try:
+        rekognition.delete_faces(CollectionId=collection_id, FaceIds=face_ids)
+      except Exception as err:
+        print("**delete from", collection_id, "failed:", str(err), "(reconcile.py will find them) **")
+
+  return counts
+
+
+if __name__ == "__main__":
+  import lambda_init
+
+  parser = argparse.ArgumentParser(description="Manage sharded Rekognition collections")
+  commands = parser.add_subparsers(dest="command", required=True)
+
+  commands.add_parser("list", help="collections, their row counts and the shard map")
+
+  assign = commands.add_parser("assign", help="give a shard key its own collection")
+  assign.add_argument("key")
+  assign.add_argument("collection")
+
+  unassign = commands.add_parser("unassign", help="route a shard key by hash again")
+  unassign.add_argument("key")
+
+  balance = commands.add_parser("rebalance", help="move faces into the collections they route to")
+  balance.add_argument("--dry-run", action="store_true", help="only list the moves")
+
+  args = parser.parse_args()
+
+  matcher = lambda_init.get_matcher()
+  if not isinstance(matcher, ShardedMatcher):
+    print("**sharding is off: set count in the [shards] section of config.ini**")
+    sys.exit(1)
+
+  db = lambda_init.get_db()
+  shard_map = matcher.shard_map
+
+  if args.command == "list":
+    rows = db.retrieve_all_rows("SELECT collectionid, COUNT(*) FROM faces GROUP BY collectionid;")
+    print(json.dumps({
+      "collections": matcher.search_collections(),
+      "rows": {(row[0] or "(unsharded)"): row[1] for row in rows},
+      "map": shard_map.mapped()
+    }, indent=2))
+
+  elif args.command == "assign":
+    shard_map.assign(args.key, args.collection)
+    print("**assigned", args.key, "to", args.collection, "- run rebalance to move its faces**")
+
+  elif args.command == "unassign":
+    shard_map.assign(args.key, None)
+    print("**unassigned", args.key, "- run rebalance to move its faces**")
+
+  else:
+    configur = lambda_init.get_config()
+    bucketname = configur.get('s3', 'bucket_name')
+    legacy_collection = configur.get('matcher', 'collection_id', fallback='database-faces')
+    counts = rebalance(matcher, db, bucketname, legacy_collection, args.dry_run)
+    print("**DONE**", counts)
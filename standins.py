@@ -0,0 +1,345 @@
+#
+# In-process stand-ins for S3 and Rekognition, used by benchmark.py to run
+# the lambda handlers without AWS.
+#
+# They implement the handful of calls the lambdas make, with the same
+# request / response shapes as boto3, plus configurable injected latency
+# and throttling (raised as the botocore ClientError boto3 would raise).
+#
+# Synthetic face images: a JPEG start-of-image marker, a "FACE:<person>;"
+# tag and random padding. Every image of the same person carries the same
+# tag but different bytes, so the stand-in Rekognition can tell who is in
+# a picture while the result cache still sees distinct images. An image
+# with no tag has no face in it.
+#
+import io
+import time
+import uuid
+import random
+import threading
+
+from botocore.exceptions import ClientError
+
+face_tag = b"FACE:"
+
+
+def synthetic_image(person, size=20000, rng=random):
+  """
+  Returns fake JPEG bytes showing person (None for an image with no face)
+  """
+  tag = face_tag + person.encode() + b";" if person is not None else b""
+  padding = size - 3 - len(tag)
+  return b"\xff\xd8\xff" + tag + rng.randbytes(max(0, padding))
+
+
+def person_in(image_bytes):
+  """
+  Returns the person tagged in a synthetic image, or None
+  """
+  start = image_bytes.find(face_tag, 0, 256)
+  if start < 0:
+    return None
+  start += len(face_tag)
+  end = image_bytes.find(b";", start, 256)
+  return image_bytes[start:end].decode() if end >= 0 else None
+
+
+def face_detail(person):
+  """
+  A FaceDetail in Rekognition's shape, derived from the person's name so
+  it is stable across calls
+  """
+  seed = sum(person.encode())
+  emotions = ["HAPPY", "CALM", "SURPRISED", "CONFUSED", "SAD"]
+  return {
+    "BoundingBox": {"Width": 0.4, "Height": 0.5, "Left": 0.3, "Top": 0.2},
+    "Gender": {"Value": "Female" if seed % 2 else "Male", "Confidence": 99.1},
+    "AgeRange": {"Low": 20 + seed % 30, "High": 28 + seed % 30},
+    "Emotions": [
+      {"Type": emotion, "Confidence": round(90.0 / (i + 1), 2)}
+      for i, emotion in enumerate(emotions)
+    ],
+    "Confidence": 99.9
+  }
+
+
+###################################################################
+#
+# latency / throttling
+#
+class ServiceModel:
+  """
+  Injected per-call latency (base_ms plus up to jitter_ms, uniform) and a
+  probability throttle_rate of failing a call with throttle_code
+  """
+
+  def __init__(self, base_ms=0.0, jitter_ms=0.0, throttle_rate=0.0,
+               throttle_code="ThrottlingException", seed=None):
+    self.base_ms = base_ms
+    self.jitter_ms = jitter_ms
+    self.throttle_rate = throttle_rate
+    self.throttle_code = throttle_code
+    self.rng = random.Random(seed)
+    self.lock = threading.Lock()
+
+    self.calls = 0
+    self.throttled = 0
+
+  def call(self, operation):
+    with self.lock:
+      self.calls += 1
+      delay = self.base_ms + self.rng.random() * self.jitter_ms
+      throttle = self.rng.random() < self.throttle_rate
+      if throttle:
+        self.throttled += 1
+
+    if delay > 0:
+      time.sleep(delay / 1000.0)
+
+    if throttle:
+      raise ClientError(
+        {"Error": {"Code": self.throttle_code, "Message": "Rate exceeded"},
+         "ResponseMetadata": {"HTTPStatusCode": 400}},
+        operation)
+
+  def stats(self):
+    with self.lock:
+      return {"calls": self.calls, "throttled": self.throttled}
+
+
+###################################################################
+#
+# S3
+#
+class StubS3:
+  """
+  Low-level S3 client with put_object / get_object / head_object /
+  delete_object; objects live in a dictionary
+  """
+
+  def __init__(self, model=None):
+    self.model = model or ServiceModel(throttle_code="SlowDown")
+    self.objects = {}  # (bucket, key) -> (bytes, content type)
+    self.lock = threading.Lock()
+
+  def put_object(self, Bucket, Key, Body, ContentType=None, **kwargs):
+    self.model.call("PutObject")
+    with self.lock:
+      self.objects[(Bucket, Key)] = (bytes(Body), ContentType)
+    return {"ETag": '"' + uuid.uuid4().hex + '"'}
+
+  def get_object(self, Bucket, Key, **kwargs):
+    self.model.call("GetObject")
+    body, content_type = self.lookup(Bucket, Key, "GetObject")
+    return {"Body": io.BytesIO(body), "ContentLength": len(body), "ContentType": content_type}
+
+  def head_object(self, Bucket, Key, **kwargs):
+    self.model.call("HeadObject")
+    body, content_type = self.lookup(Bucket, Key, "HeadObject")
+    return {"ContentLength": len(body), "ContentType": content_type}
+
+  def delete_object(self, Bucket, Key, **kwargs):
+    self.model.call("DeleteObject")
+    with self.lock:
+      self.objects.pop((Bucket, Key), None)
+    return {}
+
+  def lookup(self, bucket, key, operation):
+    with self.lock:
+      found = self.objects.get((bucket, key))
+
+    if found is None:
+      code = "404" if operation == "HeadObject" else "NoSuchKey"
+      raise ClientError(
+        {"Error": {"Code": code, "Message": "Not Found"},
+         "ResponseMetadata": {"HTTPStatusCode": 404}},
+        operation)
+
+    return found
+
+
+class StubBucket:
+
+  def __init__(self, s3, name):
+    self.s3 = s3
+    self.name = name
+
+
+class StubS3Resource:
+  """
+  Just enough of the S3 service resource for lambda_init.get_bucket
+  """
+
+  def __init__(self, s3):
+    self.s3 = s3
+
+  def Bucket(self, name):
+    return StubBucket(self.s3, name)
+
+
+###################################################################
+#
+# Rekognition
+#
+class StubRekognition:
+  """
+  Rekognition client with one or more face collections. Searching an
+  image of a registered person returns that person's face ids with a high
+  similarity; anyone else gets no matches.
+  """
+
+  def __init__(self, s3=None, model=None):
+    self.s3 = s3
+    self.model = model or ServiceModel(throttle_code="ProvisionedThroughputExceededException")
+    self.collections = {}  # collection id -> {face id: person}
+    self.lock = threading.Lock()
+
+  def image_bytes(self, Image):
+    if "Bytes" in Image:
+      return Image["Bytes"]
+
+    s3object = Image["S3Object"]
+    body, _ = self.s3.lookup(s3object["Bucket"], s3object["Name"], "GetObject")
+    return body
+
+  def collection(self, collection_id, operation):
+    faces = self.collections.get(collection_id)
+    if faces is None:
+      raise ClientError(
+        {"Error": {"Code": "ResourceNotFoundException",
+                   "Message": "collection " + collection_id + " not found"},
+         "ResponseMetadata": {"HTTPStatusCode": 400}},
+        operation)
+    return faces
+
+  def create_collection(self, CollectionId, **kwargs):
+    with self.lock:
+      self.collections.setdefault(CollectionId, {})
+    return {"StatusCode": 200}
+
+  def index_faces(self, CollectionId, Image, DetectionAttributes=None, MaxFaces=None, **kwargs):
+    self.model.call("IndexFaces")
+    person = person_in(self.image_bytes(Image))
+
+    if person is None:
+      return {"FaceRecords": [], "UnindexedFaces": []}
+
+    face_id = str(uuid.uuid4())
+    with self.lock:
+      self.collections.setdefault(CollectionId, {})[face_id] = person
+
+    return {
+      "FaceRecords": [{
+        "Face": {"FaceId": face_id, "Confidence": 99.9},
+        "FaceDetail": face_detail(person)
+      }],
+      "UnindexedFaces": []
+    }
+
+  def search_faces_by_image(self, CollectionId, Image, FaceMatchThreshold=80.0, MaxFaces=10, **kwargs):
+    self.model.call("SearchFacesByImage")
+    person = person_in(self.image_bytes(Image))
+
+    if person is None:
+      raise ClientError(
+        {"Error": {"Code": "InvalidParameterException",
+                   "Message": "There are no faces in the image"},
+         "ResponseMetadata": {"HTTPStatusCode": 400}},
+        "SearchFacesByImage")
+
+    with self.lock:
+      faces = self.collection(CollectionId, "SearchFacesByImage")
+      matches = [face_id for face_id, other in faces.items() if other == person]
+
+    return {
+      "SearchedFaceBoundingBox": face_detail(person)["BoundingBox"],
+      "FaceMatches": [
+        {"Face": {"FaceId": face_id}, "Similarity": 99.0}
+        for face_id in matches[:MaxFaces]
+      ]
+    }
+
+  def detect_faces(self, Image, Attributes=None, **kwargs):
+    self.model.call("DetectFaces")
+    person = person_in(self.image_bytes(Image))
+
+    details = [face_detail(person)] if person is not None else []
+    if Attributes != ["ALL"]:
+      details = [{"BoundingBox": d["BoundingBox"], "Confidence": d["Confidence"]} for d in details]
+
+    return {"FaceDetails": details}
+
+  def list_faces(self, CollectionId, MaxResults=1000, NextToken=None, **kwargs):
+    self.model.call("ListFaces")
+    with self.lock:
+      face_ids = sorted(self.collection(CollectionId, "ListFaces"))
+
+    start = int(NextToken) if NextToken else 0
+    page = face_ids[start:start + MaxResults]
+
+    response = {"Faces": [{"FaceId": face_id} for face_id in page]}
+    if start + MaxResults < len(face_ids):
+      response["NextToken"] = str(start + MaxResults)
+    return response
+
+  def delete_faces(self, CollectionId, FaceIds, **kwargs):
+    self.model.call("DeleteFaces")
+    with self.lock:
+      faces = self.collection(CollectionId, "DeleteFaces")
+      deleted = [face_id for face_id in FaceIds if faces.pop(face_id, None) is not None]
+    return {"DeletedFaces": deleted}
+
+
+###################################################################
+#
+# instrumentation
+#
+class StageRecorder:
+  """
+  Collects the duration of every call made through an Instrumented proxy,
+  keyed by stage name (e.g. "rekognition.search_faces_by_image")
+  """
+
+  def __init__(self):
+    self.durations = {}
+    self.lock = threading.Lock()
+
+  def record(self, stage, ms):
+    with self.lock:
+      self.durations.setdefault(stage, []).append(ms)
+
+  def clear(self):
+    with self.lock:
+      self.durations = {}
+
+
+class Instrumented:
+  """
+  Proxy that times every method call on target and reports it to the
+  recorder as "<name>.<method>"; an optional ServiceModel adds injected
+  latency (used for the database, which has no stand-in of its own)
+  """
+
+  def __init__(self, target, name, recorder, model=None):
+    self.target = target
+    self.name = name
+    self.recorder = recorder
+    self.model = model
+
+  def __getattr__(self, attr):
+    value = getattr(self.target, attr)
+    if not callable(value):
+      return value
+
+    stage = self.name + "." + attr
+
+    def timed(*args, **kwargs):
+      t0 = time.perf_counter()
+      try:
+        if self.model is not None:
+          self.model.call(attr)
+        return value(*args, **kwargs)
+      finally:
+        self.recorder.record(stage, (time.perf_counter() - t0) * 1000)
+
+    return timed
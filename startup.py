@@ -0,0 +1,99 @@
+#
+# Startup check of the client CLI.
+#
+# Runs main.py --help under python -X importtime and exits non-zero when
+# main.py's imports take longer than the budget or pull in a heavy module
+# at startup:
+#
+#   python startup.py [--budget-ms 100] [--runs 5]
+#
+# Standard library only, so it runs on a client machine without the
+# lambdas' dependencies (boto3) or the client's own (aiohttp, requests).
+#
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+
+#
+# modules main.py may only import once a command needs them:
+#
+heavy_client_modules = ["matplotlib", "jsons", "aiohttp", "requests", "cv2", "numpy", "PIL",
+                        "asyncclient", "bulk", "video"]
+
+
+def import_times(command):
+  """
+  Runs python -X importtime command...; returns (total import ms, names of
+  the imported modules)
+  """
+  completed = subprocess.run([sys.executable, "-X", "importtime"] + command,
+                             capture_output=True, text=True, check=True)
+  total_us = 0
+  modules = []
+
+  for line in completed.stderr.splitlines():
+    if not line.startswith("import time:"):
+      continue
+    fields = line[len("import time:"):].split("|")
+    if not fields[0].strip().isdigit():
+      continue  # header
+    total_us += int(fields[0])
+    modules.append(fields[2].strip())
+
+  return total_us / 1000, modules
+
+
+def startup_check(budget_ms, runs=5):
+  """
+  Measures the client CLI's startup: the import time main.py adds on top
+  of the interpreter's own, the best wall time of python main.py --help
+  over runs, and any heavy module it imports
+
+  Returns
+  -------
+  dictionary with "ok" false when over budget or a heavy module is imported
+  """
+  main_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py")
+
+  imports_ms = []
+  wall_ms = []
+  modules = []
+
+  for _ in range(runs):
+    interpreter_ms, _ = import_times(["-c", "pass"])
+
+    t0 = time.perf_counter()
+    total_ms, modules = import_times([main_path, "--help"])
+    wall_ms.append((time.perf_counter() - t0) * 1000)
+
+    imports_ms.append(max(0.0, total_ms - interpreter_ms))
+
+  heavy = sorted({name for name in modules if name.split(".")[0] in heavy_client_modules})
+  imports = min(imports_ms)
+
+  return {
+    "imports_ms": round(imports, 2),
+    "wall_ms": round(min(wall_ms), 2),
+    "budget_ms": budget_ms,
+    "modules": len(modules),
+    "heavy_modules": heavy,
+    "ok": imports <= budget_ms and not heavy
+  }
+
+
+def parse_args(argv):
+  parser = argparse.ArgumentParser(description="Check the client CLI's startup time")
+  parser.add_argument("--budget-ms", type=float, default=100.0, help="allowed import time of main.py --help, ms")
+  parser.add_argument("--runs", type=int, default=5, help="runs, the best one counts")
+  return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+  args = parse_args(sys.argv[1:])
+
+  startup = startup_check(args.budget_ms, args.runs)
+  print(json.dumps(startup, indent=2))
+  sys.exit(0 if startup["ok"] else 1)
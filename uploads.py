@@ -0,0 +1,58 @@
+#
+# Client-side helper for sending an image to the register_faces and
+# authenticate_faces web services.
+#
+# By default the raw bytes go over the wire as application/octet-stream
+# with the filename in the query string. The older base64-in-JSON format
+# is still available for gateways that are not configured for binary
+# media types.
+#
+import base64
+
+
+def registration_filename(firstname, lastname, extension):
+  """
+  The filename register_faces reads the person's name from:
+  FIRSTNAME_LASTNAME.EXT. The lambda splits it at the first "_", so the
+  last name may contain "_" but the first name may not.
+  """
+  if not firstname or not lastname:
+    raise Exception("first and last name are both required")
+  if "_" in firstname:
+    raise Exception("first name may not contain '_': " + firstname)
+
+  return firstname + "_" + lastname + "." + extension
+
+
+def image_upload_args(filename, bytes, binary=True, options=None):
+  """
+  Builds the keyword arguments for requests.put(url, **args)
+
+  Parameters
+  ----------
+  filename: filename the server should store the image under
+  bytes: raw image bytes
+  binary: True to send raw bytes, False to send base64-encoded JSON
+  options: optional extra request fields, e.g. {"mode": "multi"}; sent as
+           query parameters (binary) or JSON fields
+
+  Returns
+  -------
+  dictionary of keyword arguments for requests.put / Session.put
+  """
+  if binary:
+    return {
+      "params": dict(options or {}, filename=filename),
+      "data": bytes,
+      "headers": {"Content-Type": "application/octet-stream"}
+    }
+
+  #
+  # encode the image as base64. Note b64encode returns a bytes object,
+  # not a string. So then we have to convert (decode) the bytes -> string,
+  # and then we can serialize the string as JSON for upload to server:
+  #
+  data = base64.b64encode(bytes)
+  datastr = data.decode()
+
+  return {"json": dict(options or {}, filename=filename, data=datastr)}
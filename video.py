@@ -0,0 +1,198 @@
+#
+# Authenticates the faces in a recorded video clip.
+#
+# The clip is decoded locally with OpenCV and sampled at a configurable
+# rate. Consecutive samples are often nearly identical (nobody moved), so
+# each sample is reduced to a tiny grayscale thumbnail and compared with the
+# thumbnail of the last frame actually sent; only frames that changed by
+# more than a threshold go to the authenticate endpoint. Skipped samples
+# reuse the result of the last frame sent.
+#
+# The result is a timeline of who appeared when, plus counts of frames
+# decoded, frames sent and API calls saved.
+#
+# At most max_pending frames are encoded and waiting for their result; the
+# decoder waits for the oldest one beyond that, so memory does not grow
+# with the length of the clip.
+#
+import asyncio
+import collections
+
+import asyncclient
+
+#
+# frames are compared as thumb_size x thumb_size grayscale thumbnails:
+#
+thumb_size = 32
+
+
+def sample_frames(path, sample_fps, progress):
+  """
+  Yields (timestamp in seconds, BGR frame) for frames sampled at
+  roughly sample_fps; progress["decoded"] counts the frames grabbed
+  """
+  import cv2
+
+  capture = cv2.VideoCapture(path)
+  if not capture.isOpened():
+    raise Exception("cannot open video '" + path + "'")
+
+  try:
+    fps = capture.get(cv2.CAP_PROP_FPS) or 30.0
+    step = max(1, int(round(fps / sample_fps)))
+    index = 0
+
+    while True:
+      #
+      # grab() advances without converting the frame; only sampled frames
+      # are retrieved into an image:
+      #
+      if not capture.grab():
+        break
+      progress["decoded"] = index + 1
+      if index % step == 0:
+        ok, frame = capture.retrieve()
+        if not ok:
+          break
+        yield index / fps, frame
+      index += 1
+  finally:
+    capture.release()
+
+
+def thumbnail(frame):
+  import cv2
+
+  gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+  return cv2.resize(gray, (thumb_size, thumb_size), interpolation=cv2.INTER_AREA)
+
+
+def frame_difference(a, b):
+  """
+  Mean absolute difference between two thumbnails (0..255)
+  """
+  import numpy
+  return float(numpy.mean(numpy.abs(a.astype(numpy.int16) - b.astype(numpy.int16))))
+
+
+def build_timeline(samples, gap):
+  """
+  Collapses per-sample results [(t, name or None), ...] into appearances
+  [{"name", "start", "end"}, ...]; sightings of the same person less than
+  gap seconds apart are merged
+  """
+  timeline = []
+  open_spans = {}
+
+  for t, name in samples:
+    if name is None:
+      continue
+    span = open_spans.get(name)
+    if span is not None and t - span["end"] <= gap:
+      span["end"] = t
+    else:
+      span = {"name": name, "start": t, "end": t}
+      open_spans[name] = span
+      timeline.append(span)
+
+  for span in timeline:
+    span["start"] = round(span["start"], 2)
+    span["end"] = round(span["end"], 2)
+
+  return timeline
+
+
+async def authenticate_video_async(client, path, sample_fps=2.0, diff_threshold=6.0, jpeg_quality=85,
+                                   max_pending=16):
+  """
+  Parameters
+  ----------
+  client: open asyncclient.FacialRecognitionClient
+  path: video file
+  sample_fps: frames per second of video to consider
+  diff_threshold: mean absolute thumbnail difference (0..255) below which
+                  a sample counts as unchanged and is not sent
+  jpeg_quality: quality used to encode the frames that are sent
+  max_pending: frames sent whose result has not been collected yet, at most
+
+  Returns
+  -------
+  dictionary with "timeline" and "stats"
+  """
+  import cv2
+
+  progress = {"decoded": 0}
+  frames = sample_frames(path, sample_fps, progress)
+  last_sent = None
+  results = []                   # name (or None) per frame sent, filled in as they complete
+  pending = collections.deque()  # (t, index into results, task)
+  samples = []                   # (t, index into results of the frame whose result applies, or None)
+  saved = 0
+
+  async def collect():
+    t, i, task = pending.popleft()
+    try:
+      face = await task
+      results[i] = face.firstname + " " + face.lastname if face is not None else None
+    except Exception as e:
+      print("frame at %.2f s failed: %s" % (t, str(e)))
+
+  try:
+    while True:
+      item = await asyncio.to_thread(next, frames, None)
+      if item is None:
+        break
+      t, frame = item
+
+      thumb = thumbnail(frame)
+
+      if last_sent is not None and frame_difference(thumb, last_sent) < diff_threshold:
+        samples.append((t, len(results) - 1))
+        saved += 1
+        continue
+
+      ok, jpeg = cv2.imencode(".jpeg", frame, [cv2.IMWRITE_JPEG_QUALITY, jpeg_quality])
+      if not ok:
+        print("frame at %.2f s could not be encoded" % t)
+        samples.append((t, None))
+        continue
+
+      if len(pending) >= max_pending:
+        await collect()
+
+      results.append(None)
+      task = asyncio.create_task(client.authenticate_bytes("frame_%08.2f.jpeg" % t, jpeg.tobytes()))
+      pending.append((t, len(results) - 1, task))
+      samples.append((t, len(results) - 1))
+      last_sent = thumb
+
+    while pending:
+      await collect()
+  finally:
+    for t, i, task in pending:
+      task.cancel()
+
+  per_sample = [(t, results[i] if i is not None else None) for t, i in samples]
+
+  return {
+    "timeline": build_timeline(per_sample, gap=2.0 / sample_fps),
+    "stats": {
+      "frames_decoded": progress["decoded"],
+      "frames_sampled": len(samples),
+      "frames_sent": len(results),
+      "api_calls_saved": saved
+    }
+  }
+
+
+def authenticate_video(baseurl, path, sample_fps=2.0, diff_threshold=6.0, max_concurrency=4, binary=True):
+  """
+  Synchronous wrapper around authenticate_video_async for the CLI
+  """
+  async def run():
+    async with asyncclient.FacialRecognitionClient(
+        baseurl, max_concurrency=max_concurrency, binary=binary) as client:
+      return await authenticate_video_async(client, path, sample_fps, diff_threshold,
+                                            max_pending=4 * max_concurrency)
+
+  return asyncio.run(run())